@@ -4,7 +4,10 @@
 # 1. Run a collector instance, i.e. bind to port 5000 and accept event data
 # 2. Run an objectiv worker, i.e. process data on the queues and write the result to the database.
 #
-# By default option 1 happens. Only if ASYNC_MODE=true and ASYNC_WORK_TYPE=worker does option two happen
+# By default option 1 happens. The collector runs the flask application, or the ASGI application if
+# COLLECTOR_SERVER=asgi. Only if ASYNC_MODE=true and ASYNC_WORK_TYPE=worker does option two happen
+# If ASYNC_MODE=true and ASYNC_WORK_TYPE=supervisor, then multiple worker processes are started. The number
+# of processes is set with WORKER_ENTRY_PROCESSES and WORKER_FINALIZE_PROCESSES (default: 1 each)
 #
 
 if [[ "$ASYNC_MODE" == "true" && "$ASYNC_WORKER_TYPE" == "worker" ]]; then
@@ -13,10 +16,21 @@ if [[ "$ASYNC_MODE" == "true" && "$ASYNC_WORKER_TYPE" == "worker" ]]; then
   exit 0
 fi;
 
+if [[ "$ASYNC_MODE" == "true" && "$ASYNC_WORKER_TYPE" == "supervisor" ]]; then
+  echo "starting worker supervisor"
+  exec objectiv-workers-supervisor --entry "${WORKER_ENTRY_PROCESSES:-1}" --finalize "${WORKER_FINALIZE_PROCESSES:-1}"
+fi;
+
 # Tell python not to buffer any output to stdout and stderr. Not setting this makes any debugging almost
 # impossible
 export PYTHONUNBUFFERED=1
 
+if [[ "$COLLECTOR_SERVER" == "asgi" ]]; then
+  echo "starting gunicorn with uvicorn workers"
+  exec gunicorn --config /etc/gunicorn.conf.py --worker-class uvicorn.workers.UvicornWorker \
+  objectiv_backend.asgi:application
+fi;
+
 echo "starting gunicorn"
 # Run gunicorn. $USER and $PORT are set in the Dockerfile
 exec gunicorn --config /etc/gunicorn.conf.py \
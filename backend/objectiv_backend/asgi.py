@@ -0,0 +1,229 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+ASGI application of the collector. This serves the same end points as the flask application in app.py,
+but handles requests on an event loop: parsing and validation run in a bounded thread pool, and the
+writes to the configured outputs run concurrently in a second thread pool. A slow output therefore no
+longer blocks a worker process for the duration of a request.
+
+Run it with any ASGI server, e.g.:
+    uvicorn objectiv_backend.asgi:application
+    gunicorn -k uvicorn.workers.UvicornWorker objectiv_backend.asgi:application
+"""
+import asyncio
+import io
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from flask import Request, Response
+from werkzeug.wrappers import Response as WerkzeugResponse
+from werkzeug.exceptions import HTTPException, InternalServerError, MethodNotAllowed, NotFound
+
+from objectiv_backend.common.config import init_collector_config, get_collector_config, \
+    COLLECTOR_CPU_THREADS, COLLECTOR_IO_THREADS
+from objectiv_backend.end_points import collector, schema
+from objectiv_backend.end_points.common import generate_cookie_id
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# The same CORS headers as set by the flask-cors plugin, as configured in app.init_cors()
+_CORS_MAX_AGE = str(3600 * 24)
+_CORS_METHODS = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+
+class _Route(NamedTuple):
+    methods: List[str]
+    handler: Callable[['CollectorApp', Request, Optional[str]], Awaitable[Response]]
+
+
+class CollectorApp:
+    """ ASGI application with the collector end points. Use create_asgi_app() to create an instance. """
+
+    def __init__(self, cpu_threads: int, io_threads: int):
+        """
+        :param cpu_threads: number of threads for parsing and validating requests
+        :param io_threads: number of threads for writing to the outputs
+        """
+        self.cpu_executor = ThreadPoolExecutor(max_workers=cpu_threads, thread_name_prefix='collector-cpu')
+        self.io_executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='collector-io')
+        self._routes: Dict[str, _Route] = {
+            '/': _Route(methods=['POST'], handler=CollectorApp._collect),
+            '/schema': _Route(methods=['GET', 'HEAD'], handler=CollectorApp._schema),
+            '/jsonschema': _Route(methods=['GET', 'HEAD'], handler=CollectorApp._json_schema),
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+        body = await _read_body(receive, max_size=collector.DATA_MAX_SIZE_BYTES)
+        request = Request(_get_wsgi_environ(scope, body))
+        response: WerkzeugResponse
+        try:
+            response = await self._dispatch(request)
+        except HTTPException as exc:
+            response = exc.get_response()
+        except Exception:
+            traceback.print_exc()  # todo: real error logging
+            response = InternalServerError().get_response()
+        _add_cors_headers(request, response)
+        await _send_response(send, request, response)
+
+    def shutdown(self):
+        """ Wait for all running tasks to finish, and stop the thread pools. """
+        self.cpu_executor.shutdown(wait=True)
+        self.io_executor.shutdown(wait=True)
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _dispatch(self, request: Request) -> Response:
+        route = self._routes.get(request.path)
+        if route is None:
+            raise NotFound()
+        allowed_methods = route.methods + ['OPTIONS']
+        if request.method == 'OPTIONS':
+            return Response(headers={'Allow': ', '.join(sorted(allowed_methods))})
+        if request.method not in route.methods:
+            raise MethodNotAllowed(valid_methods=sorted(allowed_methods))
+        return await route.handler(self, request, _get_cookie_id(request))
+
+    async def _collect(self, request: Request, cookie_id: Optional[str]) -> Response:
+        return await collector.collect_async(request=request,
+                                             cookie_id=cookie_id,
+                                             cpu_executor=self.cpu_executor,
+                                             io_executor=self.io_executor)
+
+    async def _schema(self, request: Request, cookie_id: Optional[str]) -> Response:
+        return schema.schema(cookie_id=cookie_id)
+
+    async def _json_schema(self, request: Request, cookie_id: Optional[str]) -> Response:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.cpu_executor, schema.json_schema, cookie_id)
+
+
+def create_asgi_app(cpu_threads: int = COLLECTOR_CPU_THREADS,
+                    io_threads: int = COLLECTOR_IO_THREADS) -> CollectorApp:
+    """
+    Create the ASGI application.
+    :param cpu_threads: number of threads for parsing and validating requests
+    :param io_threads: number of threads for writing to the outputs
+    """
+    # load config - this will raise an error if there are configuration problems, and will cache the
+    # result for later calls.
+    init_collector_config()
+    return CollectorApp(cpu_threads=cpu_threads, io_threads=io_threads)
+
+
+def _get_cookie_id(request: Request) -> Optional[str]:
+    """
+    Get the tracking cookie uuid from the request, or generate a new one if the request has no cookie.
+    :return: the cookie id, or None if cookies are not configured
+    """
+    cookie_config = get_collector_config().cookie
+    if not cookie_config:
+        return None
+    return request.cookies.get(cookie_config.name) or generate_cookie_id()
+
+
+async def _read_body(receive: Receive, max_size: int) -> bytes:
+    """
+    Read the request body. Reading stops after more than max_size bytes, as the request will be rejected
+    anyway, there is no need to buffer more than that.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        chunks.append(chunk)
+        size += len(chunk)
+        if not message.get('more_body', False) or size > max_size:
+            break
+    return b''.join(chunks)
+
+
+def _get_wsgi_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    """ Create a WSGI environment from an ASGI http scope, so we can use the same Request class as flask. """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin1').upper().replace('-', '_')
+        value = raw_value.decode('latin1')
+        if name == 'CONTENT_LENGTH':
+            # the body is complete, so its actual length is leading
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        if key in environ:
+            value = f'{environ[key]},{value}'
+        environ[key] = value
+    return environ
+
+
+def _add_cors_headers(request: Request, response: WerkzeugResponse):
+    """
+    Add the same CORS headers as the flask application does. See app.init_cors() for why we allow
+    requests from all origins.
+    """
+    origin = request.headers.get('Origin')
+    if not origin:
+        return
+    response.headers['Access-Control-Allow-Origin'] = origin
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    if request.method == 'OPTIONS' and request.headers.get('Access-Control-Request-Method', '').upper() \
+            in _CORS_METHODS.split(', '):
+        request_headers = request.headers.get('Access-Control-Request-Headers')
+        if request_headers:
+            response.headers['Access-Control-Allow-Headers'] = \
+                ', '.join(sorted(header.strip() for header in request_headers.split(',')))
+        response.headers['Access-Control-Max-Age'] = _CORS_MAX_AGE
+        response.headers['Access-Control-Allow-Methods'] = _CORS_METHODS
+    response.vary.add('Origin')
+
+
+async def _send_response(send: Send, request: Request, response: WerkzeugResponse):
+    # get_wsgi_headers() finalizes the headers in the same way as for the flask app, e.g. Content-Length
+    wsgi_headers = response.get_wsgi_headers(request.environ).to_wsgi_list()
+    headers = [(name.encode('latin1'), value.encode('latin1')) for name, value in wsgi_headers]
+    body = response.get_data() if request.method != 'HEAD' else b''
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = create_asgi_app()
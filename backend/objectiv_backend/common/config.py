@@ -3,13 +3,14 @@ Copyright 2021 Objectiv B.V.
 """
 
 import os
-from typing import NamedTuple, Optional
+from typing import Any, NamedTuple, Optional
 
 # All settings that are controlled through environment variables are listed at the top here, for a
 # complete overview.
 # These settings should not be accessed by the constants here, but through the functions defined
 # below (e.g. get_config_output())
-from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema, \
+    get_event_list_validator
 from objectiv_backend.common.types import EventListSchema
 
 LOAD_BASE_SCHEMA = os.environ.get('LOAD_BASE_SCHEMA', 'true') == 'true'
@@ -18,6 +19,61 @@ SCHEMA_EXTENSION_DIRECTORY = os.environ.get('SCHEMA_EXTENSION_DIRECTORY')
 # when set to true, the collector will return detailed validation errors per event
 SCHEMA_VALIDATION_ERROR_REPORTING = os.environ.get('SCHEMA_VALIDATION_ERROR_REPORTING', 'false') == 'true'
 
+# JSON library used to parse and serialize events: 'orjson', 'json' (the standard library), or 'auto' to use
+# orjson if it's installed, and the standard library otherwise.
+JSON_CODEC = os.environ.get('JSON_CODEC', 'auto')
+
+# Number of threads per process of the ASGI collector (objectiv_backend.asgi). Parsing and validation of
+# requests run in a pool of COLLECTOR_CPU_THREADS threads, writing to the outputs runs in a pool of
+# COLLECTOR_IO_THREADS threads.
+COLLECTOR_CPU_THREADS = int(os.environ.get('COLLECTOR_CPU_THREADS', 2))
+COLLECTOR_IO_THREADS = int(os.environ.get('COLLECTOR_IO_THREADS', 16))
+
+# Maximum number of requests and events that a collector process handles at the same time, 0 for no
+# maximum. Requests that exceed this are rejected with status 429, and a Retry-After header of
+# COLLECTOR_RETRY_AFTER_SECONDS. The same header is set if the events cannot be written to the outputs
+# (status 503).
+COLLECTOR_MAX_IN_FLIGHT_REQUESTS = int(os.environ.get('COLLECTOR_MAX_IN_FLIGHT_REQUESTS', 64))
+COLLECTOR_MAX_IN_FLIGHT_EVENTS = int(os.environ.get('COLLECTOR_MAX_IN_FLIGHT_EVENTS', 10_000))
+COLLECTOR_RETRY_AFTER_SECONDS = int(os.environ.get('COLLECTOR_RETRY_AFTER_SECONDS', 5))
+
+# Directory for the on-disk spool of the collector. If set, events that cannot be written to postgres are
+# stored in the spool, and a background thread writes them to postgres once it is available again. Every
+# collector process uses its own subdirectory. Empty to disable the spool.
+COLLECTOR_SPOOL_DIR = os.environ.get('COLLECTOR_SPOOL_DIR', '')
+# Size of the spool's segment files; files are deleted once all their events are written to postgres.
+COLLECTOR_SPOOL_SEGMENT_BYTES = int(os.environ.get('COLLECTOR_SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024))
+# Maximum number of spooled requests that are written to postgres in a single transaction
+COLLECTOR_SPOOL_BATCH_SIZE = int(os.environ.get('COLLECTOR_SPOOL_BATCH_SIZE', 100))
+# Time to wait before trying again, if writing spooled events to postgres fails
+COLLECTOR_SPOOL_RETRY_SECONDS = float(os.environ.get('COLLECTOR_SPOOL_RETRY_SECONDS', 5))
+
+# Rolling segment files for the file system and S3 outputs. If enabled, the events of all requests are appended
+# to a segment file per prefix (OK, NOK, RAW), with one event per line, instead of written to a file per
+# request. A segment is closed when it reaches COLLECTOR_SEGMENT_MAX_BYTES (compressed), or when it is
+# COLLECTOR_SEGMENT_MAX_SECONDS old. A background thread then moves it to FILESYSTEM_OUTPUT_DIR and/or uploads
+# it to S3.
+COLLECTOR_SEGMENTS_ENABLED = os.environ.get('COLLECTOR_SEGMENTS_ENABLED', 'false') == 'true'
+# Directory for open segments, and for closed segments that still have to be moved or uploaded. If not set,
+# '.segments' in FILESYSTEM_OUTPUT_DIR is used, or in the temp directory if the file system output is disabled.
+COLLECTOR_SEGMENT_DIR = os.environ.get('COLLECTOR_SEGMENT_DIR', '')
+# Compression of the segment files: 'gzip', 'zstd' (requires the zstandard package) or 'none'
+COLLECTOR_SEGMENT_COMPRESSION = os.environ.get('COLLECTOR_SEGMENT_COMPRESSION', 'gzip')
+COLLECTOR_SEGMENT_MAX_BYTES = int(os.environ.get('COLLECTOR_SEGMENT_MAX_BYTES', 64 * 1024 * 1024))
+COLLECTOR_SEGMENT_MAX_SECONDS = float(os.environ.get('COLLECTOR_SEGMENT_MAX_SECONDS', 300))
+# Segments larger than this are uploaded to S3 with a multipart upload, in parts of this size. S3 requires
+# parts of at least 5MB.
+COLLECTOR_SEGMENT_UPLOAD_PART_BYTES = int(os.environ.get('COLLECTOR_SEGMENT_UPLOAD_PART_BYTES', 16 * 1024 * 1024))
+# Time to wait before trying again, if moving or uploading a segment fails
+COLLECTOR_SEGMENT_RETRY_SECONDS = float(os.environ.get('COLLECTOR_SEGMENT_RETRY_SECONDS', 5))
+
+# Also write the accepted events in closed segments (the OK prefix) as Parquet files, partitioned by day, to
+# the file system and/or S3 outputs. Requires COLLECTOR_SEGMENTS_ENABLED, and the pyarrow package. Not supported
+# in async mode, in which the collector only writes RAW segments.
+COLLECTOR_PARQUET_ENABLED = os.environ.get('COLLECTOR_PARQUET_ENABLED', 'false') == 'true'
+# Compression codec of the Parquet files, e.g. 'snappy', 'zstd', 'gzip' or 'none'
+COLLECTOR_PARQUET_COMPRESSION = os.environ.get('COLLECTOR_PARQUET_COMPRESSION', 'snappy')
+
 # Number of ms before an event is considered too old. set to 0 to disable
 MAX_DELAYED_EVENTS_MILLIS = 1000 * 3600
 
@@ -32,6 +88,9 @@ _PG_PORT = os.environ.get('POSTGRES_PORT', '5432')
 _PG_DATABASE_NAME = os.environ.get('POSTGRES_DB', 'objectiv')
 _PG_USER = os.environ.get('POSTGRES_USER', 'objectiv')
 _PG_PASSWORD = os.environ.get('POSTGRES_PASSWORD', '')
+# Size of the connection pool that the collector uses, per process.
+_PG_POOL_MIN_SIZE = os.environ.get('POSTGRES_POOL_MIN_SIZE', '1')
+_PG_POOL_MAX_SIZE = os.environ.get('POSTGRES_POOL_MAX_SIZE', '5')
 
 # ### AWS S3 values, for writing data to S3.
 # default access keys to an empty string, otherwise the boto library will default ot user defaults.
@@ -41,6 +100,8 @@ _AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
 _AWS_REGION = os.environ.get('AWS_REGION', 'eu-west-1')
 _AWS_BUCKET = os.environ.get('AWS_BUCKET', '')
 _AWS_S3_PREFIX = os.environ.get('AWS_S3_PREFIX', '')
+# Endpoint of an S3 compatible service (e.g. MinIO), if not using AWS S3 itself
+_AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL') or None
 
 # ### Setting for outputting data to the filesystem
 _OUTPUT_ENABLE_FILESYSTEM = os.environ.get('OUTPUT_ENABLE_FILESYSTEM', '') == 'true'
@@ -60,6 +121,17 @@ _SP_GCP_PUBSUB_TOPIC_BAD = os.environ.get('SP_GCP_PUBSUB_TOPIC_BAD', '')
 _SP_AWS_MESSAGE_TOPIC_RAW = os.environ.get('SP_AWS_MESSAGE_TOPIC_RAW', '')
 _SP_AWS_MESSAGE_TOPIC_BAD = os.environ.get('SP_AWS_MESSAGE_TOPIC_BAD', '')
 
+# Number of attempts to deliver events to the Snowplow pipeline, and the time to wait before the first
+# retry. The time doubles with every retry.
+SNOWPLOW_MAX_ATTEMPTS = int(os.environ.get('SNOWPLOW_MAX_ATTEMPTS', 3))
+SNOWPLOW_RETRY_BACKOFF_SECONDS = float(os.environ.get('SNOWPLOW_RETRY_BACKOFF_SECONDS', 0.1))
+# Maximum time to wait for PubSub to acknowledge a published event
+SP_PUBLISH_TIMEOUT_SECONDS = 30
+# Batch settings of the PubSub publisher: a batch is sent if it has this many events, or if the first event
+# has waited this long.
+SP_GCP_PUBSUB_BATCH_MAX_MESSAGES = int(os.environ.get('SP_GCP_PUBSUB_BATCH_MAX_MESSAGES', 1000))
+SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS = float(os.environ.get('SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS', 0.01))
+
 # Cookie settings
 _OBJ_COOKIE = 'obj_user_id'
 # default cookie duration is 1 year, can be overridden by setting `COOKIE_DURATION`
@@ -69,9 +141,58 @@ _OBJ_COOKIE_SAMESITE = str(os.environ.get('COOKIE_SAMESITE', 'Lax'))
 # default cookie secure is False, can be overridden by setting `COOKIE_SECURE`
 _OBJ_COOKIE_SECURE = bool(os.environ.get('COOKIE_SECURE', False))
 
-# Maximum number of events that a worker will process in a single batch. Only relevant in async mode
+# Number of events that a worker will initially process in a single batch. Only relevant in async mode
+# The batch size is adjusted at run time, between WORKER_BATCH_SIZE_MIN and WORKER_BATCH_SIZE_MAX: it grows
+# while the queue is deep and transactions take less than WORKER_BATCH_TARGET_SECONDS, and shrinks if
+# transactions take longer or hit the lock_timeout.
 WORKER_BATCH_SIZE = 200
-# Time to sleep, if there is no work to do for the workers. Only relevant in async mode
+WORKER_BATCH_SIZE_MIN = int(os.environ.get('WORKER_BATCH_SIZE_MIN', 20))
+WORKER_BATCH_SIZE_MAX = int(os.environ.get('WORKER_BATCH_SIZE_MAX', 5000))
+WORKER_BATCH_TARGET_SECONDS = float(os.environ.get('WORKER_BATCH_TARGET_SECONDS', 1.0))
+# Lists of at least this many events are written to the data and nok_data tables with COPY, instead of
+# with multi-row inserts. Set to 0 to always use COPY.
+PG_COPY_MIN_EVENTS = int(os.environ.get('PG_COPY_MIN_EVENTS', 100))
+# Maximum number of events written with a single COPY statement.
+PG_COPY_BATCH_SIZE = int(os.environ.get('PG_COPY_BATCH_SIZE', 5000))
+# Whether the data and nok_data tables are partitioned by day, see create_tables_partitioned.sql and
+# `objectiv-db-init --partitioned`. The finalize worker creates the partitions for the coming
+# PG_PARTITION_DAYS_AHEAD days, every PG_PARTITION_MAINTENANCE_SECONDS. If PG_PARTITION_RETENTION_DAYS is set,
+# partitions with older events are dropped, or detached if PG_PARTITION_RETENTION_ACTION is 'detach'.
+PG_DATA_PARTITIONED = os.environ.get('PG_DATA_PARTITIONED', 'false') == 'true'
+PG_PARTITION_DAYS_AHEAD = int(os.environ.get('PG_PARTITION_DAYS_AHEAD', 7))
+PG_PARTITION_MAINTENANCE_SECONDS = float(os.environ.get('PG_PARTITION_MAINTENANCE_SECONDS', 3600))
+PG_PARTITION_RETENTION_DAYS = int(os.environ.get('PG_PARTITION_RETENTION_DAYS', 0))
+PG_PARTITION_RETENTION_ACTION = os.environ.get('PG_PARTITION_RETENTION_ACTION', 'drop')
+# Whether the finalize worker adds the events of the last PG_SESSION_LOOKBACK_DAYS days that are not in the sessions
+# table yet to it, every PG_SESSION_INTERVAL_SECONDS. Without workers, `objectiv-sessions` can be run on a schedule
+# instead. Events of the same cookie that are less than PG_SESSION_GAP_SECONDS apart are in the same session. After
+# changing the gap, the sessions table can be rebuilt with `objectiv-sessions --rebuild`.
+PG_SESSIONS_ENABLED = os.environ.get('PG_SESSIONS_ENABLED', 'false') == 'true'
+PG_SESSION_GAP_SECONDS = float(os.environ.get('PG_SESSION_GAP_SECONDS', 1800))
+PG_SESSION_INTERVAL_SECONDS = float(os.environ.get('PG_SESSION_INTERVAL_SECONDS', 60))
+PG_SESSION_LOOKBACK_DAYS = int(os.environ.get('PG_SESSION_LOOKBACK_DAYS', 2))
+# Whether the finalize worker also adds the events that it writes to the data table to the per day rollup tables.
+# Requires the rollup tables, which `objectiv-db-init` also adds to databases that were initialized before they
+# existed. Events that were written before, or by the collector in sync mode, are counted by `objectiv-rollups`. Every
+# transaction updates one of PG_ROLLUP_SHARDS shards of the rollup rows that no other transaction is using, so
+# transactions only wait for each other if more than PG_ROLLUP_SHARDS of them update the rollups at the same time.
+PG_ROLLUPS_ENABLED = os.environ.get('PG_ROLLUPS_ENABLED', 'false') == 'true'
+PG_ROLLUP_SHARDS = int(os.environ.get('PG_ROLLUP_SHARDS', 16))
+# Number of recently inserted event_ids that every process remembers, and the time it remembers them. Events with a
+# remembered event_id are first checked with a query that doesn't block, and written to nok_data if they are
+# already in the data table. 0 to disable.
+PG_RECENT_EVENT_IDS_SIZE = int(os.environ.get('PG_RECENT_EVENT_IDS_SIZE', 100000))
+PG_RECENT_EVENT_IDS_SECONDS = float(os.environ.get('PG_RECENT_EVENT_IDS_SECONDS', 3600))
+# Number of shards of the queue tables, see `objectiv-db-init --queue-shards`. With more than 1 shard, events are put
+# in the queue tables queue_entry_<shard> and queue_finalize_<shard>, based on a hash of the event_id. Workers started
+# by the supervisor each get their own shards, other workers take events from all shards in turn. Must be the
+# same for the database, the collector and the workers.
+PG_QUEUE_SHARDS = int(os.environ.get('PG_QUEUE_SHARDS', 1))
+# Whether `objectiv-db-init` creates the queue tables as unlogged tables. Unlogged tables are faster to write to,
+# but events in the queues are lost if the database crashes.
+PG_QUEUE_UNLOGGED = os.environ.get('PG_QUEUE_UNLOGGED', 'false') == 'true'
+# Maximum time to wait for a notification of new events, if there is no work to do for the workers.
+# Only relevant in async mode
 WORKER_SLEEP_SECONDS = 5
 
 
@@ -81,6 +202,7 @@ class AwsOutputConfig(NamedTuple):
     region: str
     bucket: str
     s3_prefix: str
+    endpoint_url: Optional[str] = None
 
 
 class FileSystemOutputConfig(NamedTuple):
@@ -93,6 +215,8 @@ class PostgresConfig(NamedTuple):
     database_name: str
     user: str
     password: str
+    pool_min_size: int
+    pool_max_size: int
 
 
 class SnowplowConfig(NamedTuple):
@@ -141,13 +265,16 @@ class CollectorConfig(NamedTuple):
     error_reporting: bool
     output: OutputConfig
     event_schema: EventSchema
+    # event_list_schema and event_list_validator are derived from event_schema once, and must not be
+    # modified after that.
     event_list_schema: EventListSchema
+    event_list_validator: Any
 
 
 def get_config_output_aws() -> Optional[AwsOutputConfig]:
     if not _OUTPUT_ENABLE_AWS:
         return None
-    if _AWS_REGION and _AWS_ACCESS_KEY_ID and _AWS_SECRET_ACCESS_KEY and _AWS_BUCKET and _AWS_S3_PREFIX:
+    if not (_AWS_REGION and _AWS_ACCESS_KEY_ID and _AWS_SECRET_ACCESS_KEY and _AWS_BUCKET and _AWS_S3_PREFIX):
         raise ValueError(f'OUTPUT_ENABLE_AWS = true, but not all required values specified. '
                          f'Must specify AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_BUCKET, '
                          f'and AWS_S3_PREFIX')
@@ -156,7 +283,8 @@ def get_config_output_aws() -> Optional[AwsOutputConfig]:
         secret_access_key=_AWS_SECRET_ACCESS_KEY,
         region=_AWS_REGION,
         bucket=_AWS_BUCKET,
-        s3_prefix=_AWS_S3_PREFIX
+        s3_prefix=_AWS_S3_PREFIX,
+        endpoint_url=_AWS_S3_ENDPOINT_URL
     )
 
 
@@ -179,7 +307,9 @@ def get_config_postgres() -> Optional[PostgresConfig]:
         port=int(_PG_PORT),
         database_name=_PG_DATABASE_NAME,
         user=_PG_USER,
-        password=_PG_PASSWORD
+        password=_PG_PASSWORD,
+        pool_min_size=int(_PG_POOL_MIN_SIZE),
+        pool_max_size=int(_PG_POOL_MAX_SIZE)
     )
 
 
@@ -231,6 +361,13 @@ def get_config_output() -> OutputConfig:
             and not output_config.snowplow:
         raise Exception('No output configured. At least configure either Postgres, S3 or FileSystem '
                         'output.')
+    if COLLECTOR_PARQUET_ENABLED and not COLLECTOR_SEGMENTS_ENABLED:
+        raise ValueError('COLLECTOR_PARQUET_ENABLED = true, but COLLECTOR_SEGMENTS_ENABLED is not.')
+    if COLLECTOR_PARQUET_ENABLED and not output_config.aws and not output_config.file_system:
+        raise ValueError('COLLECTOR_PARQUET_ENABLED = true, but neither S3 nor FileSystem output is enabled.')
+    if COLLECTOR_PARQUET_ENABLED and _ASYNC_MODE:
+        raise ValueError('COLLECTOR_PARQUET_ENABLED = true, but ASYNC_MODE is also true. In async mode the '
+                         'collector has no accepted events to write as Parquet.')
     return output_config
 
 
@@ -247,8 +384,8 @@ def get_config_event_schema() -> EventSchema:
     return get_event_schema(SCHEMA_EXTENSION_DIRECTORY)
 
 
-def get_config_event_list_schema() -> EventListSchema:
-    return get_event_list_schema()
+def get_config_event_list_schema(event_schema: EventSchema) -> EventListSchema:
+    return get_event_list_schema(event_schema)
 
 
 def get_config_timestamp_validation() -> TimestampValidationConfig:
@@ -263,13 +400,16 @@ _CACHED_COLLECTOR_CONFIG: Optional[CollectorConfig] = None
 def init_collector_config():
     """ Load collector config into cache. """
     global _CACHED_COLLECTOR_CONFIG
+    event_schema = get_config_event_schema()
+    event_list_schema = get_config_event_list_schema(event_schema)
     _CACHED_COLLECTOR_CONFIG = CollectorConfig(
         async_mode=_ASYNC_MODE,
         cookie=get_config_cookie(),
         error_reporting=SCHEMA_VALIDATION_ERROR_REPORTING,
         output=get_config_output(),
-        event_schema=get_config_event_schema(),
-        event_list_schema=get_config_event_list_schema()
+        event_schema=event_schema,
+        event_list_schema=event_list_schema,
+        event_list_validator=get_event_list_validator(event_list_schema)
     )
 
 
@@ -1,19 +1,30 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Tuple
+
 import psycopg2
 from psycopg2 import extras
-from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, TRANSACTION_STATUS_IDLE
 
+from objectiv_backend.common import json_codec
 from objectiv_backend.common.config import PostgresConfig
 
+# Maximum time to wait for a connection to become available, if all connections of a pool are in use.
+POOL_CHECKOUT_TIMEOUT_SECONDS = 5
+
 
 def get_db_connection(pg_config: PostgresConfig):
     """
     Give a psycopg2 connection with:
      * read committed isolation level
      * 5 second lock_timeout
-     * uuids enabled.
+     * uuids enabled
+     * json values parsed with the configured json codec.
     """
     conn = psycopg2.connect(user=pg_config.user,
                             password=pg_config.password,
@@ -29,5 +40,168 @@ def get_db_connection(pg_config: PostgresConfig):
     # than 5 seconds, something is wrong.
     with conn.cursor() as cursor:
         cursor.execute("set lock_timeout='5s';")
+    # Commit directly, otherwise the setting would be undone if the first transaction of the caller is
+    # rolled back.
+    conn.commit()
     extras.register_uuid()
+    extras.register_default_json(conn, loads=json_codec.loads)
+    extras.register_default_jsonb(conn, loads=json_codec.loads)
     return conn
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections.
+
+    Connections are created with connection_factory, so session settings are applied once per connection
+    instead of once per use. Before a connection is handed out it is checked to be still usable, broken
+    connections are discarded and replaced.
+
+    Connections handed out by this pool must be given back with put_connection(), or be used through
+    connection(). They must not be shared between processes, see get_db_connection_pool().
+    """
+
+    def __init__(self,
+                 connection_factory: Callable[[], Any],
+                 min_size: int,
+                 max_size: int,
+                 timeout: float = POOL_CHECKOUT_TIMEOUT_SECONDS):
+        """
+        :param connection_factory: function that creates a new connection, e.g. get_db_connection()
+        :param min_size: number of connections that are created directly
+        :param max_size: maximum number of connections that can be in use or idle at the same time
+        :param timeout: seconds to wait for a connection, if max_size connections are in use.
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size. min_size: {min_size}, max_size: {max_size}')
+        self._connection_factory = connection_factory
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        # A slot is needed for every connection that is handed out, which bounds the total number of
+        # connections to max_size.
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle: Deque[Any] = deque()
+        self._closed = False
+        for _ in range(min_size):
+            self._idle.append(connection_factory())
+
+    def get_connection(self):
+        """
+        Get a connection from the pool. If there is no idle connection, then a new connection is created.
+
+        :raise psycopg2.OperationalError: if no connection becomes available within the timeout, or if
+            creating a new connection fails.
+        """
+        if not self._slots.acquire(timeout=self._timeout):
+            raise psycopg2.OperationalError(
+                f'No database connection available in pool after {self._timeout} seconds')
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        raise psycopg2.OperationalError('Connection pool is closed')
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    return self._connection_factory()
+                if _is_healthy(connection):
+                    return connection
+                _close_quietly(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def put_connection(self, connection, discard: bool = False):
+        """
+        Return a connection to the pool. Any open transaction is rolled back.
+        :param connection: connection that was obtained with get_connection()
+        :param discard: if True the connection is closed instead of kept for reuse.
+        """
+        try:
+            if not discard and _reset(connection):
+                with self._lock:
+                    if not self._closed:
+                        self._idle.append(connection)
+                        return
+            _close_quietly(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """
+        Context manager that gets a connection from the pool, and returns it when the context exits.
+        This doesn't do any transaction management, use `with connection:` for that.
+        """
+        connection = self.get_connection()
+        try:
+            yield connection
+        finally:
+            self.put_connection(connection)
+
+    def close(self):
+        """ Close all idle connections. Connections that are in use are closed when they are returned. """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection in idle:
+            _close_quietly(connection)
+
+
+def _is_healthy(connection) -> bool:
+    """ Check that an idle connection can still be used, by doing a round trip to the database. """
+    if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        return False
+    try:
+        # autocommit is a client-side setting: this way the check is a single round trip, and it doesn't
+        # leave a transaction open.
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('select 1')
+        connection.autocommit = False
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def _reset(connection) -> bool:
+    """ Rollback any open transaction. Returns False if the connection cannot be reused. """
+    if connection.closed:
+        return False
+    try:
+        if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except psycopg2.Error:
+        pass
+
+
+# Pools per process id and config. psycopg2 connections cannot be used in multiple processes, so a forked
+# process gets its own pools. Pools of a parent process are deliberately kept referenced in the child: if
+# they were garbage collected, the child would close the connections of the parent process.
+_CONNECTION_POOLS: Dict[Tuple[int, PostgresConfig], ConnectionPool] = {}
+_CONNECTION_POOLS_LOCK = threading.Lock()
+
+
+def get_db_connection_pool(pg_config: PostgresConfig) -> ConnectionPool:
+    """
+    Give the connection pool for the given config in the current process. The pool is created on first
+    use. All connections in the pool have the same session settings as connections created by
+    get_db_connection().
+    """
+    key = (os.getpid(), pg_config)
+    with _CONNECTION_POOLS_LOCK:
+        pool = _CONNECTION_POOLS.get(key)
+        if pool is None:
+            pool = ConnectionPool(connection_factory=lambda: get_db_connection(pg_config),
+                                  min_size=pg_config.pool_min_size,
+                                  max_size=pg_config.pool_max_size)
+            _CONNECTION_POOLS[key] = pool
+    return pool
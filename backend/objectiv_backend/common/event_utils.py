@@ -1,37 +1,45 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-from typing import Optional, List, cast
+from itertools import chain
+from typing import Optional, List, cast, Dict, Tuple
 
-from objectiv_backend.common.types import EventData, ContextData, ContextType
+from objectiv_backend.common.json_codec import dumps
+from objectiv_backend.common.types import EventData, ContextData, ContextType, EventDataList
 from objectiv_backend.schema.schema import AbstractGlobalContext
 
 
 def get_optional_context(event: EventData, context_type: ContextType) -> Optional[ContextData]:
-    """ Get the first Context of the given type, or None if there is none. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
-        return None
-    return result[0]
+    """
+    Get the first Context of the given type, or None if there is none.
+    Use a ContextIndex instead, if multiple context types are looked up in the same event.
+    """
+    for context in chain(get_global_contexts(event), get_location_stack(event)):
+        if _is_context_type(context, context_type):
+            return context
+    return None
 
 
 def get_context(event: EventData, context_type: ContextType) -> ContextData:
-    """ Get the first Context of the given type. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
+    """
+    Get the first Context of the given type.
+    Use a ContextIndex instead, if multiple context types are looked up in the same event.
+    """
+    context = get_optional_context(event=event, context_type=context_type)
+    if context is None:
         raise ValueError(f'context-type {context_type} not present in event. data: {event}')
-    return result[0]
+    return context
 
 
 def get_contexts(event: EventData, context_type: ContextType) -> List[ContextData]:
     """ Given all the Contexts of the given type."""
-    contexts = get_global_contexts(event) + get_location_stack(event)
-    result = []
-    for context in contexts:
-        _contexts_types = cast(List[ContextType], context.get("_types", []))
-        if context.get("_type") == context_type or context_type in _contexts_types:
-            result.append(context)
-    return result
+    return [context for context in chain(get_global_contexts(event), get_location_stack(event))
+            if _is_context_type(context, context_type)]
+
+
+def _is_context_type(context: ContextData, context_type: ContextType) -> bool:
+    _contexts_types = cast(List[ContextType], context.get("_types", []))
+    return context.get("_type") == context_type or context_type in _contexts_types
 
 
 def get_global_contexts(event: EventData) -> List[ContextData]:
@@ -44,8 +52,112 @@ def get_location_stack(event: EventData) -> List[ContextData]:
     return event.get("location_stack", [])
 
 
-def add_global_context_to_event(event: EventData, context: AbstractGlobalContext) -> EventData:
-    """ Add the global context to the event. Returns the modified event """
+def add_global_context_to_event(event: EventData,
+                                context: AbstractGlobalContext,
+                                context_index: Optional['ContextIndex'] = None) -> EventData:
+    """
+    Add the global context to the event. Returns the modified event
+    :param context_index: optional index of the contexts of the event, the context is added to it as well.
+    """
     event['global_contexts'].append(context)
+    if context_index is not None:
+        context_index.add_global_context(context)
     return event
 
+
+class ContextIndex:
+    """
+    Index of the contexts of a single event, by _type and by each of the hydrated _types of the contexts.
+
+    Looking up contexts in the index gives the same results as get_contexts(), get_context() and
+    get_optional_context(), but the contexts of the event are only scanned once, when the index is built.
+    Global contexts must be added to the event with add_global_context_to_event(), which updates the index.
+    If the _types of the contexts are changed (e.g. by hydrate_types_into_event()), then a new index must be
+    built.
+    """
+
+    def __init__(self, event: EventData):
+        self._event = event
+        self._global_contexts: Dict[ContextType, List[ContextData]] = {}
+        self._location_stack: Dict[ContextType, List[ContextData]] = {}
+        for context in get_global_contexts(event):
+            _add_to_index(self._global_contexts, context)
+        for context in get_location_stack(event):
+            _add_to_index(self._location_stack, context)
+
+    def add_global_context(self, context: ContextData):
+        """ Add a context to the index, that was appended to the global contexts of the event. """
+        _add_to_index(self._global_contexts, context)
+
+    def get_contexts(self, context_type: ContextType) -> List[ContextData]:
+        """ Given all the Contexts of the given type."""
+        return self._global_contexts.get(context_type, []) + self._location_stack.get(context_type, [])
+
+    def get_optional_context(self, context_type: ContextType) -> Optional[ContextData]:
+        """ Get the first Context of the given type, or None if there is none. """
+        contexts = self._global_contexts.get(context_type) or self._location_stack.get(context_type)
+        if not contexts:
+            return None
+        return contexts[0]
+
+    def get_context(self, context_type: ContextType) -> ContextData:
+        """ Get the first Context of the given type. """
+        context = self.get_optional_context(context_type)
+        if context is None:
+            raise ValueError(f'context-type {context_type} not present in event. data: {self._event}')
+        return context
+
+
+def _add_to_index(index: Dict[ContextType, List[ContextData]], context: ContextData):
+    context_types = set(cast(List[ContextType], context.get("_types", [])))
+    context_types.add(cast(ContextType, context.get("_type")))
+    for context_type in context_types:
+        index.setdefault(context_type, []).append(context)
+
+
+class EventJsonCache:
+    """
+    Cache of the json serialization of events, so that an event is serialized only once, even if it's
+    written to multiple sinks.
+
+    Serializations are looked up by the identity of the event object. The cache keeps a reference to all
+    events that it serialized, so that identities are not reused while the cache exists. Events must not
+    be modified after they have been serialized.
+
+    All serializations are identical to the output of json_codec.dumps().
+
+    A cache can be shared between threads. Threads that look up the same event at the same time might both
+    serialize it, which gives identical results.
+    """
+
+    def __init__(self):
+        self._cache: Dict[int, Tuple[EventData, List[Tuple[str, str]], str]] = {}
+
+    def _get_entry(self, event: EventData) -> Tuple[EventData, List[Tuple[str, str]], str]:
+        entry = self._cache.get(id(event))
+        if entry is None:
+            items = [(dumps(key), dumps(value)) for key, value in event.items()]
+            entry = (event, items, json_items_to_json(items))
+            self._cache[id(event)] = entry
+        return entry
+
+    def get_json(self, event: EventData) -> str:
+        """ Give the json serialization of the event. """
+        return self._get_entry(event)[2]
+
+    def get_json_items(self, event: EventData) -> List[Tuple[str, str]]:
+        """
+        Give the serialized top-level key-value pairs of the event. This allows building the json of a
+        slightly different object (e.g. with a renamed key) without serializing the values again.
+        Use json_items_to_json() to combine the pairs. The returned list must not be modified.
+        """
+        return self._get_entry(event)[1]
+
+    def get_json_list(self, events: EventDataList) -> str:
+        """ Give the json serialization of a list of events. """
+        return '[' + ','.join(self.get_json(event) for event in events) + ']'
+
+
+def json_items_to_json(items: List[Tuple[str, str]]) -> str:
+    """ Combine serialized key-value pairs into the json serialization of an object. """
+    return '{' + ','.join(f'{key}:{value}' for key, value in items) + '}'
@@ -0,0 +1,100 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+JSON parsing and serialization of events, with a configurable backend.
+
+All serializations are compact (no whitespace) and the top-level key order of objects is preserved. The
+exact output is not the same for all backends: the standard library escapes non-ascii characters, orjson
+writes them as UTF-8. Both can serialize dict subclasses (e.g. SchemaEntity and EventError) and UUIDs.
+"""
+import json
+import uuid
+from typing import Any, Union
+
+from objectiv_backend.common.config import JSON_CODEC
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+
+class JsonCodec:
+    """ JSON codec based on the json module from the standard library. """
+    name = 'json'
+
+    def dumps(self, obj: Any) -> str:
+        """ Serialize obj to a json string. """
+        return json.dumps(obj, separators=(',', ':'), default=_default)
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        """ Serialize obj to UTF-8 encoded json. """
+        return self.dumps(obj).encode('utf-8')
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """
+        Parse a json document.
+        :param data: json document, either a string or UTF-8 encoded bytes
+        :raise ValueError: if data is not valid json
+        """
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """ JSON codec based on orjson. Requires the orjson package. """
+    name = 'orjson'
+
+    def dumps(self, obj: Any) -> str:
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        # orjson.JSONDecodeError is a subclass of ValueError
+        return orjson.loads(data)
+
+
+def _default(obj: Any) -> Any:
+    """ Serialize types that the json module doesn't support natively. """
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def get_json_codec(name: str) -> JsonCodec:
+    """
+    Give the codec with the given name.
+    :param name: 'orjson', 'json', or 'auto' for orjson if it's installed, and json otherwise.
+    :raise ValueError: if the name is unknown, or if orjson is requested but not installed.
+    """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'json':
+        return JsonCodec()
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('JSON_CODEC = orjson, but orjson is not installed')
+        return OrjsonCodec()
+    raise ValueError(f'Unknown JSON_CODEC: {name}')
+
+
+_CODEC: JsonCodec = get_json_codec(JSON_CODEC)
+
+
+def dumps(obj: Any) -> str:
+    """ Serialize obj to a compact json string, with the configured codec. """
+    return _CODEC.dumps(obj)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """ Serialize obj to compact UTF-8 encoded json, with the configured codec. """
+    return _CODEC.dumps_bytes(obj)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Parse a json document, with the configured codec.
+    :raise ValueError: if data is not valid json
+    """
+    return _CODEC.loads(data)
@@ -0,0 +1,418 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Durable on-disk spool: an append-only log of records, used to hold on to data while an output is not
+available, until it can be replayed.
+
+Records are appended to segment files. A segment file consists of records, each a header with the length
+and crc32 of the payload, followed by the payload. If a segment grows beyond the maximum size, a new
+segment is started. Appended records are fsynced before append() returns; appends that happen at the same
+time share a single fsync.
+
+The read position, i.e. the segment and offset up to which records have been replayed, is kept in a small
+memory-mapped index file, so advancing it doesn't need any system calls besides an msync. Segments that
+have been read completely are deleted.
+
+Records that can never be replayed, e.g. because the database rejects their data, are moved to a dead letter
+file, so that they don't hold up the records after them. It has the same format as the segments, and is kept
+until it is removed by hand.
+"""
+import fcntl
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+# Record header: payload length and crc32 of the payload
+_RECORD_HEADER = struct.Struct('<II')
+# Index file: magic, and the segment number and offset of the read position.
+_INDEX = struct.Struct('<8sQQ')
+_INDEX_MAGIC = b'OBJSPOOL'
+_INDEX_FILE_NAME = 'index'
+_LOCK_FILE_NAME = 'lock'
+_DEAD_LETTER_FILE_NAME = 'dead-letter.log'
+_SEGMENT_FILE_RE = re.compile(r'^segment-(\d{20})\.log$')
+
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class SpoolPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+class SpoolLockedError(Exception):
+    """ The spool directory is in use by another process. """
+    pass
+
+
+class Spool:
+    """
+    Append-only on-disk log of records, see the module documentation.
+
+    The spool can be used by multiple threads, but a spool directory can only be used by a single process
+    at a time.
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES):
+        """
+        Open the spool in directory, or create a new spool if directory doesn't contain one.
+        If the last record of the spool was not written completely, e.g. because of a crash, that record
+        is discarded.
+        :param directory: directory to store the spool in. Created if it doesn't exist.
+        :param segment_max_bytes: size after which a new segment is started
+        :raise SpoolLockedError: if another process uses the spool
+        """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(directory, _LOCK_FILE_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise SpoolLockedError(f'Spool directory is in use: {directory}')
+
+        # _write_lock protects the write position and the open segment. _sync_lock serializes fsyncs. If
+        # both are needed, _sync_lock is acquired first.
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._records_appended = 0
+        self._records_synced = 0
+        # file descriptors of segments that were completed, but not yet synced and closed
+        self._retired_fds: List[int] = []
+        self._records_available = threading.Event()
+
+        self._index_fd, self._index = self._open_index()
+        segments = self._list_segments()
+        read_position = self._read_index()
+        if not segments:
+            segments = [read_position.segment]
+        write_segment = segments[-1]
+        write_offset = _find_end_of_records(self._segment_path(write_segment))
+        self._write_position = SpoolPosition(segment=write_segment, offset=write_offset)
+        # Position up to which records are durable. Only durable records are read, so that the read position
+        # never gets ahead of the records that survive a crash.
+        self._synced_position = self._write_position
+        self._segment_fd = os.open(self._segment_path(write_segment), os.O_WRONLY | os.O_CREAT, 0o644)
+        # discard any incomplete record at the end
+        os.ftruncate(self._segment_fd, write_offset)
+        os.lseek(self._segment_fd, write_offset, os.SEEK_SET)
+        if read_position.segment < segments[0]:
+            read_position = SpoolPosition(segment=segments[0], offset=0)
+        self._read_position = min(read_position, self._write_position)
+        if self.has_pending():
+            self._records_available.set()
+
+    def append(self, payload: bytes):
+        """
+        Append a record to the spool. When this returns, the record is stored durably.
+        """
+        record = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._write_lock:
+            if self._write_position.offset > 0 and \
+                    self._write_position.offset + len(record) > self.segment_max_bytes:
+                self._start_new_segment()
+            _write_all(self._segment_fd, record)
+            self._write_position = SpoolPosition(segment=self._write_position.segment,
+                                                 offset=self._write_position.offset + len(record))
+            self._records_appended += 1
+            record_number = self._records_appended
+        self._sync(record_number)
+        self._records_available.set()
+
+    def has_pending(self) -> bool:
+        """ Whether there are records that have not been read and committed yet. """
+        with self._write_lock:
+            return self._read_position < self._synced_position
+
+    def wait_for_records(self, timeout: float) -> bool:
+        """
+        Wait until there are pending records, at most timeout seconds.
+        :return: whether there are pending records
+        """
+        self._records_available.wait(timeout=timeout)
+        return self.has_pending()
+
+    def wake_up(self):
+        """ Let all calls to wait_for_records() return directly. """
+        self._records_available.set()
+
+    def read(self, max_records: int) -> Tuple[List[bytes], SpoolPosition]:
+        """
+        Read pending records, starting at the read position. This doesn't change the read position, use
+        commit() for that, after the records have been processed.
+        :param max_records: maximum number of records to return
+        :return: tuple: the records, and the position after the last record. Pass that position to
+            commit() to mark the records as done.
+        """
+        with self._write_lock:
+            end_position = self._synced_position
+        position = self._read_position
+        records: List[bytes] = []
+        while len(records) < max_records and position < end_position:
+            end = end_position.offset if position.segment == end_position.segment else None
+            for payload, offset in _read_segment(self._segment_path(position.segment), position.offset, end):
+                records.append(payload)
+                position = SpoolPosition(segment=position.segment, offset=offset)
+                if len(records) >= max_records:
+                    break
+            else:
+                if position.segment == end_position.segment:
+                    break
+                # The segment has been read completely, continue with the next one
+                position = SpoolPosition(segment=position.segment + 1, offset=0)
+        return records, position
+
+    def commit(self, position: SpoolPosition):
+        """
+        Set the read position, and delete segments that are before that position.
+        :param position: position as returned by read()
+        """
+        self._index[:_INDEX.size] = _INDEX.pack(_INDEX_MAGIC, position.segment, position.offset)
+        self._index.flush()
+        with self._write_lock:
+            self._read_position = position
+            if not self._read_position < self._synced_position:
+                self._records_available.clear()
+        for segment in self._list_segments():
+            if segment < position.segment:
+                os.unlink(self._segment_path(segment))
+
+    def reject(self, payload: bytes):
+        """
+        Append a record that can't be replayed to the dead letter file. When this returns, the record is
+        stored durably. This doesn't change the read position, commit() the position after the record as usual.
+        """
+        fd = os.open(self._dead_letter_path(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            _write_all(fd, _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rejected_records(self) -> List[bytes]:
+        """ Give the records in the dead letter file. """
+        return [payload for payload, _ in _read_segment(self._dead_letter_path(), 0, None)]
+
+    def close(self):
+        """ Close the spool. All appended records are already durable. """
+        with self._sync_lock:
+            with self._write_lock:
+                for fd in self._retired_fds + [self._segment_fd]:
+                    os.close(fd)
+                self._retired_fds = []
+        self._index.close()
+        os.close(self._index_fd)
+        os.close(self._lock_fd)
+
+    def _sync(self, record_number: int):
+        """ Make sure that all records up to and including record_number are durable. """
+        with self._sync_lock:
+            if self._records_synced >= record_number:
+                # Another thread synced while we were waiting for the lock
+                return
+            with self._write_lock:
+                target = self._records_appended
+                target_position = self._write_position
+                fds = self._retired_fds + [self._segment_fd]
+                self._retired_fds = []
+            for fd in fds:
+                os.fsync(fd)
+            for fd in fds[:-1]:
+                os.close(fd)
+            with self._write_lock:
+                self._records_synced = target
+                self._synced_position = target_position
+
+    def _start_new_segment(self):
+        """ Start a new segment. Must be called with _write_lock held. """
+        # The old segment is synced and closed by the next _sync(), so we don't wait for that here
+        self._retired_fds.append(self._segment_fd)
+        segment = self._write_position.segment + 1
+        self._segment_fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._write_position = SpoolPosition(segment=segment, offset=0)
+        _fsync_directory(self.directory)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'segment-{segment:020d}.log')
+
+    def _dead_letter_path(self) -> str:
+        return os.path.join(self.directory, _DEAD_LETTER_FILE_NAME)
+
+    def _list_segments(self) -> List[int]:
+        segments = []
+        for file_name in os.listdir(self.directory):
+            match = _SEGMENT_FILE_RE.match(file_name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _open_index(self) -> Tuple[int, mmap.mmap]:
+        path = os.path.join(self.directory, _INDEX_FILE_NAME)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < _INDEX.size:
+            os.ftruncate(fd, 0)
+            _write_all(fd, _INDEX.pack(_INDEX_MAGIC, 0, 0))
+            os.fsync(fd)
+        return fd, mmap.mmap(fd, _INDEX.size)
+
+    def _read_index(self) -> SpoolPosition:
+        magic, segment, offset = _INDEX.unpack(self._index[:_INDEX.size])
+        if magic != _INDEX_MAGIC:
+            raise ValueError(f'Not a valid spool index in {self.directory}')
+        return SpoolPosition(segment=segment, offset=offset)
+
+
+def _read_segment(path: str, start: int, end: Optional[int]) -> Iterator[Tuple[bytes, int]]:
+    """
+    Read the records of a segment file, from offset start up to offset end.
+    :param end: offset to read up to, or None to read up to the last complete record
+    :return: iterator of tuples: payload, and the offset after the record
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        if end is None or end > size:
+            end = size
+        if start >= end:
+            return
+        with mmap.mmap(segment_file.fileno(), length=end, access=mmap.ACCESS_READ) as data:
+            offset = start
+            while offset + _RECORD_HEADER.size <= end:
+                length, crc = _RECORD_HEADER.unpack_from(data, offset)
+                payload_end = offset + _RECORD_HEADER.size + length
+                if payload_end > end:
+                    return
+                payload = data[offset + _RECORD_HEADER.size:payload_end]
+                if zlib.crc32(payload) != crc:
+                    return
+                offset = payload_end
+                yield payload, offset
+
+
+def _find_end_of_records(path: str) -> int:
+    """ Give the offset after the last complete and valid record of a segment file. """
+    end = 0
+    for _, offset in _read_segment(path, 0, None):
+        end = offset
+    return end
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _fsync_directory(directory: str):
+    """ Make the creation of new files in directory durable. """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_spool_slot(directory: str, segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES) -> Spool:
+    """
+    Open the first spool in directory that is not in use by another process. Spools are stored in
+    numbered subdirectories of directory. This way every process of the collector gets its own spool,
+    and a restarted process picks up the spool of a process that stopped.
+    """
+    slot = 0
+    while True:
+        try:
+            return Spool(os.path.join(directory, f'{slot}'), segment_max_bytes=segment_max_bytes)
+        except SpoolLockedError:
+            slot += 1
+
+
+class SpoolDrainer:
+    """
+    Background thread that replays the records of a spool, in batches.
+
+    If replaying fails, the batch is retried after retry_seconds. If it fails with a permanent error, i.e. one
+    that retrying won't fix, the batch is split in halves that are replayed separately, until the records that
+    fail are found. Those are moved to the dead letter file of the spool, and the other records are replayed.
+
+    Records are replayed at least once: after a crash, the last batch might be replayed again. So might the
+    records of a batch that was split, if replaying fails with an error that isn't permanent.
+    """
+
+    def __init__(self,
+                 spool: Spool,
+                 replay: Callable[[List[bytes]], None],
+                 batch_size: int = 100,
+                 retry_seconds: float = 5.0,
+                 is_permanent_error: Optional[Callable[[Exception], bool]] = None):
+        """
+        :param spool: spool to drain
+        :param replay: function that processes a list of records. It should raise an exception if the records
+            could not be processed.
+        :param batch_size: maximum number of records passed to replay at once
+        :param retry_seconds: time to wait before retrying after replay raised an exception
+        :param is_permanent_error: function that tells whether an exception of replay is permanent. Defaults to
+            none being permanent, so that records are retried until they're replayed.
+        """
+        self.spool = spool
+        self.replay = replay
+        self.batch_size = batch_size
+        self.retry_seconds = retry_seconds
+        self.is_permanent_error = is_permanent_error
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='spool-drainer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """ Stop the thread, after the current batch is done. """
+        self._stop.set()
+        self.spool.wake_up()
+        self._thread.join(timeout=timeout)
+
+    def drain_once(self) -> int:
+        """
+        Replay a single batch of records.
+        :return: the number of records that were replayed, or moved to the dead letter file
+        :raise Exception: if replay raised an exception that isn't permanent. The records are not committed in
+            that case.
+        """
+        records, position = self.spool.read(max_records=self.batch_size)
+        if records:
+            self._replay(records)
+        self.spool.commit(position)
+        return len(records)
+
+    def _replay(self, records: List[bytes]):
+        """ Replay records, splitting them up if that fails with a permanent error, see the class documentation. """
+        try:
+            self.replay(records)
+        except Exception as exc:
+            if self.is_permanent_error is None or not self.is_permanent_error(exc):
+                raise
+            if len(records) == 1:
+                print(f'Cannot replay record from spool {self.spool.directory}, '
+                      f'moved it to the dead letter file: {exc!r}')  # todo: real error logging
+                self.spool.reject(records[0])
+                return
+            middle = len(records) // 2
+            self._replay(records[:middle])
+            self._replay(records[middle:])
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.spool.wait_for_records(timeout=self.retry_seconds):
+                continue
+            try:
+                count = self.drain_once()
+                print(f'Replayed {count} records from spool {self.spool.directory}')
+            except Exception as exc:
+                print(f'Error replaying spool {self.spool.directory}: {exc!r}')  # todo: real error logging
+                self._stop.wait(self.retry_seconds)
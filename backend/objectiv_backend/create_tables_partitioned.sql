@@ -0,0 +1,50 @@
+-- Partitioned layout of the data and nok_data tables, used by `objectiv-db-init --partitioned`. Each section
+-- below replaces the section with the same name in create_tables.sql. Requires PG_DATA_PARTITIONED=true for
+-- the collector and workers.
+--
+-- Both tables are partitioned by range on day, with a partition per day, named e.g. data_p20210827. Events
+-- for days without a partition end up in the default partitions. The finalize worker creates partitions
+-- ahead of time, and drops or detaches old partitions, see objectiv_backend/workers/pg_partitions.py.
+--
+-- A primary key on a partitioned table must include the partition key, so it can't guarantee that an
+-- event_id occurs only once in data. That's why the event_ids of data are also stored in data_event_id,
+-- which is not partitioned and has event_id as primary key. Events are only inserted into data if their
+-- event_id could be inserted into data_event_id.
+-- begin data tables
+create table data_event_id (
+    event_id uuid not null,
+    day date not null,
+    primary key(event_id)
+);
+
+-- used to remove the event_ids of old partitions
+create index on data_event_id using brin(day);
+
+create table data (
+    event_id uuid not null,
+    day date not null,
+    moment timestamp not null,
+    cookie_id uuid not null,
+    value json not null,
+    primary key(event_id, day)
+) partition by range (day);
+
+create table data_default partition of data default;
+
+create type failure_reason as enum('failed validation', 'duplicate');
+
+create table nok_data (
+    event_id uuid not null,
+    day date not null,
+    moment timestamp not null,
+    cookie_id uuid not null,
+    value json not null,
+    reason failure_reason default 'failed validation'
+) partition by range (day);
+
+create table nok_data_default partition of nok_data default;
+-- end data tables
+
+-- begin data grants
+grant select, insert on data_event_id to obj_collector_role, obj_worker_role;
+-- end data grants
@@ -0,0 +1,115 @@
+-- Tables that were added after the first version of create_tables.sql. Every statement in this file can be run
+-- again, so `objectiv-db-init` also runs it on a database that was initialized before, to add the tables that
+-- are missing there. The new tables are empty then, see CONFIGURATION.md for filling them.
+begin;
+
+-- used to sessionize the events of a cookie
+create index if not exists data_cookie_id_moment_idx on data(cookie_id, moment);
+
+-- Session of every event in data, maintained by objectiv_backend/workers/pg_sessions.py after events are
+-- inserted into data. Events of the same cookie that are less than PG_SESSION_GAP_SECONDS apart are in the
+-- same session. The session_id is the event_id of the first event of the session.
+create table if not exists sessions (
+    event_id uuid not null,
+    cookie_id uuid not null,
+    moment timestamp not null,
+    session_id uuid not null,
+    session_hit_number bigint not null,
+    primary key(event_id)
+);
+
+-- used to find the sessions around new events of a cookie
+create index if not exists sessions_cookie_id_moment_idx on sessions(cookie_id, moment);
+create index if not exists sessions_session_id_idx on sessions(session_id);
+
+
+-- Has the same columns as the view that computed the sessions from data, which it replaces on existing
+-- databases. session_id and session_hit_number are null for events that are not sessionized yet.
+create or replace view data_with_sessions as
+select
+        s.session_id as session_id,
+        s.session_hit_number as session_hit_number,
+        d.*
+from data as d
+left join sessions as s on s.event_id = d.event_id
+order by session_id, moment
+;
+
+
+-- Per day rollups, maintained by objectiv_backend/workers/pg_rollups.py when the finalize worker inserts events
+-- into data, or recounted from data with `objectiv-rollups`.
+-- Every transaction updates a shard of the rows that no other transaction is using, so the shards have to be
+-- combined when querying, as the daily_events and daily_users views do.
+create table if not exists daily_event_counts (
+    day date not null,
+    application text not null, -- id of the ApplicationContext, or '' if there is none
+    event_type text not null,
+    shard smallint not null,
+    event_count bigint not null,
+    primary key(day, application, event_type, shard)
+);
+
+-- HyperLogLog sketches of the distinct cookie_ids. Use hll_union_agg() to combine sketches, and
+-- hll_estimate() to estimate the number of distinct cookies of a sketch.
+create table if not exists daily_cookies (
+    day date not null,
+    application text not null,
+    shard smallint not null,
+    registers smallint[] not null,
+    primary key(day, application, shard)
+);
+
+create or replace function hll_union(registers1 smallint[], registers2 smallint[]) returns smallint[]
+language sql immutable as $$
+    select case
+        when registers1 is null then registers2
+        when registers2 is null then registers1
+        else (
+            select array_agg(greatest(register1, register2) order by position)
+            from unnest(registers1, registers2) with ordinality as registers(register1, register2, position)
+        )
+    end
+$$;
+
+create or replace aggregate hll_union_agg(smallint[]) (
+    sfunc = hll_union,
+    stype = smallint[]
+);
+
+create or replace function hll_estimate(registers smallint[]) returns double precision
+language sql immutable as $$
+    select case
+        -- linear counting is more accurate for small numbers of values
+        when raw_estimate <= 2.5 * register_count and zeros > 0 then register_count * ln(register_count / zeros)
+        else raw_estimate
+    end
+    from (
+        select
+            (0.7213 / (1 + 1.079 / count(*))) * count(*) ^ 2 / sum(2 ^ (-register::double precision))
+                as raw_estimate,
+            count(*)::double precision as register_count,
+            count(*) filter (where register = 0)::double precision as zeros
+        from unnest(registers) as register
+    ) as counts
+$$;
+
+create or replace view daily_events as
+select day, application, event_type, sum(event_count) as event_count
+from daily_event_counts
+group by day, application, event_type
+;
+
+create or replace view daily_users as
+select day, application, round(hll_estimate(hll_union_agg(registers)))::bigint as user_count
+from daily_cookies
+group by day, application
+;
+
+
+grant select, insert, update on sessions to obj_collector_role, obj_worker_role;
+grant select on sessions, data_with_sessions to obj_reader_role;
+grant select, insert, update on daily_event_counts, daily_cookies to obj_collector_role, obj_worker_role;
+grant select on daily_event_counts, daily_cookies, daily_events, daily_users to obj_reader_role;
+
+
+commit;
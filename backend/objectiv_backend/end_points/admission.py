@@ -0,0 +1,70 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Admission control for the collector: a bound on the number of requests and events that are processed at
+the same time. If the outputs slow down, requests are rejected early, instead of piling up in the
+collector while waiting for the outputs.
+"""
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class InFlightBudget:
+    """
+    Counts the requests and events that are being processed, and refuses new work if that would exceed the
+    maximums. The budget can be shared between threads.
+    """
+
+    def __init__(self, max_requests: int, max_events: int):
+        """
+        :param max_requests: maximum number of requests in flight, 0 for no maximum
+        :param max_events: maximum number of events in flight, 0 for no maximum. If no events are in flight,
+            a request is always admitted, even if it has more events than the maximum.
+        """
+        self.max_requests = max_requests
+        self.max_events = max_events
+        self._requests = 0
+        self._events = 0
+        self._lock = threading.Lock()
+
+    @property
+    def requests(self) -> int:
+        return self._requests
+
+    @property
+    def events(self) -> int:
+        return self._events
+
+    def try_acquire(self, requests: int = 0, events: int = 0) -> bool:
+        """
+        Add the requests and events to the budget, if they fit.
+        :return: True if added, False if the budget is exhausted.
+        """
+        with self._lock:
+            if self.max_requests and requests and self._requests + requests > self.max_requests:
+                return False
+            if self.max_events and events and self._events and self._events + events > self.max_events:
+                return False
+            self._requests += requests
+            self._events += events
+            return True
+
+    def release(self, requests: int = 0, events: int = 0):
+        """ Remove requests and events, that were added with try_acquire(), from the budget. """
+        with self._lock:
+            self._requests -= requests
+            self._events -= events
+
+    @contextmanager
+    def admit(self, requests: int = 0, events: int = 0) -> Iterator[bool]:
+        """
+        Context manager that acquires the requests and events, and releases them on exit if acquired.
+        Yields whether they were acquired.
+        """
+        admitted = self.try_acquire(requests=requests, events=events)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release(requests=requests, events=events)
@@ -1,27 +1,29 @@
-import json
+import asyncio
 import urllib.parse
+from concurrent.futures import Executor
 from datetime import datetime
+from functools import partial
 
 import flask
 import time
 from urllib.parse import urlparse, parse_qs
-from typing import List
+from typing import Callable, List, Optional
 
-import psycopg2
 from flask import Response, Request
 
-from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.config import get_collector_config, COLLECTOR_MAX_IN_FLIGHT_REQUESTS, \
+    COLLECTOR_MAX_IN_FLIGHT_EVENTS, COLLECTOR_RETRY_AFTER_SECONDS, COLLECTOR_SEGMENTS_ENABLED
 from objectiv_backend.common.types import EventData, EventDataList, EventList
-from objectiv_backend.common.db import get_db_connection
-from objectiv_backend.common.event_utils import add_global_context_to_event, get_contexts
+from objectiv_backend.common.event_utils import add_global_context_to_event, EventJsonCache, ContextIndex
+from objectiv_backend.end_points.admission import InFlightBudget
 from objectiv_backend.end_points.common import get_json_response, get_cookie_id
 from objectiv_backend.end_points.extra_output import events_to_json, write_data_to_fs_if_configured, \
     write_data_to_s3_if_configured, write_data_to_snowplow_if_configured
+from objectiv_backend.end_points.postgres_output import write_events_to_postgres
+from objectiv_backend.end_points.segment_output import write_events_to_segments
 from objectiv_backend.schema.validate_events import validate_structure_event_list, EventError
-from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
-from objectiv_backend.workers.pg_storage import insert_events_into_nok_data
 from objectiv_backend.workers.worker_entry import process_events_entry
-from objectiv_backend.workers.worker_finalize import insert_events_into_data
 
 from objectiv_backend.schema.schema import HttpContext, CookieIdContext, MarketingContext
 
@@ -29,34 +31,137 @@ from objectiv_backend.schema.schema import HttpContext, CookieIdContext, Marketi
 DATA_MAX_SIZE_BYTES = 1_000_000
 DATA_MAX_EVENT_COUNT = 1_000
 
+# Requests and events that are being processed by this process
+IN_FLIGHT_BUDGET = InFlightBudget(max_requests=COLLECTOR_MAX_IN_FLIGHT_REQUESTS,
+                                  max_events=COLLECTOR_MAX_IN_FLIGHT_EVENTS)
+
 
 def collect() -> Response:
     """
     Endpoint that accepts event data from the tracker and stores it for further processing.
+
+    If too many requests or events are in flight already, the request is rejected with status 429. If the
+    events cannot be written to the outputs, status 503 is returned. In both cases the Retry-After header is
+    set, and the tracker will try again later.
     """
     current_millis = round(time.time() * 1000)
-    try:
-        event_data: EventList = _get_event_data(flask.request)
-        events: EventDataList = event_data['events']
-        transport_time: int = event_data['transport_time']
-    except ValueError as exc:
-        print(f'Data problem: {exc}')  # todo: real error logging
-        return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__())
-
-    # Do all the enrichment steps that can only be done in this phase
-    add_enriched_contexts(events)
-
+    with IN_FLIGHT_BUDGET.admit(requests=1) as admitted:
+        if not admitted:
+            return _get_rejected_response(status=429, data_error='Too many requests in flight')
+        try:
+            event_data: EventList = _get_event_data(flask.request)
+            events: EventDataList = event_data['events']
+            transport_time: int = event_data['transport_time']
+        except ValueError as exc:
+            print(f'Data problem: {exc}')  # todo: real error logging
+            return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__())
+
+        with IN_FLIGHT_BUDGET.admit(events=len(events)) as admitted:
+            if not admitted:
+                return _get_rejected_response(status=429, data_error='Too many events in flight',
+                                              event_count=len(events))
+
+            _enrich_events(events=events, request=flask.request, current_millis=current_millis,
+                           transport_time=transport_time)
+
+            if not get_collector_config().async_mode:
+                ok_events, nok_events, event_errors = process_events_entry(events=events,
+                                                                           current_millis=current_millis)
+                print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
+                # The events are not modified anymore from here on, so every event can be serialized once
+                # for all sinks.
+                json_cache = EventJsonCache()
+                try:
+                    write_sync_events(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors,
+                                      json_cache=json_cache)
+                except Exception as exc:
+                    return _get_write_error_response(exc, event_count=len(events))
+                return _get_collector_response(error_count=len(nok_events), event_count=len(events),
+                                               event_errors=event_errors)
+            else:
+                # The events are not modified anymore from here on, so every event can be serialized once
+                # for all sinks.
+                json_cache = EventJsonCache()
+                try:
+                    write_async_events(events=events, json_cache=json_cache)
+                except Exception as exc:
+                    return _get_write_error_response(exc, event_count=len(events))
+                return _get_collector_response(error_count=0, event_count=len(events))
+
+
+async def collect_async(request: Request,
+                        cookie_id: Optional[str],
+                        cpu_executor: Executor,
+                        io_executor: Executor) -> Response:
+    """
+    Same as collect(), but for the ASGI application (see objectiv_backend.asgi), which is not bound to a
+    flask request context.
+
+    Parsing, enrichment and validation of the events run in cpu_executor, so the event loop stays free to
+    accept other requests. The writes to the configured sinks run concurrently in io_executor.
+    :param request: the http request
+    :param cookie_id: tracking cookie id of the request, or None if cookies are not configured
+    :param cpu_executor: bounded executor for parsing and validating events
+    :param io_executor: executor for writing to the sinks
+    """
+    current_millis = round(time.time() * 1000)
+    with IN_FLIGHT_BUDGET.admit(requests=1) as admitted:
+        if not admitted:
+            return _get_rejected_response(status=429, data_error='Too many requests in flight',
+                                          cookie_id=cookie_id)
+        loop = asyncio.get_running_loop()
+        try:
+            event_data: EventList = await loop.run_in_executor(cpu_executor, _get_event_data, request)
+            events: EventDataList = event_data['events']
+            transport_time: int = event_data['transport_time']
+        except ValueError as exc:
+            print(f'Data problem: {exc}')  # todo: real error logging
+            return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__(),
+                                           cookie_id=cookie_id)
+
+        with IN_FLIGHT_BUDGET.admit(events=len(events)) as admitted:
+            if not admitted:
+                return _get_rejected_response(status=429, data_error='Too many events in flight',
+                                              event_count=len(events), cookie_id=cookie_id)
+
+            enrich = partial(_enrich_events, events=events, request=request, current_millis=current_millis,
+                             transport_time=transport_time, cookie_id=cookie_id)
+            json_cache = EventJsonCache()
+            if not get_collector_config().async_mode:
+                def enrich_and_process():
+                    enrich()
+                    return process_events_entry(events=events, current_millis=current_millis)
+
+                ok_events, nok_events, event_errors = \
+                    await loop.run_in_executor(cpu_executor, enrich_and_process)
+                print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
+                writers = get_sync_event_writers(ok_events=ok_events, nok_events=nok_events,
+                                                 event_errors=event_errors, json_cache=json_cache)
+                try:
+                    await run_event_writers(writers=writers, executor=io_executor)
+                except Exception as exc:
+                    return _get_write_error_response(exc, event_count=len(events), cookie_id=cookie_id)
+                return _get_collector_response(error_count=len(nok_events), event_count=len(events),
+                                               event_errors=event_errors, cookie_id=cookie_id)
+            else:
+                await loop.run_in_executor(cpu_executor, enrich)
+                writers = get_async_event_writers(events=events, json_cache=json_cache)
+                try:
+                    await run_event_writers(writers=writers, executor=io_executor)
+                except Exception as exc:
+                    return _get_write_error_response(exc, event_count=len(events), cookie_id=cookie_id)
+                return _get_collector_response(error_count=0, event_count=len(events), cookie_id=cookie_id)
+
+
+def _enrich_events(events: EventDataList,
+                   request: Request,
+                   current_millis: int,
+                   transport_time: int,
+                   cookie_id: Optional[str] = None):
+    """ Do all the enrichment steps that can only be done in the collector. """
+    add_enriched_contexts(events, request=request, cookie_id=cookie_id)
     set_time_in_events(events, current_millis, transport_time)
 
-    if not get_collector_config().async_mode:
-        ok_events, nok_events, event_errors = process_events_entry(events=events, current_millis=current_millis)
-        print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
-        write_sync_events(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors)
-        return _get_collector_response(error_count=len(nok_events), event_count=len(events), event_errors=event_errors)
-    else:
-        write_async_events(events=events)
-        return _get_collector_response(error_count=0, event_count=len(events))
-
 
 def _get_event_data(request: Request) -> EventList:
     """
@@ -78,7 +183,7 @@ def _get_event_data(request: Request) -> EventList:
     if len(post_data) > DATA_MAX_SIZE_BYTES:
         # if it's more than a megabyte, we'll refuse to process
         raise ValueError(f'Data size exceeds limit')
-    event_data: EventList = json.loads(post_data)
+    event_data: EventList = json_codec.loads(post_data)
     if not isinstance(event_data, dict):
         raise ValueError('Parsed post data is not a dict')
     if 'events' not in event_data:
@@ -94,10 +199,14 @@ def _get_event_data(request: Request) -> EventList:
     return event_data
 
 
-def _get_collector_response(
-        error_count: int, event_count: int, event_errors: List[EventError] = None, data_error: str = '') -> Response:
+def _get_collector_response(error_count: int,
+                            event_count: int,
+                            event_errors: List[EventError] = None,
+                            data_error: str = '',
+                            cookie_id: Optional[str] = None) -> Response:
     """
     Create a Response object, with a json message with event counts, and a cookie set if needed.
+    :param cookie_id: see get_json_response()
     """
 
     if not get_collector_config().error_reporting:
@@ -108,7 +217,7 @@ def _get_collector_response(
             event_errors = []
 
     status = 200 if error_count == 0 else 400
-    msg = json.dumps({
+    msg = json_codec.dumps_bytes({
         "status": f"{status}",
         "error_count": error_count,
         "event_count": event_count,
@@ -117,28 +226,67 @@ def _get_collector_response(
     })
     # we always return a HTTP 200 status code, so we can handle any errors
     # on the application layer.
-    return get_json_response(status=200, msg=msg)
+    return get_json_response(status=200, msg=msg, cookie_id=cookie_id)
 
 
-def add_enriched_contexts(events: EventDataList):
+def _get_rejected_response(status: int,
+                           data_error: str,
+                           event_count: int = -1,
+                           cookie_id: Optional[str] = None) -> Response:
+    """
+    Create a Response object for a request that is not processed, but should be retried later. The response
+    has the given HTTP status code, and a Retry-After header.
+    :param status: 429 if the collector is overloaded, 503 if the outputs are not available.
+    :param data_error: reason that the request is not processed
+    :param event_count: number of events in the request, -1 if unknown
+    :param cookie_id: see get_json_response()
+    """
+    msg = json_codec.dumps_bytes({
+        "status": f"{status}",
+        "error_count": 1,
+        "event_count": event_count,
+        "event_errors": [],
+        "data_error": data_error
+    })
+    response = get_json_response(status=status, msg=msg, cookie_id=cookie_id)
+    response.headers['Retry-After'] = str(COLLECTOR_RETRY_AFTER_SECONDS)
+    return response
+
+
+def _get_write_error_response(exc: Exception, event_count: int, cookie_id: Optional[str] = None) -> Response:
+    """
+    Create a Response object for a request of which the events could not be written to all outputs.
+    :param exc: the exception of the failed output. Errors are already printed by the writers.
+    """
+    return _get_rejected_response(status=503, data_error='Events could not be stored', event_count=event_count,
+                                  cookie_id=cookie_id)
+
+
+def add_enriched_contexts(events: EventDataList, request: Request, cookie_id: Optional[str] = None):
     """
     Enrich the list of events
+    :param request: request in which the events were received
+    :param cookie_id: see add_cookie_id_contexts()
     """
 
-    add_cookie_id_contexts(events)
+    add_cookie_id_contexts(events, cookie_id=cookie_id)
     for event in events:
-        add_http_context_to_event(event=event, request=flask.request)
-        add_marketing_context_to_event(event=event)
+        context_index = ContextIndex(event)
+        add_http_context_to_event(event=event, request=request, context_index=context_index)
+        add_marketing_context_to_event(event=event, context_index=context_index)
 
 
-def add_cookie_id_contexts(events: EventDataList):
+def add_cookie_id_contexts(events: EventDataList, cookie_id: Optional[str] = None):
     """
     Modify the given list of events: Add the CookieIdContext to each event, if cookies are enabled.
+    :param cookie_id: the tracking cookie id. If not set, get_cookie_id() is used, which requires a flask
+        request context.
     """
     cookie_config = get_collector_config().cookie
     if not cookie_config:
         return
-    cookie_id = get_cookie_id()
+    if cookie_id is None:
+        cookie_id = get_cookie_id()
     cookie_id_context = CookieIdContext(id=cookie_id, cookie_id=cookie_id)
     for event in events:
         add_global_context_to_event(event, cookie_id_context)
@@ -197,7 +345,7 @@ def _get_remote_address(request: Request) -> str:
     return 'unknown'
 
 
-def add_http_context_to_event(event: EventData, request: Request):
+def add_http_context_to_event(event: EventData, request: Request, context_index: Optional[ContextIndex] = None):
     """
         Create or enrich an HttpContext based on the data in the current request. If an HttpContext is already
         present, the remote address is added to the existing context. Otherwise, a new context is created and
@@ -205,13 +353,16 @@ def add_http_context_to_event(event: EventData, request: Request):
 
         :param event - event to add context to
         :param request - request object, used to extract extra context from.
+        :param context_index - index of the contexts of the event. If not set, an index is built.
     """
+    if context_index is None:
+        context_index = ContextIndex(event)
 
     remote_address = _get_remote_address(request)
 
     # check if there is a pre-existing http_context
     # if so, use that.
-    contexts = get_contexts(event, 'HttpContext')
+    contexts = context_index.get_contexts('HttpContext')
     if contexts:
         tracker_http_context = contexts[0]
         tracker_http_context['remote_address'] = remote_address
@@ -224,17 +375,20 @@ def add_http_context_to_event(event: EventData, request: Request):
             'user_agent': request.headers.get('User-Agent', '')
         }
 
-        add_global_context_to_event(event, HttpContext(**http_context))
+        add_global_context_to_event(event, HttpContext(**http_context), context_index=context_index)
 
 
-def add_marketing_context_to_event(event: EventData) -> None:
+def add_marketing_context_to_event(event: EventData, context_index: Optional[ContextIndex] = None) -> None:
     """
     Tries to generate MarketingContext(s) based on parameters in the query string, and add to global contexts
     in the provided event.
     :param event: EventData
+    :param context_index: index of the contexts of the event. If not set, an index is built.
     :return:
     """
-    path_contexts = get_contexts(event, 'PathContext')
+    if context_index is None:
+        context_index = ContextIndex(event)
+    path_contexts = context_index.get_contexts('PathContext')
 
     if not path_contexts:
         # without a PathContext, we have no query_string
@@ -277,7 +431,8 @@ def add_marketing_context_to_event(event: EventData) -> None:
         if len(marketing_context_fields) > 1:
             # if no fields are set (other than id), no point in trying
             try:
-                add_global_context_to_event(event, MarketingContext(**marketing_context_fields))
+                add_global_context_to_event(event, MarketingContext(**marketing_context_fields),
+                                            context_index=context_index)
             except TypeError as e:
                 # couldn't create a marketing context for this mapping, no problem, as this is not a mandatory context
                 #
@@ -286,65 +441,130 @@ def add_marketing_context_to_event(event: EventData) -> None:
                 pass
 
 
-def write_sync_events(ok_events: EventDataList, nok_events: EventDataList, event_errors: List[EventError] = None):
+EventWriter = Callable[[], None]
+
+
+def write_sync_events(ok_events: EventDataList,
+                      nok_events: EventDataList,
+                      event_errors: List[EventError] = None,
+                      json_cache: Optional[EventJsonCache] = None):
     """
     Write the events to the following sinks, if configured:
         * postgres
         * aws
         * file system
+    :param json_cache: optional cache with the json serialization of the events. All sinks share the same
+        cache, so that each event is serialized only once.
+    :raise Exception: the first exception of any of the sinks, after all sinks have been written to.
     """
+    writers = get_sync_event_writers(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors,
+                                     json_cache=json_cache)
+    _run_event_writers_in_order(writers)
+
+
+def write_async_events(events: EventDataList, json_cache: Optional[EventJsonCache] = None):
+    """
+    Write the events to the following sinks, if configured:
+        * postgres - To the entry queue
+        * aws - to the 'RAW' prefix
+        * file system - to the 'RAW' directory
+    :param json_cache: optional cache with the json serialization of the events. All sinks share the same
+        cache, so that each event is serialized only once.
+    :raise Exception: the first exception of any of the sinks, after all sinks have been written to.
+    """
+    _run_event_writers_in_order(get_async_event_writers(events=events, json_cache=json_cache))
+
+
+def get_sync_event_writers(ok_events: EventDataList,
+                           nok_events: EventDataList,
+                           event_errors: List[EventError] = None,
+                           json_cache: Optional[EventJsonCache] = None) -> List[EventWriter]:
+    """
+    Get a function per configured sink, that writes the events to that sink. See write_sync_events().
+    The functions are independent of each other, so they can be called in any order, or concurrently.
+    """
+    if json_cache is None:
+        json_cache = EventJsonCache()
     output_config = get_collector_config().output
-    # todo: add exception handling. if one output fails, continue to next if configured.
+    writers: List[EventWriter] = []
     if output_config.postgres:
-        try:
-            connection = get_db_connection(output_config.postgres)
-            try:
-                with connection:
-                    insert_events_into_data(connection, events=ok_events)
-                    insert_events_into_nok_data(connection, events=nok_events)
-            finally:
-                connection.close()
-        except psycopg2.DatabaseError as oe:
-            print(f'Error occurred in postgres: {oe}')
+        writers.append(partial(write_events_to_postgres, pg_config=output_config.postgres,
+                               data=ok_events, nok_data=nok_events, json_cache=json_cache))
 
     if output_config.snowplow:
-        write_data_to_snowplow_if_configured(events=ok_events, good=True)
-        write_data_to_snowplow_if_configured(events=nok_events, good=False, event_errors=event_errors)
+        writers.append(partial(write_data_to_snowplow_if_configured,
+                               events=ok_events, good=True, json_cache=json_cache))
+        writers.append(partial(write_data_to_snowplow_if_configured,
+                               events=nok_events, good=False, event_errors=event_errors, json_cache=json_cache))
 
-    if not output_config.file_system and not output_config.aws:
-        return
-    for prefix, events in ('OK', ok_events), ('NOK', nok_events):
-        if events:
-            data = events_to_json(events)
-            moment = datetime.utcnow()
-            write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
-            write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+    if output_config.file_system or output_config.aws:
+        for prefix, events in ('OK', ok_events), ('NOK', nok_events):
+            if events:
+                writers.append(partial(_write_events_to_files, events=events, prefix=prefix, json_cache=json_cache))
+    return writers
 
 
-def write_async_events(events: EventDataList):
+def get_async_event_writers(events: EventDataList,
+                            json_cache: Optional[EventJsonCache] = None) -> List[EventWriter]:
     """
-    Write the events to the following sinks, if configured:
-        * postgres - To the entry queue
-        * aws - to the 'RAW' prefix
-        * file system - to the 'RAW' directory
+    Get a function per configured sink, that writes the events to that sink. See write_async_events().
+    The functions are independent of each other, so they can be called in any order, or concurrently.
     """
+    if json_cache is None:
+        json_cache = EventJsonCache()
     output_config = get_collector_config().output
-    # todo: add exception handling. if one output fails, continue to next if configured.
+    writers: List[EventWriter] = []
     if output_config.postgres:
-        connection = get_db_connection(output_config.postgres)
-        try:
-            with connection:
-                pg_queue = PostgresQueues(connection=connection)
-                pg_queue.put_events(queue=ProcessingStage.ENTRY, events=events)
-        finally:
-            connection.close()
+        writers.append(partial(write_events_to_postgres, pg_config=output_config.postgres,
+                               queue_entry=events, json_cache=json_cache))
+
+    if (output_config.file_system or output_config.aws) and events:
+        writers.append(partial(_write_events_to_files, events=events, prefix='RAW', json_cache=json_cache))
+    return writers
+
 
-    if not output_config.file_system and not output_config.aws:
+def _write_events_to_files(events: EventDataList, prefix: str, json_cache: EventJsonCache):
+    """
+    Write the events as one json file to the file system and/or aws s3, if configured. Or, if
+    COLLECTOR_SEGMENTS_ENABLED, append them to a rolling segment file that is later moved to the file system
+    and/or uploaded to s3.
+    """
+    if COLLECTOR_SEGMENTS_ENABLED:
+        write_events_to_segments(events=events, prefix=prefix, json_cache=json_cache)
         return
-    prefix = 'RAW'
-    if events:
-        data = events_to_json(events)
-        moment = datetime.utcnow()
-        write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
-        write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+    data = events_to_json(events, json_cache=json_cache)
+    moment = datetime.utcnow()
+    write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
+    write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+
 
+def _run_event_writers_in_order(writers: List[EventWriter]):
+    """
+    Run all writers, also if some of them fail.
+    :raise Exception: the first exception raised by any of the writers, after all writers are done.
+    """
+    first_exception: Optional[Exception] = None
+    for writer in writers:
+        try:
+            writer()
+        except Exception as exc:
+            print(f'Error writing events: {exc!r}')  # todo: real error logging
+            if first_exception is None:
+                first_exception = exc
+    if first_exception is not None:
+        raise first_exception
+
+
+async def run_event_writers(writers: List[EventWriter], executor: Executor):
+    """
+    Run all writers concurrently in the executor, and wait until all are done.
+    :raise Exception: the first exception raised by any of the writers, after all writers are done.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, writer) for writer in writers),
+                                   return_exceptions=True)
+    exceptions = [result for result in results if isinstance(result, BaseException)]
+    for exception in exceptions:
+        print(f'Error writing events: {exception!r}')  # todo: real error logging
+    if exceptions:
+        raise exceptions[0]
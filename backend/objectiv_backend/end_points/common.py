@@ -2,22 +2,27 @@
 Copyright 2021 Objectiv B.V.
 """
 import uuid
+from typing import Optional, Union
+
 import flask
 from flask import Response
 from objectiv_backend.common.config import get_collector_config
 
 
-def get_json_response(status: int, msg: str) -> Response:
+def get_json_response(status: int, msg: Union[str, bytes], cookie_id: Optional[str] = None) -> Response:
     """
     Create a Response object, with json content, and a cookie set if needed.
     :param status: http status code
-    :param msg: valid json string
+    :param msg: valid json, either a string or UTF-8 encoded bytes
+    :param cookie_id: value of the cookie to set. If not set, get_cookie_id() is used, which requires a flask
+        request context.
     """
     response = Response(mimetype='application/json', status=status, response=msg)
 
     cookie_config = get_collector_config().cookie
     if cookie_config:
-        cookie_id = get_cookie_id()
+        if cookie_id is None:
+            cookie_id = get_cookie_id()
         response.set_cookie(key=cookie_config.name, value=f'{cookie_id}',
                             max_age=cookie_config.duration, samesite=cookie_config.samesite,
                             secure=cookie_config.secure)
@@ -43,9 +48,15 @@ def get_cookie_id() -> str:
 
     if not cookie_id:
         # There's no cookie in the request, and we have not yet generated one
-        # use uuid4 (random), so there is no predictability and bad actors cannot ruin sessions of others
-        cookie_id = str(uuid.uuid4())
+        cookie_id = generate_cookie_id()
         flask.g.G_COOKIE_ID = cookie_id
-        print(f'Generating cookie_id: {cookie_id}')
 
     return str(cookie_id)
+
+
+def generate_cookie_id() -> str:
+    """ Generate a new tracking cookie uuid. """
+    # use uuid4 (random), so there is no predictability and bad actors cannot ruin sessions of others
+    cookie_id = str(uuid.uuid4())
+    print(f'Generating cookie_id: {cookie_id}')
+    return cookie_id
@@ -5,14 +5,14 @@ Functions to write data to S3 and the local filesystem.
 
 This is experimental code, and not ready for production use.
 """
-import json
 from datetime import datetime
 from io import BytesIO
 
-from typing import List
+from typing import List, Optional
 
 
 from objectiv_backend.common.config import get_collector_config, SnowplowConfig
+from objectiv_backend.common.event_utils import EventJsonCache
 from objectiv_backend.common.types import EventDataList
 from objectiv_backend.schema.validate_events import EventError
 from objectiv_backend.snowplow.snowplow_helper import write_data_to_aws_pipeline, write_data_to_gcp_pubsub
@@ -22,13 +22,16 @@ if get_collector_config().output.aws:
     from botocore.exceptions import ClientError
 
 
-def events_to_json(events: EventDataList) -> str:
+def events_to_json(events: EventDataList, json_cache: Optional[EventJsonCache] = None) -> str:
     """
     Convert list of events to a string with on each line a json object representing a single event.
     Note that the returned string is not a json list; This format makes it suitable as raw input to AWS
     Athena.
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
     """
-    return json.dumps(events)
+    if json_cache is None:
+        json_cache = EventJsonCache()
+    return json_cache.get_json_list(events)
 
 
 def write_data_to_fs_if_configured(data: str, prefix: str, moment: datetime) -> None:
@@ -78,18 +81,22 @@ def write_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) ->
 
 def write_data_to_snowplow_if_configured(events: EventDataList,
                                          good: bool,
-                                         event_errors: List[EventError] = None) -> None:
+                                         event_errors: List[EventError] = None,
+                                         json_cache: Optional[EventJsonCache] = None) -> None:
     """
     Write data to Snowplow pipeline if either GCP or AWS for Snowplow if configures
     :param events: EventDataList
     :param prefix: should be either OK or NOK
     :param event_errors: list of errors, if any
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
     :return:
     """
     config: SnowplowConfig = get_collector_config().output.snowplow
 
     if config.aws_enabled:
-        write_data_to_aws_pipeline(events=events, config=config, good=good, event_errors=event_errors)
+        write_data_to_aws_pipeline(events=events, config=config, good=good, event_errors=event_errors,
+                                   json_cache=json_cache)
 
     if config.gcp_enabled:
-        write_data_to_gcp_pubsub(events=events, config=config, good=good, event_errors=event_errors)
+        write_data_to_gcp_pubsub(events=events, config=config, good=good, event_errors=event_errors,
+                                 json_cache=json_cache)
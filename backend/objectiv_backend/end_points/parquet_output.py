@@ -0,0 +1,116 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Parquet output: accepted events as Parquet files, partitioned by day.
+
+When a closed OK segment is published (see segment_output), its events are also written as a Parquet file
+per day, to 'parquet/day=<yyyy-mm-dd>/<segment name>.parquet' in the file system output directory and/or
+under the S3 prefix. The file names are derived from the segment name, so publishing a segment again
+overwrites the same files.
+
+The top-level fields of the events, and the commonly used global contexts, are flattened into typed
+columns. The location stack, and the other global contexts, are kept as json strings. Requires the pyarrow
+package.
+"""
+from datetime import datetime
+from typing import Any, Dict, List
+
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.config import COLLECTOR_PARQUET_COMPRESSION
+from objectiv_backend.common.types import ContextData, EventData, EventDataList
+
+try:
+    import pyarrow  # type: ignore
+    import pyarrow.parquet  # type: ignore
+except ImportError:  # pragma: no cover
+    pyarrow = None  # type: ignore
+
+PARQUET_DIRECTORY = 'parquet'
+
+# Top-level fields that are stored in their own column. Other fields are stored as json in 'properties'.
+_FLATTENED_FIELDS = ('_type', 'id', 'time', 'location_stack', 'global_contexts')
+# Global contexts that are stored in their own columns: context type -> {column name: context property}.
+# Other global contexts are stored as json in 'global_contexts'.
+_FLATTENED_CONTEXTS: Dict[str, Dict[str, str]] = {
+    'CookieIdContext': {'cookie_id': 'cookie_id'},
+    'PathContext': {'path': 'id'},
+    'ApplicationContext': {'application': 'id'},
+    'HttpContext': {'referrer': 'referrer', 'user_agent': 'user_agent', 'remote_address': 'remote_address'},
+}
+
+
+def get_parquet_schema() -> 'pyarrow.Schema':
+    """ Schema of the Parquet files. The day column is not in the files, but in their path. """
+    if pyarrow is None:
+        raise ValueError('Parquet output requires the pyarrow package')
+    fields = [
+        ('event_id', pyarrow.string()),
+        ('event_type', pyarrow.string()),
+        ('moment', pyarrow.timestamp('ms', tz='UTC')),
+    ]
+    for columns in _FLATTENED_CONTEXTS.values():
+        fields.extend((column, pyarrow.string()) for column in columns)
+    fields.extend([
+        ('location_stack', pyarrow.string()),
+        ('global_contexts', pyarrow.string()),
+        ('properties', pyarrow.string()),
+    ])
+    return pyarrow.schema(fields)
+
+
+def events_to_parquet_tables(events: EventDataList) -> Dict[str, 'pyarrow.Table']:
+    """
+    Convert events to a table per day.
+    :return: dict mapping the day (yyyy-mm-dd, in UTC) to the table with the events of that day
+    """
+    schema = get_parquet_schema()
+    columns_per_day: Dict[str, Dict[str, List[Any]]] = {}
+    for event in events:
+        day = datetime.utcfromtimestamp(event['time'] // 1000).strftime('%Y-%m-%d')
+        columns = columns_per_day.get(day)
+        if columns is None:
+            columns = {name: [] for name in schema.names}
+            columns_per_day[day] = columns
+        for name, value in _event_to_row(event).items():
+            columns[name].append(value)
+    return {day: pyarrow.Table.from_pydict(columns, schema=schema) for day, columns in columns_per_day.items()}
+
+
+def _event_to_row(event: EventData) -> Dict[str, Any]:
+    row: Dict[str, Any] = {
+        'event_id': event['id'],
+        'event_type': event['_type'],
+        'moment': event['time'],
+    }
+    other_contexts: List[ContextData] = []
+    for context in event.get('global_contexts', []):
+        columns = _FLATTENED_CONTEXTS.get(context.get('_type'))
+        # only the first context of a type is flattened
+        if columns is None or next(iter(columns)) in row:
+            other_contexts.append(context)
+            continue
+        for column, context_property in columns.items():
+            row[column] = context.get(context_property)
+    for columns in _FLATTENED_CONTEXTS.values():
+        for column in columns:
+            row.setdefault(column, None)
+    properties = {key: value for key, value in event.items() if key not in _FLATTENED_FIELDS}
+    row['location_stack'] = json_codec.dumps(event.get('location_stack', []))
+    row['global_contexts'] = json_codec.dumps(other_contexts)
+    row['properties'] = json_codec.dumps(properties) if properties else None
+    return row
+
+
+def write_parquet_file(table: 'pyarrow.Table', path: str):
+    """ Write a table, as created by events_to_parquet_tables(), to a Parquet file. """
+    pyarrow.parquet.write_table(table, path, compression=COLLECTOR_PARQUET_COMPRESSION)
+
+
+def get_parquet_file_name(segment_name: str) -> str:
+    """ Give the name of the Parquet files with the events of a segment. """
+    return f'{segment_name.split(".", 1)[0]}.parquet'
+
+
+def get_parquet_key(s3_prefix: str, day: str, file_name: str) -> str:
+    """ Give the S3 key of a Parquet file. """
+    return f'{s3_prefix}/{PARQUET_DIRECTORY}/day={day}/{file_name}'
@@ -0,0 +1,146 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Functions to write the events of the collector to postgres.
+
+If COLLECTOR_SPOOL_DIR is configured, events that cannot be written to postgres because it is not available
+are appended to an on-disk spool instead, and a background thread writes them to postgres once it is available
+again.
+"""
+import os
+import threading
+from typing import Dict, List, Optional
+
+import psycopg2
+
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.config import PostgresConfig, get_collector_config, COLLECTOR_SPOOL_DIR, \
+    COLLECTOR_SPOOL_SEGMENT_BYTES, COLLECTOR_SPOOL_BATCH_SIZE, COLLECTOR_SPOOL_RETRY_SECONDS
+from objectiv_backend.common.db import get_db_connection_pool
+from objectiv_backend.common.event_utils import EventJsonCache
+from objectiv_backend.common.spool import Spool, SpoolDrainer, open_spool_slot
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+from objectiv_backend.workers.pg_storage import insert_events_into_data, insert_events_into_nok_data
+
+# Spool per process id, as spools cannot be shared between processes.
+_SPOOLS: Dict[int, Spool] = {}
+_SPOOLS_LOCK = threading.Lock()
+
+# Errors after which writing the same events can succeed later, e.g. when postgres is down, or a connection was
+# lost or timed out. Other errors, e.g. a missing table or permission, or data that postgres rejects, would fail
+# again when the events are replayed from the spool.
+_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def write_events_to_postgres(pg_config: PostgresConfig,
+                             data: Optional[EventDataList] = None,
+                             nok_data: Optional[EventDataList] = None,
+                             queue_entry: Optional[EventDataList] = None,
+                             json_cache: Optional[EventJsonCache] = None):
+    """
+    Write events to postgres, in a single transaction.
+
+    If a spool is configured, and writing to postgres fails because it is not available, then the events are
+    appended to the spool instead. As long as the spool is not empty, events are appended to the spool
+    directly, without trying postgres first. This keeps requests from waiting on an unavailable database, and
+    keeps the events in order.
+
+    :param pg_config: postgres configuration
+    :param data: events to insert into the data table
+    :param nok_data: events to insert into the nok_data table
+    :param queue_entry: events to put on the entry queue
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
+    :raise Exception: if the events could not be written to postgres nor to the spool, or if postgres failed
+        with an error that is not a connection error.
+    """
+    data = data or []
+    nok_data = nok_data or []
+    queue_entry = queue_entry or []
+    if json_cache is None:
+        json_cache = EventJsonCache()
+    spool = get_postgres_spool()
+    if spool is not None and spool.has_pending():
+        spool.append(_make_spool_record(data, nok_data, queue_entry, json_cache))
+        return
+    try:
+        with get_db_connection_pool(pg_config).connection() as connection:
+            with connection:
+                _insert_events(connection, data, nok_data, queue_entry, json_cache)
+    except _CONNECTION_ERRORS as exc:
+        if spool is None:
+            raise
+        print(f'Error occurred in postgres, events are added to the spool: {exc!r}')
+        spool.append(_make_spool_record(data, nok_data, queue_entry, json_cache))
+
+
+def get_postgres_spool() -> Optional[Spool]:
+    """
+    Give the spool of the current process, or None if no spool is configured. The spool, and the thread
+    that writes its events to postgres, are created on first use.
+    """
+    if not COLLECTOR_SPOOL_DIR:
+        return None
+    pid = os.getpid()
+    with _SPOOLS_LOCK:
+        spool = _SPOOLS.get(pid)
+        if spool is None:
+            spool = open_spool_slot(COLLECTOR_SPOOL_DIR, segment_max_bytes=COLLECTOR_SPOOL_SEGMENT_BYTES)
+            drainer = SpoolDrainer(spool=spool,
+                                   replay=replay_spool_records,
+                                   batch_size=COLLECTOR_SPOOL_BATCH_SIZE,
+                                   retry_seconds=COLLECTOR_SPOOL_RETRY_SECONDS,
+                                   is_permanent_error=is_permanent_error)
+            drainer.start()
+            _SPOOLS[pid] = spool
+    return spool
+
+
+def is_permanent_error(exc: Exception) -> bool:
+    """ Whether replaying spool records failed with a postgres error that retrying won't fix. """
+    return isinstance(exc, psycopg2.Error) and not isinstance(exc, _CONNECTION_ERRORS)
+
+
+def replay_spool_records(records: List[bytes]):
+    """
+    Write the events of spool records to postgres, all in a single transaction.
+    :raise Exception: if postgres is not available, or if postgres output is not configured.
+    """
+    data: EventDataList = []
+    nok_data: EventDataList = []
+    queue_entry: EventDataList = []
+    for record in records:
+        spooled = json_codec.loads(record)
+        data.extend(spooled['data'])
+        nok_data.extend(spooled['nok_data'])
+        queue_entry.extend(spooled['queue_entry'])
+    pg_config = get_collector_config().output.postgres
+    if not pg_config:
+        raise ValueError('Postgres output is not configured, cannot write spooled events')
+    json_cache = EventJsonCache()
+    with get_db_connection_pool(pg_config).connection() as connection:
+        with connection:
+            _insert_events(connection, data, nok_data, queue_entry, json_cache)
+
+
+def _insert_events(connection,
+                   data: EventDataList,
+                   nok_data: EventDataList,
+                   queue_entry: EventDataList,
+                   json_cache: EventJsonCache):
+    insert_events_into_data(connection, events=data, json_cache=json_cache)
+    insert_events_into_nok_data(connection, events=nok_data, json_cache=json_cache)
+    PostgresQueues(connection=connection).put_events(
+        queue=ProcessingStage.ENTRY, events=queue_entry, json_cache=json_cache)
+
+
+def _make_spool_record(data: EventDataList,
+                       nok_data: EventDataList,
+                       queue_entry: EventDataList,
+                       json_cache: EventJsonCache) -> bytes:
+    record = (
+        f'{{"data":{json_cache.get_json_list(data)},'
+        f'"nok_data":{json_cache.get_json_list(nok_data)},'
+        f'"queue_entry":{json_cache.get_json_list(queue_entry)}}}'
+    )
+    return record.encode('utf-8')
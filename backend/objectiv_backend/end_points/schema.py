@@ -2,6 +2,7 @@
 Copyright 2021 Objectiv B.V.
 """
 import json
+from typing import Optional
 
 from flask import Response
 
@@ -10,15 +11,21 @@ from objectiv_backend.end_points.common import get_json_response
 from objectiv_backend.schema.generate_json_schema import generate_json_schema
 
 
-def schema() -> Response:
-    """ Endpoint that returns the event schema in our own notation. """
+def schema(cookie_id: Optional[str] = None) -> Response:
+    """
+    Endpoint that returns the event schema in our own notation.
+    :param cookie_id: see get_json_response()
+    """
     event_schema = get_collector_config().event_schema
     msg = str(event_schema)
-    return get_json_response(status=200, msg=msg)
+    return get_json_response(status=200, msg=msg, cookie_id=cookie_id)
 
 
-def json_schema() -> Response:
-    """ Endpoint that returns a jsonschema that describes the event schema. """
+def json_schema(cookie_id: Optional[str] = None) -> Response:
+    """
+    Endpoint that returns a jsonschema that describes the event schema.
+    :param cookie_id: see get_json_response()
+    """
     event_schema = get_collector_config().event_schema
     msg = json.dumps(generate_json_schema(event_schema), indent=4)
-    return get_json_response(status=200, msg=msg)
+    return get_json_response(status=200, msg=msg, cookie_id=cookie_id)
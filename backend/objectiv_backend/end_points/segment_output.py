@@ -0,0 +1,479 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Rolling segment files for the file system and S3 outputs.
+
+Instead of a file (or S3 object) per request, the events of all requests are appended to a segment file per
+prefix (OK, NOK or RAW), with one json event per line (NDJSON). A segment is closed when it is large or old
+enough. A background thread then publishes it: it moves the segment to the file system output and/or
+uploads it to S3, with a multipart upload if the segment is large.
+
+Segments are compressed while they are written, and flushed after every write. If a process dies, the
+segments it had open are recovered by the next process that uses the same directory: the events that were
+written completely are written to a new, closed segment, which is then published as usual.
+
+Segment names start with the UTC time at which they were created, followed by a random part, e.g.
+'20220301T101500123456Z-<uuid>.ndjson.gz'. Open segments have an extra '.open' suffix.
+"""
+import atexit
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.config import AwsOutputConfig, get_collector_config, COLLECTOR_SEGMENT_DIR, \
+    COLLECTOR_SEGMENT_COMPRESSION, COLLECTOR_SEGMENT_MAX_BYTES, COLLECTOR_SEGMENT_MAX_SECONDS, \
+    COLLECTOR_SEGMENT_UPLOAD_PART_BYTES, COLLECTOR_SEGMENT_RETRY_SECONDS, COLLECTOR_PARQUET_ENABLED
+from objectiv_backend.common.event_utils import EventJsonCache
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.end_points.parquet_output import PARQUET_DIRECTORY, events_to_parquet_tables, \
+    get_parquet_file_name, get_parquet_key, write_parquet_file
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+if get_collector_config().output.aws:
+    import boto3
+
+_OPEN_SUFFIX = '.open'
+_EXTENSIONS = {'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst', 'none': '.ndjson'}
+_SEGMENT_NAME_RE = re.compile(r'^\d{8}T\d{12}Z-[0-9a-f]{32}\.ndjson(\.gz|\.zst)?$')
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 300.0
+
+# Publish function: called with the path, prefix and name of a closed segment.
+PublishSegment = Callable[[str, str, str], None]
+
+
+class _Compressor:
+    """ Streaming compressor. Everything that is written can be decompressed after flush(). """
+
+    def __init__(self, compression: str):
+        self.compression = compression
+        if compression == 'gzip':
+            self._compressobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression requires the zstandard package')
+            self._compressobj = zstandard.ZstdCompressor().compressobj()
+        elif compression != 'none':
+            raise ValueError(f'Unknown compression: {compression}')
+
+    def compress_and_flush(self, data: bytes) -> bytes:
+        if self.compression == 'gzip':
+            return self._compressobj.compress(data) + self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+        if self.compression == 'zstd':
+            return self._compressobj.compress(data) + \
+                self._compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return data
+
+    def finish(self) -> bytes:
+        if self.compression == 'none':
+            return b''
+        return self._compressobj.flush()
+
+
+def _decompress_partial(compression: str, data: bytes) -> bytes:
+    """ Decompress data, which might be truncated. Returns all data that could be decompressed. """
+    try:
+        if compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+        if compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    except Exception as exc:
+        print(f'Error decompressing segment, it is discarded: {exc!r}')
+        return b''
+    return data
+
+
+def read_segment(path: str, name: str) -> bytes:
+    """
+    Read a closed segment, and decompress it.
+    :param path: path of the segment
+    :param name: name of the segment, which determines the compression
+    :return: the lines of the segment
+    """
+    compression = _get_compression(name)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if compression == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def _get_compression(name: str) -> str:
+    for compression, extension in _EXTENSIONS.items():
+        if name.endswith(extension):
+            return compression
+    raise ValueError(f'Not a segment name: {name}')
+
+
+class _Segment:
+    """ Open segment file. Locked while open, so other processes know it's not left behind. """
+
+    def __init__(self, directory: str, compression: str):
+        created = datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+        self.name = f'{created}-{uuid.uuid4().hex}{_EXTENSIONS[compression]}'
+        self.path = os.path.join(directory, self.name)
+        self.created = time.monotonic()
+        self.size = 0
+        self._compressor = _Compressor(compression)
+        self._file = open(self.path + _OPEN_SUFFIX, 'xb')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def write(self, data: bytes):
+        chunk = self._compressor.compress_and_flush(data)
+        self._file.write(chunk)
+        self._file.flush()
+        self.size += len(chunk)
+
+    def close(self):
+        """ Complete the file, and rename it to its final name. """
+        self._file.write(self._compressor.finish())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        # rename while still locked, so no other process considers it left behind
+        os.rename(self.path + _OPEN_SUFFIX, self.path)
+        self._file.close()
+
+
+@contextmanager
+def _claim_file(path: str) -> Iterator[Optional[BinaryIO]]:
+    """
+    Open and lock path, without waiting. Yields the file, or None if it is locked by another process, or if
+    it no longer exists at path.
+    """
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        yield None
+        return
+    with fp:
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the file might have been renamed or deleted before we got the lock
+            claimed = os.stat(path).st_ino == os.fstat(fp.fileno()).st_ino
+        except (BlockingIOError, FileNotFoundError):
+            claimed = False
+        yield fp if claimed else None
+
+
+class SegmentWriter:
+    """
+    Appends data to rolling segment files, one per prefix. See the module documentation.
+
+    A SegmentWriter can be used by multiple threads. Multiple SegmentWriters, also in different processes,
+    can share a directory.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 publish: PublishSegment,
+                 compression: str = 'gzip',
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_seconds: float = DEFAULT_MAX_SECONDS,
+                 retry_seconds: float = 5.0):
+        """
+        :param directory: directory for open segments, and segments that are not yet published. Created if it
+            doesn't exist.
+        :param publish: function that is called as publish(path, prefix, name) for every closed segment. It
+            should move the segment to its destination, or raise an exception if that failed. Afterwards the
+            file at path is deleted, if it is still there.
+        :param compression: 'gzip', 'zstd' or 'none'
+        :param max_bytes: size at which a segment is closed
+        :param max_seconds: age at which a segment is closed
+        :param retry_seconds: time to wait before trying again, if publish raised an exception
+        """
+        if compression not in _EXTENSIONS:
+            raise ValueError(f'Unknown compression: {compression}')
+        self.directory = directory
+        self.publish = publish
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.retry_seconds = retry_seconds
+        self._segments: Dict[str, _Segment] = {}
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='segment-publisher', daemon=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, prefix: str, data: bytes):
+        """
+        Append data to the open segment of prefix. A new segment is opened if there is none.
+        :param prefix: prefix, e.g. 'OK'
+        :param data: data to append, should consist of complete lines
+        """
+        with self._lock:
+            segment = self._segments.get(prefix)
+            if segment is None:
+                prefix_directory = os.path.join(self.directory, prefix)
+                os.makedirs(prefix_directory, exist_ok=True)
+                segment = _Segment(prefix_directory, self.compression)
+                self._segments[prefix] = segment
+            segment.write(data)
+            if segment.size >= self.max_bytes:
+                self._close_segment(prefix)
+                self._wake_up.set()
+
+    def roll(self, force: bool = False) -> int:
+        """
+        Close the segments that are older than max_seconds, or all segments if force is True.
+        :return: number of closed segments
+        """
+        now = time.monotonic()
+        with self._lock:
+            prefixes = [prefix for prefix, segment in self._segments.items()
+                        if force or now - segment.created >= self.max_seconds]
+            for prefix in prefixes:
+                self._close_segment(prefix)
+        return len(prefixes)
+
+    def publish_closed(self) -> int:
+        """
+        Publish all closed segments in the directory, also those of other writers.
+        :return: number of published segments
+        :raise Exception: the exception of publish, if publishing a segment failed
+        """
+        count = 0
+        for prefix, name in self._list_segments(open_segments=False):
+            path = os.path.join(self.directory, prefix, name)
+            with _claim_file(path) as fp:
+                if fp is None:
+                    continue
+                self.publish(path, prefix, name)
+                if os.path.exists(path):
+                    os.unlink(path)
+                count += 1
+        return count
+
+    def recover(self) -> int:
+        """
+        Close the open segments that were left behind by writers that stopped without closing them.
+        :return: number of recovered segments
+        """
+        count = 0
+        for prefix, name in self._list_segments(open_segments=True):
+            path = os.path.join(self.directory, prefix, name)
+            with _claim_file(path) as fp:
+                if fp is None:
+                    continue
+                compression = _get_compression(name[:-len(_OPEN_SUFFIX)])
+                data = _decompress_partial(compression, fp.read())
+                # discard the last line, if it was not written completely
+                data = data[:data.rfind(b'\n') + 1]
+                if data:
+                    segment = _Segment(os.path.join(self.directory, prefix), compression)
+                    segment.write(data)
+                    segment.close()
+                os.unlink(path)
+                count += 1
+        return count
+
+    def start(self):
+        """ Start the thread that recovers, closes and publishes segments. """
+        self._thread.start()
+
+    def close(self, timeout: Optional[float] = None):
+        """ Stop the thread, and close and publish all segments. """
+        self._stop.set()
+        self._wake_up.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+        self.roll(force=True)
+        try:
+            self.publish_closed()
+        except Exception as exc:
+            print(f'Error publishing segments, will be retried on next start: {exc!r}')
+
+    def _close_segment(self, prefix: str):
+        segment = self._segments.pop(prefix)
+        segment.close()
+
+    def _list_segments(self, open_segments: bool) -> List[Tuple[str, str]]:
+        """ Give (prefix, name) of all open or closed segments in the directory. """
+        result = []
+        for prefix_entry in os.scandir(self.directory):
+            if not prefix_entry.is_dir():
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                name = entry.name
+                if name.endswith(_OPEN_SUFFIX) != open_segments:
+                    continue
+                if _SEGMENT_NAME_RE.match(name[:-len(_OPEN_SUFFIX)] if open_segments else name):
+                    result.append((prefix_entry.name, name))
+        return sorted(result)
+
+    def _run(self):
+        try:
+            self.recover()
+        except Exception as exc:
+            print(f'Error recovering segments in {self.directory}: {exc!r}')  # todo: real error logging
+        while not self._stop.is_set():
+            self._wake_up.wait(timeout=min(1.0, self.max_seconds))
+            self._wake_up.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.roll()
+                self.publish_closed()
+            except Exception as exc:
+                print(f'Error publishing segments in {self.directory}: {exc!r}')  # todo: real error logging
+                self._stop.wait(self.retry_seconds)
+
+
+def upload_file_to_s3(client: Any, path: str, bucket: str, key: str, part_bytes: int):
+    """
+    Upload a file to S3. Files larger than part_bytes are uploaded with a multipart upload, in parts of
+    part_bytes.
+    :param client: boto3 S3 client
+    :raise Exception: if uploading failed. An unfinished multipart upload is aborted.
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size <= part_bytes:
+            client.put_object(Bucket=bucket, Key=key, Body=fp.read())
+            return
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        try:
+            parts: List[Dict[str, Any]] = []
+            while True:
+                chunk = fp.read(part_bytes)
+                if not chunk:
+                    break
+                part_number = len(parts) + 1
+                response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number, Body=chunk)
+                parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except Exception:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+
+def get_s3_key(aws_config: AwsOutputConfig, prefix: str, name: str) -> str:
+    """ Give the S3 key of a segment: the configured prefix, the date of the segment, prefix and name. """
+    return f'{aws_config.s3_prefix}/{name[0:4]}/{name[4:6]}/{name[6:8]}/{prefix}/{name}'
+
+
+def publish_segment(path: str, prefix: str, name: str):
+    """
+    Publish a closed segment to the configured outputs: upload it to S3 and/or move it to the file system
+    output directory. If COLLECTOR_PARQUET_ENABLED, the events of OK segments are published as Parquet files
+    too, see parquet_output.
+    """
+    if prefix == 'OK' and COLLECTOR_PARQUET_ENABLED:
+        _publish_segment_as_parquet(path, name)
+    aws_config = get_collector_config().output.aws
+    _publish_file(path, directory=prefix, name=name,
+                  s3_key=get_s3_key(aws_config, prefix, name) if aws_config else '')
+
+
+def _publish_segment_as_parquet(path: str, name: str):
+    events = [json_codec.loads(line) for line in read_segment(path, name).splitlines()]
+    file_name = get_parquet_file_name(name)
+    aws_config = get_collector_config().output.aws
+    for day, table in sorted(events_to_parquet_tables(events).items()):
+        parquet_path = f'{path}.{day}.parquet'
+        write_parquet_file(table, parquet_path)
+        try:
+            _publish_file(parquet_path, directory=f'{PARQUET_DIRECTORY}/day={day}', name=file_name,
+                          s3_key=get_parquet_key(aws_config.s3_prefix, day, file_name) if aws_config else '')
+        finally:
+            if os.path.exists(parquet_path):
+                os.unlink(parquet_path)
+
+
+def _publish_file(path: str, directory: str, name: str, s3_key: str):
+    """
+    Upload a file to s3_key, if S3 output is configured, and move it to directory/name in the file system
+    output directory, if file system output is configured.
+    """
+    output_config = get_collector_config().output
+    if output_config.aws:
+        aws_config = output_config.aws
+        upload_file_to_s3(_get_s3_client(aws_config), path=path, bucket=aws_config.bucket, key=s3_key,
+                          part_bytes=COLLECTOR_SEGMENT_UPLOAD_PART_BYTES)
+    if output_config.file_system:
+        output_directory = os.path.join(output_config.file_system.path, directory)
+        os.makedirs(output_directory, exist_ok=True)
+        shutil.move(path, os.path.join(output_directory, name))
+
+
+def write_events_to_segments(events: EventDataList, prefix: str, json_cache: Optional[EventJsonCache] = None):
+    """
+    Append the events to the open segment of prefix, one event per line.
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
+    """
+    if not events:
+        return
+    if json_cache is None:
+        json_cache = EventJsonCache()
+    data = ''.join(json_cache.get_json(event) + '\n' for event in events)
+    get_segment_writer().write(prefix, data.encode('utf-8'))
+
+
+# SegmentWriter per process id. The lock on open segments is not inherited by forked processes.
+_SEGMENT_WRITERS: Dict[int, SegmentWriter] = {}
+_SEGMENT_WRITERS_LOCK = threading.Lock()
+_S3_CLIENTS: Dict[int, Any] = {}
+
+
+def get_segment_writer() -> SegmentWriter:
+    """
+    Give the SegmentWriter of the current process. It is created, and its thread started, on first use. The
+    segments are closed and published when the process exits.
+    """
+    pid = os.getpid()
+    with _SEGMENT_WRITERS_LOCK:
+        writer = _SEGMENT_WRITERS.get(pid)
+        if writer is None:
+            writer = SegmentWriter(directory=_get_segment_directory(),
+                                   publish=publish_segment,
+                                   compression=COLLECTOR_SEGMENT_COMPRESSION,
+                                   max_bytes=COLLECTOR_SEGMENT_MAX_BYTES,
+                                   max_seconds=COLLECTOR_SEGMENT_MAX_SECONDS,
+                                   retry_seconds=COLLECTOR_SEGMENT_RETRY_SECONDS)
+            writer.start()
+            atexit.register(writer.close)
+            _SEGMENT_WRITERS[pid] = writer
+    return writer
+
+
+def _get_segment_directory() -> str:
+    if COLLECTOR_SEGMENT_DIR:
+        return COLLECTOR_SEGMENT_DIR
+    fs_config = get_collector_config().output.file_system
+    if fs_config:
+        return os.path.join(fs_config.path, '.segments')
+    return os.path.join(tempfile.gettempdir(), 'objectiv-segments')
+
+
+def _get_s3_client(aws_config: AwsOutputConfig) -> Any:
+    pid = os.getpid()
+    with _SEGMENT_WRITERS_LOCK:
+        client = _S3_CLIENTS.get(pid)
+        if client is None:
+            client = boto3.client(
+                service_name='s3',
+                region_name=aws_config.region,
+                endpoint_url=aws_config.endpoint_url,
+                aws_access_key_id=aws_config.access_key_id,
+                aws_secret_access_key=aws_config.secret_access_key)
+            _S3_CLIENTS[pid] = client
+    return client
@@ -7,14 +7,35 @@ import os
 import re
 import sys
 from copy import deepcopy
-from typing import Set, List, Dict, Any, Optional, Tuple
+from typing import Set, List, Dict, Any, Optional, Tuple, FrozenSet
 import pkgutil
 
+import jsonschema
+
 from objectiv_backend.common.types import EventType, ContextType, EventListSchema
+from objectiv_backend.schema.generate_validators import NativeValidator, compile_validator
 
 MAX_HIERARCHY_DEPTH = 100
 
 
+def _get_validator(json_schema: Dict[str, Any]) -> Any:
+    """
+    Give a jsonschema validator for the given json-schema.
+    The json-schema itself is checked here once, instead of on every validation as jsonschema.validate()
+    does. The returned validator can be reused for any number of validations.
+    If possible, a validation function is generated for the json-schema, and a NativeValidator is
+    returned, which gives the same results but is much faster for valid input.
+    :raise jsonschema.SchemaError: if json_schema is not a valid json-schema
+    """
+    validator_class = jsonschema.validators.validator_for(json_schema)
+    validator_class.check_schema(json_schema)
+    schema_validator = validator_class(json_schema)
+    validate = compile_validator(json_schema)
+    if validate is None:
+        return schema_validator
+    return NativeValidator(schema_validator=schema_validator, validate=validate)
+
+
 class EventSubSchema:
     """
     Immutable sub-schema containing events, their inheritance hierarchy and required contexts for events.
@@ -32,6 +53,10 @@ class EventSubSchema:
         self._compiled_list_event_types: List[EventType] = []
         self._compiled_all_parents_and_required_contexts: \
             Dict[EventType, Tuple[Set[EventType], Set[ContextType]]] = {}
+        self._compiled_sorted_parent_event_types: Dict[EventType, Tuple[EventType, ...]] = {}
+        self._compiled_frozen_required_contexts: Dict[EventType, FrozenSet[ContextType]] = {}
+        self._compiled_event_schemas: Dict[EventType, Dict[str, Any]] = {}
+        self._compiled_validators: Dict[EventType, Any] = {}
 
     def get_extended_schema(self, event_schema: Dict[str, Any]) -> 'EventSubSchema':
         """
@@ -63,8 +88,9 @@ class EventSubSchema:
 
     def _compile(self):
         """
-        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(), and
-        get_all_required_contexts.
+        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(),
+            get_sorted_parent_event_types(), get_all_required_contexts(), get_frozen_required_contexts(),
+            get_event_schema(), and get_event_validator().
         2) Makes sure the event hierarchy has no cycles
         Must be called after the schema has changed.
         """
@@ -73,6 +99,21 @@ class EventSubSchema:
         self._compiled_all_parents_and_required_contexts = {}
         for event_type in self._compiled_list_event_types:
             self._compile_parents_and_contexts(event_type)
+        self._compiled_sorted_parent_event_types = {
+            event_type: tuple(sorted(event_types))
+            for event_type, (event_types, _) in self._compiled_all_parents_and_required_contexts.items()
+        }
+        self._compiled_frozen_required_contexts = {
+            event_type: frozenset(context_types)
+            for event_type, (_, context_types) in self._compiled_all_parents_and_required_contexts.items()
+        }
+
+        self._compiled_event_schemas = {}
+        self._compiled_validators = {}
+        for event_type in self._compiled_list_event_types:
+            event_json_schema = self._build_event_schema(event_type)
+            self._compiled_event_schemas[event_type] = event_json_schema
+            self._compiled_validators[event_type] = _get_validator(event_json_schema)
 
     def _compile_parents_and_contexts(
             self,
@@ -138,6 +179,25 @@ class EventSubSchema:
             raise ValueError(f'Not a valid event_type {event_type}')
         return {ctx for ctx in self._compiled_all_parents_and_required_contexts[event_type][1]}
 
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        """
+        Same as get_all_parent_event_types(), but as an alphabetically sorted tuple. The tuple is shared
+        between calls.
+        :param event_type: event type. Must be a valid event_type
+        """
+        if not self.is_valid_event_type(event_type):
+            raise ValueError(f'Not a valid event_type {event_type}')
+        return self._compiled_sorted_parent_event_types[event_type]
+
+    def get_frozen_required_contexts(self, event_type: EventType) -> FrozenSet[ContextType]:
+        """
+        Same as get_all_required_contexts(), but as a frozenset that is shared between calls.
+        :param event_type: event type. Must be a valid event_type
+        """
+        if not self.is_valid_event_type(event_type):
+            raise ValueError(f'Not a valid event_type {event_type}')
+        return self._compiled_frozen_required_contexts[event_type]
+
     def is_valid_event_type(self, event_type: EventType) -> bool:
         return event_type in self.schema
 
@@ -145,8 +205,19 @@ class EventSubSchema:
         """
         Give the json-schema for a specific event_type, or None if the event type doesn't exist.
         """
-        if event_type not in self.schema:
+        if event_type not in self._compiled_event_schemas:
             return None
+        return deepcopy(self._compiled_event_schemas[event_type])
+
+    def get_event_validator(self, event_type: EventType) -> Optional[Any]:
+        """
+        Give the compiled jsonschema validator for a specific event_type, or None if the event type
+        doesn't exist. The validator validates against the json-schema as returned by get_event_schema().
+        """
+        return self._compiled_validators.get(event_type)
+
+    def _build_event_schema(self, event_type: EventType) -> Dict[str, Any]:
+        """ Build the json-schema for a specific event_type. event_type must exist. """
         all_classes = self.get_all_parent_event_types(event_type)
         properties = {}
         for klass in all_classes:
@@ -184,6 +255,11 @@ class ContextSubSchema:
         self._compiled_all_parents_and_required_context_types: \
             Dict[ContextType, Dict[str, Set[ContextType]]] = {}
         self._compiled_all_child_context_types = {}
+        self._compiled_sorted_parent_context_types: Dict[ContextType, Tuple[ContextType, ...]] = {}
+        self._compiled_frozen_parent_context_types: Dict[ContextType, FrozenSet[ContextType]] = {}
+        self._compiled_frozen_required_context_types: Dict[ContextType, FrozenSet[ContextType]] = {}
+        self._compiled_context_schemas: Dict[ContextType, Dict[str, Any]] = {}
+        self._compiled_validators: Dict[ContextType, Any] = {}
 
     CONTEXT_NAME_REGEX = r'^[A-Z][a-zA-Z0-9]*Context$'
 
@@ -228,7 +304,9 @@ class ContextSubSchema:
     def _compile(self):
         """
         1) Pre calculate the return values of list_context_types(), get_all_parent_context_types(),
-            and get_all_child_context_types().
+            get_sorted_parent_context_types(), get_frozen_parent_context_types(),
+            get_frozen_required_context_types(), get_all_child_context_types(), get_context_schema(), and
+            get_context_validator().
         2) Makes sure the event hierarchy has no cycles, and all parent-reference exist.
         Must be called after the schema has changed.
         """
@@ -238,6 +316,16 @@ class ContextSubSchema:
         # Calculate parent relations, and do some basic checks on graph
         for context_type in self._compiled_list_context_types:
             self._compile_parent_and_required_context_types(context_type)
+        compiled_types = self._compiled_all_parent_and_required_context_types
+        self._compiled_sorted_parent_context_types = {
+            context_type: tuple(sorted(types['parents'])) for context_type, types in compiled_types.items()
+        }
+        self._compiled_frozen_parent_context_types = {
+            context_type: frozenset(types['parents']) for context_type, types in compiled_types.items()
+        }
+        self._compiled_frozen_required_context_types = {
+            context_type: frozenset(types['requiredContexts']) for context_type, types in compiled_types.items()
+        }
 
         # Calculate child relations based on parent relations
         for context_type in self._compiled_list_context_types:
@@ -247,6 +335,13 @@ class ContextSubSchema:
                     children.add(ct)
             self._compiled_all_child_context_types[context_type] = children
 
+        self._compiled_context_schemas = {}
+        self._compiled_validators = {}
+        for context_type in self._compiled_list_context_types:
+            context_json_schema = self._build_context_schema(context_type)
+            self._compiled_context_schemas[context_type] = context_json_schema
+            self._compiled_validators[context_type] = _get_validator(context_json_schema)
+
     def _compile_parent_and_required_context_types(self, context_type: ContextType, count=MAX_HIERARCHY_DEPTH) -> \
             Tuple[Set[ContextType], Set[ContextType]]:
         """
@@ -299,6 +394,27 @@ class ContextSubSchema:
         return {c for c in
                 self._compiled_all_parent_and_required_context_types.get(context_type, {}).get('requiredContexts', {})}
 
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        """
+        Same as get_all_parent_context_types(), but as an alphabetically sorted tuple. The tuple is shared
+        between calls.
+        """
+        result = self._compiled_sorted_parent_context_types.get(context_type)
+        if result is None:
+            return (context_type, )
+        return result
+
+    def get_frozen_parent_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        """ Same as get_all_parent_context_types(), but as a frozenset that is shared between calls. """
+        result = self._compiled_frozen_parent_context_types.get(context_type)
+        if result is None:
+            return frozenset((context_type, ))
+        return result
+
+    def get_frozen_required_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        """ Same as get_all_required_context_types(), but as a frozenset that is shared between calls. """
+        return self._compiled_frozen_required_context_types.get(context_type, frozenset())
+
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         """
         Given a context_type, give a set with that context_type and all its child context_types
@@ -309,8 +425,19 @@ class ContextSubSchema:
         """
         Give the json-schema for a specific context_type, or None if the context type doesn't exist.
         """
-        if context_type not in self.schema:
+        if context_type not in self._compiled_context_schemas:
             return None
+        return deepcopy(self._compiled_context_schemas[context_type])
+
+    def get_context_validator(self, context_type: ContextType) -> Optional[Any]:
+        """
+        Give the compiled jsonschema validator for a specific context_type, or None if the context type
+        doesn't exist. The validator validates against the json-schema as returned by get_context_schema().
+        """
+        return self._compiled_validators.get(context_type)
+
+    def _build_context_schema(self, context_type: ContextType) -> Dict[str, Any]:
+        """ Build the json-schema for a specific context_type. context_type must exist. """
         all_classes = self.get_all_parent_context_types(context_type)
         properties = {}
         for klass in all_classes:
@@ -362,8 +489,10 @@ class EventSchema:
             * adding properties to an existing context
             * adding sub-properties to an existing context (e.g. a "minimum" field for an integer)
         """
-        events = deepcopy(self.events)
-        contexts = deepcopy(self.contexts)
+        # The sub-schemas' get_extended_schema() leave the originals unmodified, so there is no need to copy
+        # them (including their compiled validators) here.
+        events = self.events
+        contexts = self.contexts
         version = deepcopy(self.version)
 
         events = events.get_extended_schema(schema['events'])
@@ -421,12 +550,21 @@ class EventSchema:
         """
         return self.events.get_all_parent_event_types(event_type=event_type)
 
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        return self.events.get_sorted_parent_event_types(event_type=event_type)
+
     def get_all_required_contexts_for_event(self, event_type: EventType) -> Set[ContextType]:
         return self.events.get_all_required_contexts(event_type=event_type)
 
+    def get_frozen_required_contexts_for_event(self, event_type: EventType) -> FrozenSet[ContextType]:
+        return self.events.get_frozen_required_contexts(event_type=event_type)
+
     def get_all_required_contexts_for_context(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_required_context_types(context_type=context_type)
 
+    def get_frozen_required_contexts_for_context(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        return self.contexts.get_frozen_required_context_types(context_type=context_type)
+
     def is_valid_event_type(self, event_type: EventType) -> bool:
         return self.events.is_valid_event_type(event_type=event_type)
 
@@ -436,6 +574,12 @@ class EventSchema:
     def get_all_parent_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_parent_context_types(context_type=context_type)
 
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        return self.contexts.get_sorted_parent_context_types(context_type=context_type)
+
+    def get_frozen_parent_context_types(self, context_type: ContextType) -> FrozenSet[ContextType]:
+        return self.contexts.get_frozen_parent_context_types(context_type=context_type)
+
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_child_context_types(context_type=context_type)
 
@@ -445,12 +589,59 @@ class EventSchema:
     def get_event_schema(self, event_type: EventType) -> Optional[Dict[str, Any]]:
         return self.events.get_event_schema(event_type=event_type)
 
+    def get_context_validator(self, context_type: ContextType) -> Optional[Any]:
+        return self.contexts.get_context_validator(context_type=context_type)
+
+    def get_event_validator(self, event_type: EventType) -> Optional[Any]:
+        return self.events.get_event_validator(event_type=event_type)
+
 
-def get_event_list_schema() -> EventListSchema:
+def get_event_list_schema(event_schema: EventSchema) -> EventListSchema:
+    """
+    Give a json-schema to validate the overall structure of a list of events, as sent by the tracker.
+
+    The schema is based on schema/event_list.json5, with the AbstractEvent type of the events replaced by
+    the properties of AbstractEvent in event_schema. The returned schema is newly created, event_schema
+    is not modified.
+    :param event_schema: schema from which AbstractEvent is taken.
+    """
     data = pkgutil.get_data(__name__, "event_list.json5")
-    schema_json = json5.loads(data)
+    event_list_schema = json5.loads(data)
+
+    # we use AbstractEvent as the blueprint for what an event should look like
+    abstract_event = event_schema.events.schema['AbstractEvent']
+
+    # # list of properties for an event (can be nested)
+    items: Dict[str, dict] = {}
+    for property_name, property_desc in abstract_event['properties'].items():
+        property_desc = deepcopy(property_desc)
+        if 'items' in property_desc and re.match('^Abstract.*?Context$', property_desc['items']['type']):
+            # we don't want to go into the validation / schema of contexts here
+            # so a simple object will suffice
+            property_desc['items']['type'] = 'object'
+        items[property_name] = property_desc
+
+    # we want a schema for a list of events (the base_schema only specifies a single event)
+    # the schema wants a list of abstract events. As that is not a valid JSON type,
+    # we replace that type with the more generic 'object' type, and the actual definition of
+    # an abstract event
+    if 'events' in event_list_schema['properties'] and \
+            'items' in event_list_schema['properties']['events'] and \
+            'type' in event_list_schema['properties']['events']['items'] and \
+            event_list_schema['properties']['events']['items']['type'] == 'AbstractEvent':
+        event_list_schema['properties']['events']['items'] = {
+            'type': 'object',
+            'items': items
+        }
+    return event_list_schema
 
-    return schema_json
+
+def get_event_list_validator(event_list_schema: EventListSchema) -> Any:
+    """
+    Give a compiled jsonschema validator for the given event list schema, as returned by
+    get_event_list_schema().
+    """
+    return _get_validator(event_list_schema)
 
 
 def get_event_schema(schema_extensions_directory: Optional[str]) -> EventSchema:
@@ -0,0 +1,272 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Generate Python validation functions from the json-schemas of the event and context types.
+
+jsonschema validation is generic, and therefore slow. For every json-schema that only uses a supported
+subset of json-schema (type, required, properties, items, pattern, enum, and numeric and length bounds),
+we generate a function that does the same checks directly on the dicts and lists.
+
+A generated function returns True if the instance is valid. If it returns False, then the instance might
+be invalid, and the jsonschema validator is used to find the actual error, so that errors are exactly the
+same as without generated functions. The generated functions are conservative: for input that jsonschema
+might accept, but that is uncommon (e.g. 1.0 for an integer), they also return False.
+
+The functions are compiled when the schema is loaded, see event_schemas._get_validator(). main() prints
+the source code of all functions, for inspection.
+"""
+import argparse
+import re
+import sys
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import jsonschema
+
+# Keywords that we generate code for. Keywords that jsonschema doesn't know (e.g. 'description') are
+# ignored, just like jsonschema does. If a json-schema contains any other keyword, no function is
+# generated for it.
+SUPPORTED_KEYWORDS = {
+    'type', 'required', 'properties', 'items', 'pattern', 'enum',
+    'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum', 'minLength', 'maxLength'
+}
+
+_TYPE_CHECKS = {
+    'object': 'isinstance({0}, dict)',
+    'array': 'isinstance({0}, list)',
+    'string': 'isinstance({0}, str)',
+    # jsonschema also accepts floats like 1.0 as integer, we leave those to jsonschema
+    'integer': '(isinstance({0}, int) and not isinstance({0}, bool))',
+    'number': '(isinstance({0}, (int, float)) and not isinstance({0}, bool))',
+    'boolean': 'isinstance({0}, bool)',
+    'null': '{0} is None'
+}
+
+_NUMBER_CHECK = _TYPE_CHECKS['number']
+_BOUND_OPERATORS = {
+    'minimum': '<',
+    'maximum': '>',
+    'exclusiveMinimum': '<=',
+    'exclusiveMaximum': '>='
+}
+_LENGTH_OPERATORS = {
+    'minLength': '<',
+    'maxLength': '>'
+}
+
+
+# Marker for properties that are not present, as None is a valid property value.
+_MISSING = object()
+
+
+class UnsupportedSchemaError(ValueError):
+    """ The json-schema uses a feature for which we cannot generate a validation function. """
+    pass
+
+
+class _ValidatorGenerator:
+    """ Generates the source code of a single validation function, and the constants that it uses. """
+
+    def __init__(self, function_name: str, json_schema: Dict[str, Any]):
+        self._function_name = function_name
+        self._known_keywords = set(jsonschema.validators.validator_for(json_schema).VALIDATORS)
+        self._constants: List[str] = []
+        self._lines: List[str] = []
+        self._variable_count = 0
+        self._generate(json_schema)
+
+    def get_source(self) -> str:
+        return '\n'.join(self._constants + self._lines) + '\n'
+
+    def _generate(self, json_schema: Dict[str, Any]):
+        self._lines.append(f'def {self._function_name}(instance):')
+        self._add_checks(json_schema, variable='instance', indent=1)
+        self._lines.append('    return True')
+
+    def _new_name(self, kind: str) -> str:
+        self._variable_count += 1
+        return f'{kind}_{self._variable_count}'
+
+    def _add_constant(self, kind: str, source: str) -> str:
+        # constants are module-level, so their names must be unique over all generated functions
+        name = f'_{self._function_name}_{self._new_name(kind)}'
+        self._constants.append(f'{name} = {source}')
+        return name
+
+    def _emit(self, indent: int, line: str):
+        self._lines.append('    ' * indent + line)
+
+    def _add_checks(self, json_schema: Any, variable: str, indent: int):
+        """ Add code that returns False if the value in `variable` doesn't (certainly) match json_schema. """
+        if not isinstance(json_schema, dict):
+            raise UnsupportedSchemaError(f'Unsupported sub-schema: {json_schema!r}')
+        for keyword, value in json_schema.items():
+            if keyword not in self._known_keywords:
+                # Not a validation keyword, e.g. 'description', ignored by jsonschema too.
+                continue
+            if keyword not in SUPPORTED_KEYWORDS:
+                raise UnsupportedSchemaError(f'Unsupported keyword: {keyword}')
+            if keyword == 'type':
+                self._add_type_check(value, variable, indent)
+            elif keyword == 'required':
+                self._add_required_check(value, variable, indent)
+            elif keyword == 'properties':
+                self._add_properties_checks(value, variable, indent)
+            elif keyword == 'items':
+                self._add_items_checks(value, variable, indent)
+            elif keyword == 'pattern':
+                pattern = self._add_constant('pattern', f're.compile({value!r})')
+                self._emit(indent, f'if isinstance({variable}, str) and {pattern}.search({variable}) is None:')
+                self._emit(indent + 1, 'return False')
+            elif keyword == 'enum':
+                self._add_enum_check(value, variable, indent)
+            elif keyword in _BOUND_OPERATORS:
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    raise UnsupportedSchemaError(f'Unsupported value for {keyword}: {value!r}')
+                self._emit(indent, f'if {_NUMBER_CHECK.format(variable)} and '
+                                   f'{variable} {_BOUND_OPERATORS[keyword]} {value!r}:')
+                self._emit(indent + 1, 'return False')
+            elif keyword in _LENGTH_OPERATORS:
+                if not isinstance(value, int) or isinstance(value, bool):
+                    raise UnsupportedSchemaError(f'Unsupported value for {keyword}: {value!r}')
+                self._emit(indent, f'if isinstance({variable}, str) and '
+                                   f'len({variable}) {_LENGTH_OPERATORS[keyword]} {value!r}:')
+                self._emit(indent + 1, 'return False')
+
+    def _add_type_check(self, value: Any, variable: str, indent: int):
+        type_names = value if isinstance(value, list) else [value]
+        checks = []
+        for type_name in type_names:
+            if type_name not in _TYPE_CHECKS:
+                raise UnsupportedSchemaError(f'Unsupported type: {type_name!r}')
+            checks.append(_TYPE_CHECKS[type_name].format(variable))
+        self._emit(indent, f'if not ({" or ".join(checks)}):')
+        self._emit(indent + 1, 'return False')
+
+    def _add_required_check(self, value: Any, variable: str, indent: int):
+        if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+            raise UnsupportedSchemaError(f'Unsupported value for required: {value!r}')
+        if not value:
+            return
+        checks = ' and '.join(f'{name!r} in {variable}' for name in value)
+        self._emit(indent, f'if isinstance({variable}, dict) and not ({checks}):')
+        self._emit(indent + 1, 'return False')
+
+    def _add_properties_checks(self, value: Any, variable: str, indent: int):
+        if not isinstance(value, dict):
+            raise UnsupportedSchemaError(f'Unsupported value for properties: {value!r}')
+        header = len(self._lines)
+        self._emit(indent, f'if isinstance({variable}, dict):')
+        for property_name, property_schema in value.items():
+            property_variable = self._new_name('value')
+            property_header = len(self._lines)
+            self._emit(indent + 1, f'{property_variable} = {variable}.get({property_name!r}, _MISSING)')
+            self._emit(indent + 1, f'if {property_variable} is not _MISSING:')
+            self._add_checks(property_schema, variable=property_variable, indent=indent + 2)
+            self._remove_empty_block(property_header, header_lines=2)
+        self._remove_empty_block(header, header_lines=1)
+
+    def _add_items_checks(self, value: Any, variable: str, indent: int):
+        if not isinstance(value, dict):
+            raise UnsupportedSchemaError(f'Unsupported value for items: {value!r}')
+        item_variable = self._new_name('item')
+        header = len(self._lines)
+        self._emit(indent, f'if isinstance({variable}, list):')
+        self._emit(indent + 1, f'for {item_variable} in {variable}:')
+        self._add_checks(value, variable=item_variable, indent=indent + 2)
+        self._remove_empty_block(header, header_lines=2)
+
+    def _remove_empty_block(self, start: int, header_lines: int):
+        """ Remove the header lines of a block that starts at line `start`, if no checks were added to it. """
+        if len(self._lines) == start + header_lines:
+            del self._lines[start:]
+
+    def _add_enum_check(self, value: Any, variable: str, indent: int):
+        # jsonschema compares enum values with special rules for e.g. booleans and numbers. We only
+        # generate code for string enums; other values are left to jsonschema.
+        if not isinstance(value, list) or not all(isinstance(option, str) for option in value):
+            raise UnsupportedSchemaError(f'Unsupported value for enum: {value!r}')
+        options = self._add_constant('enum', f'frozenset({sorted(value)!r})')
+        self._emit(indent, f'if not (isinstance({variable}, str) and {variable} in {options}):')
+        self._emit(indent + 1, 'return False')
+
+
+def generate_validator_source(function_name: str, json_schema: Dict[str, Any]) -> str:
+    """
+    Generate the source code of a function that returns True if its argument certainly is valid according
+    to json_schema.
+    :param function_name: name of the function, must be a valid Python identifier
+    :param json_schema: json-schema for which to generate the validation function.
+    :raise UnsupportedSchemaError: if json_schema uses keywords for which no code can be generated.
+    """
+    if not function_name.isidentifier():
+        raise ValueError(f'Not a valid function name: {function_name}')
+    return _ValidatorGenerator(function_name=function_name, json_schema=json_schema).get_source()
+
+
+def compile_validator(json_schema: Dict[str, Any]) -> Optional[Callable[[Any], bool]]:
+    """
+    Generate and compile a validation function for the json-schema, see generate_validator_source().
+    :return: the function, or None if json_schema uses keywords for which no code can be generated.
+    """
+    try:
+        source = generate_validator_source('validate', json_schema)
+    except UnsupportedSchemaError:
+        return None
+    namespace: Dict[str, Any] = {'re': re, '_MISSING': _MISSING}
+    exec(compile(source, '<generated validator>', 'exec'), namespace)
+    return namespace['validate']
+
+
+class NativeValidator:
+    """
+    Validator with the same is_valid() and iter_errors() methods as a jsonschema validator. A generated
+    validation function is tried first, only if that doesn't accept the instance, the jsonschema validator
+    is used.
+    """
+
+    def __init__(self, schema_validator: Any, validate: Callable[[Any], bool]):
+        """
+        :param schema_validator: jsonschema validator
+        :param validate: generated validation function for the same json-schema, see compile_validator()
+        """
+        self.schema_validator = schema_validator
+        self.schema = schema_validator.schema
+        self._validate = validate
+
+    def is_valid(self, instance: Any) -> bool:
+        return self._validate(instance) or self.schema_validator.is_valid(instance)
+
+    def iter_errors(self, instance: Any) -> Iterator[Any]:
+        if self._validate(instance):
+            return iter(())
+        return self.schema_validator.iter_errors(instance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate python validation functions')
+    parser.add_argument('--schema-extensions-directory', type=str)
+    args = parser.parse_args(sys.argv[1:])
+
+    # imported here, as event_schemas uses this module to compile the validators
+    from objectiv_backend.schema.event_schemas import get_event_schema
+    event_schema = get_event_schema(schema_extensions_directory=args.schema_extensions_directory)
+
+    sources = [
+        '"""\nGenerated by objectiv_backend.schema.generate_validators\n"""',
+        'import re',
+        '_MISSING = object()'
+    ]
+    schemas = [(f'validate_event_{event_type}', event_schema.get_event_schema(event_type))
+               for event_type in event_schema.list_event_types()]
+    schemas.extend((f'validate_context_{context_type}', event_schema.get_context_schema(context_type))
+                   for context_type in event_schema.list_context_types())
+    for function_name, json_schema in schemas:
+        try:
+            sources.append('\n\n' + generate_validator_source(function_name, json_schema).rstrip())
+        except UnsupportedSchemaError as exc:
+            sources.append(f'\n\n# {function_name}: not generated, {exc}')
+    print('\n'.join(sources))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,18 +4,17 @@ Copyright 2021 Objectiv B.V.
 import argparse
 import json
 import sys
+from copy import deepcopy
 from typing import List, Any, Dict, NamedTuple, Set
 import uuid
-import re
 
-import jsonschema
-from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
 
 from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
 from objectiv_backend.common.config import \
     get_config_timestamp_validation, get_collector_config
 
-from objectiv_backend.common.types import EventData
+from objectiv_backend.common.types import EventData, ContextType
 
 
 class ErrorInfo(NamedTuple):
@@ -41,38 +40,10 @@ class EventError(Dict):
 def get_event_list_schema() -> Dict[str, Any]:
     """
 
-    :return: a dictionary containing a JSON schema like string to validate an array of events
+    :return: a dictionary containing a JSON schema like string to validate an array of events. The
+        returned dictionary is a copy, and can be modified by the caller.
     """
-    event_schema = get_collector_config().event_schema
-    events = event_schema.events.schema
-
-    # we use AbstractEvent as the blueprint for what an event should look like
-    abstract_event = events['AbstractEvent']
-
-    # # list of properties for an event (can be nested)
-    items: Dict[str, dict] = {}
-    for property_name, property_desc in abstract_event['properties'].items():
-
-        if 'items' in property_desc and re.match('^Abstract.*?Context$', property_desc['items']['type']):
-            # we don't want to go into the validation / schema of contexts here
-            # so a simple object will suffice
-            property_desc['items']['type'] = 'object'
-        items[property_name] = property_desc
-
-    # we want a schema for a list of events (the base_schema only specifies a single event)
-    # the schema wants a list of abstract events. As that is not a valid JSON type,
-    # we replace that type with the more generic 'object' type, and the actual definition of
-    # an abstract event
-    event_list_schema = get_collector_config().event_list_schema
-    if 'events' in event_list_schema['properties'] and \
-            'items' in event_list_schema['properties']['events'] and \
-            'type' in event_list_schema['properties']['events']['items'] and \
-            event_list_schema['properties']['events']['items']['type'] == 'AbstractEvent':
-        event_list_schema['properties']['events']['items'] = {
-            'type': 'object',
-            'items': items
-        }
-    return event_list_schema
+    return deepcopy(get_collector_config().event_list_schema)
 
 
 def validate_structure_event_list(event_data: Any) -> List[ErrorInfo]:
@@ -84,11 +55,11 @@ def validate_structure_event_list(event_data: Any) -> List[ErrorInfo]:
     validate_event_adheres_to_schema on each individual event.
     :return: list of found errors. Empty list indicates not errors
     """
-    try:
-        event_list_schema = get_event_list_schema()
-        jsonschema.validate(instance=event_data, schema=event_list_schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {exc}')]
+    # The event list schema is created and compiled once, when the collector config is loaded.
+    validator = get_collector_config().event_list_validator
+    error = best_match(validator.iter_errors(event_data))
+    if error is not None:
+        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {error}')]
     return []
 
 
@@ -152,15 +123,16 @@ def _validate_required_contexts(event_schema: EventSchema, event: EventData) ->
     event_name = event['_type']
     global_contexts = event['global_contexts']
     location_stack = event['location_stack']
-    required_context_types: Set = event_schema.get_all_required_contexts_for_event(event_name)
-    actual_types = set()
-    for context in global_contexts:
-        actual_types |= event_schema.get_all_parent_context_types(context['_type'])
-    for context in location_stack:
-        actual_types |= event_schema.get_all_parent_context_types(context['_type'])
-
-    for context in actual_types:
-        required_context_types |= event_schema.get_all_required_contexts_for_context(context)
+    context_types = {context['_type'] for context in global_contexts}
+    context_types.update(context['_type'] for context in location_stack)
+    actual_types: Set[ContextType] = set()
+    # The required contexts of a context type include those of its parent types, so we only have to look
+    # at the actual types of the contexts, and not at their parent types.
+    required_context_types: Set[ContextType] = \
+        set(event_schema.get_frozen_required_contexts_for_event(event_name))
+    for context_type in context_types:
+        actual_types |= event_schema.get_frozen_parent_context_types(context_type)
+        required_context_types |= event_schema.get_frozen_required_contexts_for_context(context_type)
 
     if not required_context_types.issubset(actual_types):
         error_info = ErrorInfo(
@@ -204,24 +176,26 @@ def _validate_context_item(event_schema: EventSchema, context) -> List[ErrorInfo
     context_type = context['_type']
     # theoretically we could generate some json schema with if-then that we could just validate, without
     # having to select the right sub-schema here, but that would be very complex and not very readable.
-    schema = event_schema.get_context_schema(context_type)
-    if not schema:
+    validator = event_schema.get_context_validator(context_type)
+    if not validator:
         print(f'Unknown context {context_type}, ignoring')
         return []
-    try:
-        jsonschema.validate(instance=context, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(context, f'context validation failed: {exc}')]
+    error = best_match(validator.iter_errors(context))
+    if error is not None:
+        return [ErrorInfo(context, f'context validation failed: {error}')]
     return []
 
 
 def _validate_event_item(event_schema: EventSchema, event) -> List[ErrorInfo]:
     event_type = event['_type']
-    schema = event_schema.get_event_schema(event_type=event_type)
-    try:
-        jsonschema.validate(instance=event, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event, f'event validation failed {exc}')]
+    validator = event_schema.get_event_validator(event_type=event_type)
+    # help mypy; validate_event_adheres_to_schema() already checked that the event type exists
+    assert validator is not None
+    # Same error selection as jsonschema.validate(), but using the validator that was compiled when the
+    # schema was loaded.
+    error = best_match(validator.iter_errors(event))
+    if error is not None:
+        return [ErrorInfo(event, f'event validation failed {error}')]
 
     return []
 
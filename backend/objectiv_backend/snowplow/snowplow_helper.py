@@ -1,19 +1,23 @@
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, Iterator, List, Tuple, TypeVar, Union, Optional
 
 import base64
-import json
+import os
+import threading
+import time
 from datetime import datetime
+from functools import partial
 from urllib.parse import urlparse
 
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload  # type: ignore
 
-from objectiv_backend.common.config import SnowplowConfig, get_collector_config
-from objectiv_backend.common.event_utils import get_context
+from objectiv_backend.common.config import SnowplowConfig, get_collector_config, SNOWPLOW_MAX_ATTEMPTS, \
+    SNOWPLOW_RETRY_BACKOFF_SECONDS, SP_PUBLISH_TIMEOUT_SECONDS, SP_GCP_PUBSUB_BATCH_MAX_MESSAGES, \
+    SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.event_utils import EventJsonCache, json_items_to_json, ContextIndex
 from objectiv_backend.common.types import EventDataList, EventData
 from objectiv_backend.schema.validate_events import EventError
-
-from thrift.protocol import TBinaryProtocol
-from thrift.transport import TTransport
+from objectiv_backend.snowplow.thrift_encoder import encode_collector_payload
 
 # only load imports if needed
 snowplow_config = get_collector_config().output.snowplow
@@ -39,10 +43,43 @@ def make_snowplow_custom_context(self_describing_event: Dict, config: SnowplowCo
         'schema': snowplow_contexts_schema,
         'data': [self_describing_event]
     }
-    custom_context_json = json.dumps(custom_context)
+    custom_context_json = json_codec.dumps(custom_context)
     return str(base64.b64encode(custom_context_json.encode('UTF-8')), 'UTF-8')
 
 
+def _make_snowplow_custom_context_json(rich_event_json: str, config: SnowplowConfig) -> str:
+    """
+    Create the json of the Snowplow custom context, from the already serialized rich event. The result is
+    identical to json_codec.dumps() of the custom context that make_snowplow_custom_context() creates.
+    :param rich_event_json: serialized rich event
+    :param config: SnowplowConfig
+    :return: json serialization of the snowplow custom context
+    """
+    self_describing_event_json = \
+        '{"schema":' + json_codec.dumps(config.schema_objectiv_taxonomy) + ',"data":' + rich_event_json + '}'
+    return '{"schema":' + json_codec.dumps(config.schema_contexts) + ',"data":[' + self_describing_event_json + ']}'
+
+
+def _get_rich_event_json(event: EventData, cookie_id: Any, json_cache: EventJsonCache) -> str:
+    """
+    Serialize the event, with 'id' renamed to 'event_id' and with an added (or replaced) 'cookie_id'. The
+    already serialized values of the event are reused.
+    """
+    cookie_id_item = (json_codec.dumps('cookie_id'), json_codec.dumps(cookie_id))
+    items = []
+    cookie_id_added = False
+    for key, value in json_cache.get_json_items(event):
+        if key == '"id"':
+            key = '"event_id"'
+        elif key == cookie_id_item[0]:
+            key, value = cookie_id_item
+            cookie_id_added = True
+        items.append((key, value))
+    if not cookie_id_added:
+        items.append(cookie_id_item)
+    return json_items_to_json(items)
+
+
 def objectiv_event_to_snowplow(event: EventData, config: SnowplowConfig) -> Dict[str, Union[str, EventData]]:
     """
     Wrap objectiv event in self-describing Snowplow object
@@ -58,50 +95,56 @@ def objectiv_event_to_snowplow(event: EventData, config: SnowplowConfig) -> Dict
     }
 
 
-def objectiv_event_to_snowplow_payload(event: EventData, config: SnowplowConfig) -> CollectorPayload:
+def objectiv_event_to_snowplow_payload(event: EventData,
+                                       config: SnowplowConfig,
+                                       json_cache: Optional[EventJsonCache] = None) -> CollectorPayload:
     """
     Transform Objectiv event to Snowplow Collector Payload object
     :param event: EventData
     :param config: SnowplowConfig
+    :param json_cache: optional cache with the json serialization of the event, to share with other sinks
     :return: CollectorPayload
     """
-    snowplow_payload_data_schema = config.schema_payload_data
-    snowplow_collector_payload_schema = config.schema_collector_payload
+    payload, _ = _make_snowplow_payload(event=event, config=config, json_cache=json_cache)
+    return payload
 
-    try:
-        http_context = get_context(event, 'HttpContext')
-    except ValueError:
-        http_context = {}
 
-    try:
-        cookie_context = get_context(event, 'CookieIdContext')
-    except ValueError:
-        cookie_context = {}
+def _make_snowplow_payload(event: EventData,
+                           config: SnowplowConfig,
+                           json_cache: Optional[EventJsonCache]) -> Tuple[CollectorPayload, Dict[str, str]]:
+    """
+    Transform Objectiv event to Snowplow Collector Payload object.
+    :return: tuple: the CollectorPayload, and the tracker parameters that are in the body of the payload
+    """
+    if json_cache is None:
+        json_cache = EventJsonCache()
+    snowplow_payload_data_schema = config.schema_payload_data
+    snowplow_collector_payload_schema = config.schema_collector_payload
 
-    try:
-        path_context = get_context(event, 'PathContext')
-    except ValueError:
-        path_context = {}
+    context_index = ContextIndex(event)
+    http_context = context_index.get_optional_context('HttpContext') or {}
+    cookie_context = context_index.get_optional_context('CookieIdContext') or {}
+    path_context = context_index.get_optional_context('PathContext') or {}
 
     query_string = urlparse(str(path_context.get('id', ''))).query
 
-    rich_event = {'event_id' if k == 'id' else k: v for k, v in event.items()}
-    rich_event['cookie_id'] = cookie_context.get('id', '')
-
-    snowplow_event = objectiv_event_to_snowplow(event=rich_event, config=config)
-    snowplow_custom_context = make_snowplow_custom_context(self_describing_event=snowplow_event, config=config)
+    rich_event_json = _get_rich_event_json(event=event, cookie_id=cookie_context.get('id', ''),
+                                           json_cache=json_cache)
+    custom_context_json = _make_snowplow_custom_context_json(rich_event_json=rich_event_json, config=config)
+    snowplow_custom_context = str(base64.b64encode(custom_context_json.encode('UTF-8')), 'UTF-8')
+    parameters = {
+        "e": "se",  # mandatory: event type: structured event
+        "p": "web",  # mandatory: platform
+        "tv": "objectiv-tracker-0.0.5",  # mandatory: tracker version
+        "eid": event['id'],  # event_id
+        "url": path_context.get('id', ''),
+        "cx": snowplow_custom_context
+    }
     payload = {
         "schema": snowplow_payload_data_schema,
-        "data": [{
-            "e": "se",  # mandatory: event type: structured event
-            "p": "web",  # mandatory: platform
-            "tv": "objectiv-tracker-0.0.5",  # mandatory: tracker version
-            "eid": event['id'],  # event_id
-            "url": path_context.get('id', ''),
-            "cx": snowplow_custom_context
-        }]
+        "data": [parameters]
     }
-    return CollectorPayload(
+    collector_payload = CollectorPayload(
         schema=snowplow_collector_payload_schema,
         ipAddress=http_context.get('remote_address', ''),
         timestamp=int(datetime.now().timestamp() * 1000),
@@ -111,39 +154,38 @@ def objectiv_event_to_snowplow_payload(event: EventData, config: SnowplowConfig)
         refererUri=http_context.get('referrer', ''),
         path='/com.snowplowanalytics.snowplow/tp2',
         querystring=query_string,
-        body=json.dumps(payload),
+        body=json_codec.dumps(payload),
         headers=[],
         contentType='application/json',
         hostname='',
         networkUserId=cookie_context.get('id', '')
     )
+    return collector_payload, parameters
 
 
 def payload_to_thrift(payload: CollectorPayload) -> bytes:
     """
     Generate Thrift message for payload, based on Thrift schema here:
         https://github.com/snowplow/snowplow/blob/master/2-collectors/thrift-schemas/collector-payload-1/src/main/thrift/collector-payload.thrift
+
+    The message is encoded with the binary protocol by a writer that is specialised for CollectorPayload,
+    which is a lot faster than the generated code. See thrift_encoder.
     :param payload: CollectorPayload - class instance representing Thrift message
     :return: bytes - serialized string
     """
-
-    # use memory buffer as transport layer
-    trans = TTransport.TMemoryBuffer()
-
-    # use the binary encoding protocol
-    oprot = TBinaryProtocol.TBinaryProtocol(trans=trans)
-    payload.write(oprot=oprot)
-
-    return trans.getvalue()
+    return encode_collector_payload(payload)
 
 
 def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowConfig,
-                                   event_error: EventError = None) -> Dict[str, Union[str, Dict]]:
+                                   event_error: EventError = None,
+                                   parameters: Optional[Dict[str, str]] = None) -> Dict[str, Union[str, Dict]]:
     """
     Generate Snowplow schema violation JSON object
     :param payload: CollectorPayload object - representation of Event
     :param config: SnowplowConfig
     :param event_error: error for this event
+    :param parameters: optional tracker parameters in the body of the payload. If not given, they are
+        parsed from the payload.
     :return: Dictionary representing the schema violation
     """
 
@@ -158,25 +200,9 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
                 "targets": ["_type"]
             })
 
-    parameters = []
-    data = json.loads(payload.body)['data'][0]
-    for key, value in data.items():
-        parameters.append({
-            "name": key,
-            "value": value[:512]
-        })
-
-    # look for our custom context, so we can fill the enrich section
-    event = {}
-    if 'cx' in data:
-        context_container_encoded = data['cx']
-        context_container_decoded = json.loads(base64.b64decode(context_container_encoded).decode('utf-8'))
-        contexts = context_container_decoded['data']
-        for context in contexts:
-            if 'schema' in context and context['schema'] == config.schema_objectiv_taxonomy and 'data' in context:
-                event = context['data']
-                # we pick the first
-                break
+    if parameters is None:
+        parameters = json_codec.loads(payload.body)['data'][0]
+    raw_parameters = [{"name": key, "value": value[:512]} for key, value in parameters.items()]
 
     ts_format = '%Y-%m-%dT%H:%M:%S.%fZ'
     return {
@@ -212,7 +238,7 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
                     # Encoding of the collector payload
                     "encoding": payload.encoding,
                     # Query string of the collector payload containing this event
-                    "parameters": parameters,
+                    "parameters": raw_parameters,
                     # Content type of the payload as detected by the collector
                     "contentType": payload.contentType,
                     "headers": payload.headers,
@@ -223,8 +249,8 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
                     "userId": payload.networkUserId
                 },
                 "enrich": {
-                    "event_id": event.get('id'),
-                    "context": context_container_encoded
+                    "event_id": parameters.get('eid'),
+                    "context": parameters.get('cx')
                 }
             },
             # Information about the piece of software responsible for the creation of schema violations
@@ -241,7 +267,8 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
 def prepare_event_for_snowplow_pipeline(event: EventData,
                                         good: bool,
                                         config: SnowplowConfig,
-                                        event_errors: List[EventError] = None) -> bytes:
+                                        event_error: Optional[EventError] = None,
+                                        json_cache: Optional[EventJsonCache] = None) -> bytes:
     """
     Transform event into data suitable for writing to the Snowplow Pipeline. If the event is "good" this means a
     CollectorPayload object, binary-encoded using Thrift. If it's a bad event, it's transformed to a JSON-based schema
@@ -249,37 +276,61 @@ def prepare_event_for_snowplow_pipeline(event: EventData,
     :param event: EventData
     :param good: bool - True if these events should go to the "good" channel
     :param config: SnowplowConfig
-    :param event_errors: list of EventError
+    :param event_error: error of this event, if any. See index_event_errors()
+    :param json_cache: optional cache with the json serialization of the event, to share with other sinks
     :return: bytes object to be ingested by Snowplow pipeline
     """
-    payload: CollectorPayload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    payload, parameters = _make_snowplow_payload(event=event, config=config, json_cache=json_cache)
     if good:
         data = payload_to_thrift(payload=payload)
     else:
-        event_error = None
-        # try to find errors for the current event_id
-        if event_errors:
-            for ee in event_errors:
-                if ee.event_id == event['id']:
-                    event_error = ee
-        failed_event = snowplow_schema_violation_json(payload=payload, config=config, event_error=event_error)
+        failed_event = snowplow_schema_violation_json(payload=payload, config=config, event_error=event_error,
+                                                      parameters=parameters)
 
         # serialize (json) and encode to bytestring for publishing
-        data = json.dumps(failed_event, separators=(',', ':')).encode('utf-8')
+        data = json_codec.dumps_bytes(failed_event)
 
     return data
 
 
+def index_event_errors(event_errors: Optional[List[EventError]]) -> Dict[str, EventError]:
+    """
+    Index errors by event id. If there are multiple errors for an event, the last one is used.
+    :param event_errors: list of EventErrors, or None
+    :return: dict mapping event id (as string) to EventError
+    """
+    return {str(event_error.event_id): event_error for event_error in event_errors or []}
+
+
+def _prepare_events_for_snowplow_pipeline(events: EventDataList,
+                                          good: bool,
+                                          config: SnowplowConfig,
+                                          event_errors: Optional[List[EventError]],
+                                          json_cache: Optional[EventJsonCache]) -> List[bytes]:
+    """ Call prepare_event_for_snowplow_pipeline() for all events, with the error of each event. """
+    errors_by_event_id = {} if good else index_event_errors(event_errors)
+    return [prepare_event_for_snowplow_pipeline(event=event, good=good, config=config,
+                                                event_error=errors_by_event_id.get(str(event['id'])),
+                                                json_cache=json_cache)
+            for event in events]
+
+
 def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good: bool = True,
-                             event_errors: List[EventError] = None) -> None:
+                             event_errors: List[EventError] = None,
+                             json_cache: Optional[EventJsonCache] = None) -> None:
     """
-    Write provided list of events to the Snowplow GCP pipeline, using GCP PubSub
+    Write provided list of events to the Snowplow GCP pipeline, using GCP PubSub.
+    All events are published at once, the publisher client combines them into batches. Events that could
+    not be published are retried, see SNOWPLOW_MAX_ATTEMPTS.
     :param events: EventDataList - List of EventData
     :param config:  SnowplowConfig
     :param good: bool - True if these events should go to the "good" channel
     :param event_errors: list of EventErrors
-    :return:
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
+    :raise SnowplowPublishError: if not all events could be published
     """
+    if not events:
+        return
 
     project = config.gcp_project
     if good:
@@ -289,29 +340,46 @@ def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good
         # not ok events get sent to the bad topic
         topic = config.gcp_pubsub_topic_bad
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = _get_pubsub_publisher()
     topic_path = f'projects/{project}/topics/{topic}'
 
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
+    data = _prepare_events_for_snowplow_pipeline(events=events, good=good, config=config,
+                                                 event_errors=event_errors, json_cache=json_cache)
 
-        try:
-            publisher.publish(topic_path, data=data)
-        except NotFound as e:
-            print(f'PubSub topic {topic} could not be found! {e}')
+    def publish(pending: List[bytes]) -> List[bytes]:
+        futures = [publisher.publish(topic_path, data=message) for message in pending]
+        failed = []
+        for message, future in zip(pending, futures):
+            try:
+                future.result(timeout=SP_PUBLISH_TIMEOUT_SECONDS)
+            except NotFound as e:
+                # retrying won't help
+                print(f'PubSub topic {topic} could not be found! {e}')
+            except Exception as e:
+                print(f'Failed to publish event to PubSub topic {topic}: {e}')
+                failed.append(message)
+        return failed
+
+    _publish_with_retries(publish, data, destination=f'PubSub topic {topic}')
 
 
 def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
                                good: bool = True,
-                               event_errors: List[EventError] = None) -> None:
+                               event_errors: List[EventError] = None,
+                               json_cache: Optional[EventJsonCache] = None) -> None:
     """
-    Write provided list of events to Snowplow AWS pipeline, either directly to Kinesis, or to SQS
+    Write provided list of events to Snowplow AWS pipeline, either directly to Kinesis, or to SQS.
+    Events are sent in batches, as large as Kinesis and SQS allow. Events that could not be delivered are
+    retried, see SNOWPLOW_MAX_ATTEMPTS.
     :param events: EventDataList - List of EventData
     :param config:  SnowplowConfig
     :param good: bool - True if these events should go to the "good" channel
     :param event_errors: list of EventErrors
-    :return:
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
+    :raise SnowplowPublishError: if not all events could be delivered
     """
+    if not events:
+        return
 
     if good:
         # good events get sent to the raw topic, which means they get processed by snowplow's enrichment
@@ -324,45 +392,157 @@ def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
         # the bad stream always goes to kinesis
         client_type = 'kinesis'
 
+    if client_type not in ('kinesis', 'sqs'):
+        # this should never happen
+        raise ValueError(f'Unknown Client-Type: {client_type}')
+    client = _get_aws_client(client_type)
+
+    data = _prepare_events_for_snowplow_pipeline(events=events, good=good, config=config,
+                                                 event_errors=event_errors, json_cache=json_cache)
+
     if client_type == 'kinesis':
-        client = boto3.client('kinesis')
+        _publish_with_retries(partial(_put_kinesis_records, client, stream_name), data,
+                              destination=f'Kinesis stream {stream_name}')
     else:
-        client = boto3.client('sqs')
+        # sqs doesn't support binary payloads, so in this case we base64 encode
+        payloads = [str(base64.b64encode(message), 'UTF-8') for message in data]
+        _publish_with_retries(partial(_send_sqs_messages, client, stream_name), payloads,
+                              destination=f'SQS queue {stream_name}')
 
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
 
-        if client_type == 'kinesis':
-            try:
-                client.put_record(
-                    StreamName=stream_name,
-                    Data=data,
-                    PartitionKey='event_id')
-            except client.exceptions.ProvisionedThroughputExceededException as e:
-                print(f'Could not deliver event to Kinesis: throughput exceeded in {stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Exception sending event to Kinesis ({stream_name}: {e}')
-
-        elif client_type == 'sqs':
-            # sqs doesn't support binary payloads, so in this case we base64 encode
-            payload = str(base64.b64encode(data), 'UTF-8')
+class SnowplowPublishError(Exception):
+    """ Events could not be delivered to the Snowplow pipeline. """
+    pass
 
-            try:
-                client.send_message(QueueUrl=stream_name,
-                                    MessageBody=payload,
-                                    MessageAttributes={
-                                        #  The sqs message attribute that will be used to set the kinesis partition key
-                                        'kinesisKey': {
-                                            'StringValue': 'event_id',
-                                            'DataType': 'String'
-                                        }
-                                    })
-            except client.exceptions.InvalidMessageContents as e:
-                print(f'Failed to deliver event to SQS: Invalid Message Contents ({stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Failed to deliver event to SQS ({stream_name}: {e}')
-
-        else:
-            # this should never happen
-            raise ValueError(f'Unknown Client-Type: {client_type}')
 
+# Maximum number of records and bytes per request, as allowed by the AWS APIs
+_KINESIS_MAX_RECORDS = 500
+_KINESIS_MAX_BYTES = 5 * 1024 * 1024
+_SQS_MAX_MESSAGES = 10
+_SQS_MAX_BYTES = 256 * 1024
+
+T = TypeVar('T', bytes, str)
+
+
+def _publish_with_retries(publish: Callable[[List[T]], List[T]], messages: List[T], destination: str):
+    """
+    Publish the messages, and retry the messages that failed with exponential backoff.
+    :param publish: function that publishes a list of messages, and returns the messages that failed and
+        should be retried.
+    :param destination: description of the destination, for error messages
+    :raise SnowplowPublishError: if there are still failed messages after SNOWPLOW_MAX_ATTEMPTS attempts
+    """
+    pending = messages
+    for attempt in range(SNOWPLOW_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(SNOWPLOW_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        pending = publish(pending)
+        if not pending:
+            return
+    raise SnowplowPublishError(f'Could not deliver {len(pending)} events to {destination}')
+
+
+def _make_batches(messages: List[T], max_count: int, max_bytes: int) -> Iterator[List[T]]:
+    """ Split messages into lists of at most max_count messages, and at most max_bytes in total. """
+    batch: List[T] = []
+    batch_bytes = 0
+    for message in messages:
+        if batch and (len(batch) >= max_count or batch_bytes + len(message) > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(message)
+        batch_bytes += len(message)
+    if batch:
+        yield batch
+
+
+def _put_kinesis_records(client: Any, stream_name: str, data: List[bytes]) -> List[bytes]:
+    """
+    Put records on a Kinesis stream, with a put_records call per batch.
+    :return: the records that failed, and can be retried
+    """
+    failed = []
+    # The partition key counts towards the size limit too, but it's small compared to the margin that we
+    # have between the maximum size of a request and the maximum size of the events in it.
+    for batch in _make_batches(data, max_count=_KINESIS_MAX_RECORDS, max_bytes=_KINESIS_MAX_BYTES):
+        try:
+            response = client.put_records(
+                StreamName=stream_name,
+                Records=[{'Data': record, 'PartitionKey': 'event_id'} for record in batch])
+        except client.exceptions.ProvisionedThroughputExceededException as e:
+            print(f'Could not deliver events to Kinesis: throughput exceeded in {stream_name}: {e}')
+            failed.extend(batch)
+            continue
+        except botocore.exceptions.ClientError as e:
+            print(f'Exception sending events to Kinesis ({stream_name}: {e}')
+            failed.extend(batch)
+            continue
+        if response.get('FailedRecordCount'):
+            for record, result in zip(batch, response['Records']):
+                if 'ErrorCode' in result:
+                    failed.append(record)
+            print(f'Could not deliver {response["FailedRecordCount"]} events to Kinesis ({stream_name})')
+    return failed
+
+
+def _send_sqs_messages(client: Any, queue_url: str, payloads: List[str]) -> List[str]:
+    """
+    Send messages to an SQS queue, with a send_message_batch call per batch.
+    :return: the messages that failed, and can be retried. Messages that failed because of an error on our
+        side are not returned, as retrying them won't help.
+    """
+    failed = []
+    for batch in _make_batches(payloads, max_count=_SQS_MAX_MESSAGES, max_bytes=_SQS_MAX_BYTES):
+        entries = [{
+            'Id': str(index),
+            'MessageBody': payload,
+            'MessageAttributes': {
+                #  The sqs message attribute that will be used to set the kinesis partition key
+                'kinesisKey': {
+                    'StringValue': 'event_id',
+                    'DataType': 'String'
+                }
+            }
+        } for index, payload in enumerate(batch)]
+        try:
+            response = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except botocore.exceptions.ClientError as e:
+            print(f'Failed to deliver events to SQS ({queue_url}: {e}')
+            failed.extend(batch)
+            continue
+        for failure in response.get('Failed', []):
+            print(f'Failed to deliver event to SQS ({queue_url}): {failure.get("Code")} {failure.get("Message")}')
+            if not failure.get('SenderFault'):
+                failed.append(batch[int(failure['Id'])])
+    return failed
+
+
+# Clients per process id. Clients are expensive to create, but they should not be shared between processes.
+_CLIENTS: Dict[Tuple[int, str], Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(name: str, factory: Callable[[], Any]) -> Any:
+    key = (os.getpid(), name)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = factory()
+            _CLIENTS[key] = client
+    return client
+
+
+def _get_aws_client(client_type: str) -> Any:
+    """ Give the boto3 client of the current process for client_type, which is 'kinesis' or 'sqs'. """
+    return _get_client(client_type, lambda: boto3.client(client_type))
+
+
+def _get_pubsub_publisher() -> Any:
+    """ Give the PubSub publisher client of the current process. """
+    def create_publisher():
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=SP_GCP_PUBSUB_BATCH_MAX_MESSAGES,
+            max_latency=SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS)
+        return pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    return _get_client('pubsub', create_publisher)
@@ -1,7 +1,7 @@
 """
 Tool that connects to the database and creates the needed tables as defined in create_table.sql
 If a duplicate-table error is encounterd, then the script will assume that the databse is already
-initialized correctly and exit successfully.
+initialized, add the tables of create_tables_upgrade.sql that are missing, and exit successfully.
 
 This assumes that the user and database already exist.
 
@@ -9,26 +9,68 @@ Copyright 2021 Objectiv B.V.
 """
 import argparse
 import os
+import re
 import sys
 from time import sleep
 
 import psycopg2
 
-from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.config import get_config_postgres, PG_DATA_PARTITIONED, PG_QUEUE_SHARDS, \
+    PG_QUEUE_UNLOGGED
 from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.workers.pg_partitions import maintain_partitions
 
 _MAX_RETRIES = 5
 _POSTGRES_DUPLICATE_TABLE_ERROR = '42P07'
 
 
-def get_sql() -> str:
-    """ get content of ../../create_tables.sql as string """
+_SECTION_RE = re.compile(r'^-- begin (?P<name>[\w ]+)$.*?^-- end (?P=name)$', re.MULTILINE | re.DOTALL)
+
+
+def get_sql(partitioned: bool = False, queue_shards: int = 1, unlogged_queues: bool = False) -> str:
+    """
+    get content of ../../create_tables.sql as string
+    :param partitioned: if set, the sections ('-- begin <name>' up to '-- end <name>') of create_tables.sql
+        are replaced with the sections of the same name in ../../create_tables_partitioned.sql
+    :param queue_shards: number of shards of the queue tables. If more than 1, the queue sections are
+        repeated per shard, with the queue tables named <table>_<shard>
+    :param unlogged_queues: if set, the queue tables are created as unlogged tables
+    """
     dirname = os.path.dirname(__file__)
     filename = os.path.join(dirname, '../../create_tables.sql')
     with open(filename) as f:
+        sql = f.read()
+    sections = {}
+    if partitioned:
+        with open(os.path.join(dirname, '../../create_tables_partitioned.sql')) as f:
+            sections = {match.group('name'): match.group(0) for match in _SECTION_RE.finditer(f.read())}
+
+    def replace_section(match) -> str:
+        name = match.group('name')
+        section = sections.get(name, match.group(0))
+        if name.startswith('queue '):
+            return _shard_queue_section(section, queue_shards, unlogged_queues)
+        return section
+
+    return _SECTION_RE.sub(replace_section, sql) + get_upgrade_sql()
+
+
+def get_upgrade_sql() -> str:
+    """ get content of ../../create_tables_upgrade.sql as string. Can be run on an initialized database. """
+    dirname = os.path.dirname(__file__)
+    with open(os.path.join(dirname, '../../create_tables_upgrade.sql')) as f:
         return f.read()
 
 
+def _shard_queue_section(section: str, queue_shards: int, unlogged_queues: bool) -> str:
+    if unlogged_queues:
+        section = re.sub(r'^create table ', 'create unlogged table ', section, flags=re.MULTILINE)
+    if queue_shards == 1:
+        return section
+    return '\n'.join(re.sub(r'\b(queue_entry|queue_finalize)\b', rf'\1_{shard}', section)
+                     for shard in range(queue_shards))
+
+
 def get_connection_with_retries(retry: bool):
     """ Connect to database. If retry set will attempt multiple times"""
     pg_config = get_config_postgres()
@@ -54,8 +96,20 @@ def main():
                              "giving the database time to start up if run at start up. If set won't retry")
     parser.add_argument('--print', dest='print', default=False, action='store_true',
                         help="Instead of running sql to setup schema, print it to stdout")
+    parser.add_argument('--partitioned', dest='partitioned', default=PG_DATA_PARTITIONED, action='store_true',
+                        help="Partition the data and nok_data tables by day, see create_tables_partitioned.sql. "
+                             "Default is set by PG_DATA_PARTITIONED")
+    parser.add_argument('--queue-shards', dest='queue_shards', default=PG_QUEUE_SHARDS, type=int,
+                        help="Number of shards of the queue tables. Default is set by PG_QUEUE_SHARDS")
+    parser.add_argument('--unlogged-queues', dest='unlogged_queues', default=PG_QUEUE_UNLOGGED,
+                        action='store_true',
+                        help="Create the queue tables as unlogged tables. These are faster, but are emptied "
+                             "after a database crash. Default is set by PG_QUEUE_UNLOGGED")
     args = parser.parse_args(sys.argv[1:])
-    sql = get_sql()
+    if args.queue_shards < 1:
+        parser.error('Number of queue shards must be at least 1')
+    sql = get_sql(partitioned=args.partitioned, queue_shards=args.queue_shards,
+                  unlogged_queues=args.unlogged_queues)
 
     if args.print:
         print(sql)
@@ -66,9 +120,14 @@ def main():
         try:
             cursor.execute(sql)
             print('Succesfully initialized database.')
+            if args.partitioned:
+                maintain_partitions(connection)
         except psycopg2.Error as error:
             if error.pgcode == _POSTGRES_DUPLICATE_TABLE_ERROR:
                 print('Got "duplicate table error", assuming database is already initialized')
+                connection.rollback()
+                cursor.execute(get_upgrade_sql())
+                print('Succesfully added missing tables.')
                 exit(0)
             raise
 
@@ -0,0 +1,201 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Maintenance of the day partitions of the data and nok_data tables, for the partitioned layout of
+create_tables_partitioned.sql.
+
+Every table has a partition per day, named <table>_p<yyyymmdd>, and a default partition <table>_default for
+events of days without a partition. Partitions are created ahead of time. A new partition takes over the
+events of its day from the default partition. Partitions older than the retention period are dropped or
+detached, and the event_ids of those days are removed from data_event_id and sessions.
+
+Maintenance is run periodically by the finalize worker, see maybe_maintain_partitions(), and can be run
+manually with `objectiv-db-partitions`.
+"""
+import argparse
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from psycopg2 import sql
+
+from objectiv_backend.common.config import get_config_postgres, PG_DATA_PARTITIONED, PG_PARTITION_DAYS_AHEAD, \
+    PG_PARTITION_MAINTENANCE_SECONDS, PG_PARTITION_RETENTION_DAYS, PG_PARTITION_RETENTION_ACTION
+from objectiv_backend.common.db import get_db_connection
+
+PARTITIONED_TABLES = ('data', 'nok_data')
+RETENTION_ACTIONS = ('drop', 'detach')
+
+# Key of the advisory lock that makes sure only one process at a time does maintenance.
+_ADVISORY_LOCK_KEY = 0x6f626a70  # 'objp'
+
+_last_maintenance: Optional[float] = None
+
+
+def get_partition_name(table: str, day: date) -> str:
+    return f'{table}_p{day:%Y%m%d}'
+
+
+def get_partitions(connection, table: str) -> Dict[date, str]:
+    """
+    Give the day partitions of a table.
+    :return: dict mapping day to partition name. The default partition is not included.
+    """
+    query = '''
+        select child.relname
+        from pg_inherits
+        inner join pg_class as child on child.oid = pg_inherits.inhrelid
+        where pg_inherits.inhparent = %s::regclass
+    '''
+    name_re = re.compile(rf'^{re.escape(table)}_p(\d{{4}})(\d{{2}})(\d{{2}})$')
+    partitions = {}
+    with connection.cursor() as cursor:
+        cursor.execute(query, (table,))
+        for (name,) in cursor.fetchall():
+            match = name_re.match(name)
+            if match:
+                partitions[date(*(int(part) for part in match.groups()))] = name
+    return partitions
+
+
+def create_partitions(connection, first_day: date, last_day: date) -> List[str]:
+    """
+    Create the missing partitions of the partitioned tables, for the days first_day up to and including
+    last_day. The events of those days that are in the default partition are moved to the new partition.
+    :return: names of the created partitions
+    """
+    created = []
+    with connection.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            existing = get_partitions(connection, table)
+            day = first_day
+            while day <= last_day:
+                if day not in existing:
+                    _create_partition(cursor, table, day)
+                    created.append(get_partition_name(table, day))
+                day += timedelta(days=1)
+    return created
+
+
+def _create_partition(cursor, table: str, day: date):
+    # A partition can't be added if the default partition holds rows for its range. So the partition is
+    # created as a separate table, the rows are moved to it, and then it is attached.
+    partition = sql.Identifier(get_partition_name(table, day))
+    default_partition = sql.Identifier(f'{table}_default')
+    parameters = {'start': day, 'end': day + timedelta(days=1)}
+    cursor.execute(sql.SQL('''
+        create table {partition} (like {table} including defaults including constraints);
+        with moved as (
+            delete from {default_partition}
+            where day >= %(start)s and day < %(end)s
+            returning *
+        )
+        insert into {partition} select * from moved;
+        alter table {table} attach partition {partition} for values from (%(start)s) to (%(end)s);
+    ''').format(partition=partition, table=sql.Identifier(table), default_partition=default_partition),
+        parameters)
+
+
+def apply_retention(connection, cutoff_day: date, action: str = 'drop') -> List[str]:
+    """
+    Remove the partitions of the partitioned tables with days before cutoff_day, and the events of those days
+    in the default partitions and in data_event_id.
+    :param action: 'drop' to drop the partitions, 'detach' to detach them, leaving them as normal tables that
+        can be archived.
+    :return: names of the dropped or detached partitions
+    """
+    if action not in RETENTION_ACTIONS:
+        raise ValueError(f'Unknown retention action: {action}')
+    removed = []
+    with connection.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            for day, name in sorted(get_partitions(connection, table).items()):
+                if day >= cutoff_day:
+                    continue
+                if action == 'drop':
+                    cursor.execute(sql.SQL('drop table {partition}').format(partition=sql.Identifier(name)))
+                else:
+                    cursor.execute(sql.SQL('alter table {table} detach partition {partition}').format(
+                        table=sql.Identifier(table), partition=sql.Identifier(name)))
+                removed.append(name)
+            cursor.execute(sql.SQL('delete from {default_partition} where day < %s').format(
+                default_partition=sql.Identifier(f'{table}_default')), (cutoff_day,))
+        cursor.execute('delete from data_event_id where day < %s', (cutoff_day,))
+        cursor.execute('delete from sessions where moment < %s', (cutoff_day,))
+    return removed
+
+
+def maintain_partitions(connection,
+                        today: Optional[date] = None,
+                        days_ahead: int = PG_PARTITION_DAYS_AHEAD,
+                        retention_days: int = PG_PARTITION_RETENTION_DAYS,
+                        retention_action: str = PG_PARTITION_RETENTION_ACTION) -> bool:
+    """
+    Create the partitions from yesterday up to days_ahead days from today, and apply the retention if
+    retention_days is set. Runs in a single transaction. If another process is already doing maintenance,
+    this returns without doing anything.
+    :param today: current date (UTC), defaults to the actual date
+    :param retention_days: number of days to keep, including today, 0 to keep everything
+    :return: True if maintenance was done, False if another process was busy with it
+    """
+    if today is None:
+        today = datetime.utcnow().date()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute('select pg_try_advisory_xact_lock(%s)', (_ADVISORY_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                return False
+        created = create_partitions(connection, today - timedelta(days=1), today + timedelta(days=days_ahead))
+        removed = []
+        if retention_days:
+            removed = apply_retention(connection, today - timedelta(days=retention_days - 1), retention_action)
+    if created or removed:
+        print(f'Partitions created: {created}, {retention_action}: {removed}')
+    return True
+
+
+def maybe_maintain_partitions(connection):
+    """
+    Call maintain_partitions(), if PG_DATA_PARTITIONED is set and if it's PG_PARTITION_MAINTENANCE_SECONDS
+    since this process last did. Errors are printed, and maintenance is tried again next time.
+    """
+    global _last_maintenance
+    if not PG_DATA_PARTITIONED:
+        return
+    now = time.monotonic()
+    if _last_maintenance is not None and now - _last_maintenance < PG_PARTITION_MAINTENANCE_SECONDS:
+        return
+    _last_maintenance = now
+    try:
+        maintain_partitions(connection)
+    except Exception as exc:
+        print(f'Error maintaining partitions: {exc!r}')  # todo: real error logging
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create day partitions, and remove old ones, of the data '
+                                                 'and nok_data tables. Requires the partitioned layout.')
+    parser.add_argument('--days-ahead', type=int, default=PG_PARTITION_DAYS_AHEAD,
+                        help='number of days after today to create partitions for')
+    parser.add_argument('--retention-days', type=int, default=PG_PARTITION_RETENTION_DAYS,
+                        help='number of days to keep, including today. 0 to keep everything')
+    parser.add_argument('--retention-action', choices=RETENTION_ACTIONS, default=PG_PARTITION_RETENTION_ACTION,
+                        help='whether to drop or to detach old partitions')
+    args = parser.parse_args(sys.argv[1:])
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    connection = get_db_connection(pg_config)
+    try:
+        if not maintain_partitions(connection, days_ahead=args.days_ahead, retention_days=args.retention_days,
+                                   retention_action=args.retention_action):
+            print('Another process is maintaining the partitions, try again later')
+            sys.exit(1)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
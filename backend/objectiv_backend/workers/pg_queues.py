@@ -1,22 +1,58 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
+import os
+import select
 import uuid
+import zlib
 from enum import Enum
-from typing import List, Tuple
+from typing import Dict, List, Tuple, Sequence, Optional
 
-import psycopg2
 from psycopg2.extras import execute_values
 
+from objectiv_backend.common.config import PG_QUEUE_SHARDS
+from objectiv_backend.common.event_utils import EventJsonCache
 from objectiv_backend.common.types import EventDataList
 
+# Shards that the workers of this process take events from, see set_worker_shards(). None for all shards.
+_worker_shards: Optional[List[int]] = None
+# Per queue, the position in the worker shards from where the next get_events() call starts. Starts at a
+# different position per process, so that workers without their own shards don't all start at the same shard.
+_next_shard_position: Dict['ProcessingStage', int] = {}
+
 
 class ProcessingStage(Enum):
     ENTRY = "entry"
     FINALIZE = "finalize"
 
 
+def get_shard(event_id: str, shard_count: int = PG_QUEUE_SHARDS) -> int:
+    """ Give the queue shard of an event. """
+    return zlib.crc32(str(event_id).encode('utf-8')) % shard_count
+
+
+def get_worker_shards(number: int, worker_count: int, shard_count: int = PG_QUEUE_SHARDS) -> List[int]:
+    """
+    Divide the queue shards over the workers of a queue.
+    If there are more workers than shards, then multiple workers share a shard.
+    :param number: number of the worker, from 0 up to worker_count
+    :param worker_count: number of workers that take events from the queue
+    :return: the shards that the worker takes events from
+    """
+    if worker_count >= shard_count:
+        return [number % shard_count]
+    return list(range(number, shard_count, worker_count))
+
+
+def set_worker_shards(shards: Optional[Sequence[int]]):
+    """
+    Set the shards that the workers of this process take events from, in get_events(), get_queue_depth()
+    and listen(). None for all shards.
+    """
+    global _worker_shards
+    _worker_shards = None if shards is None else list(shards)
+
+
 class PostgresQueues:
     """
     Class to interact with the event queues in Postgres.
@@ -27,14 +63,24 @@ class PostgresQueues:
 
     This class assumes that the postgres connection has the isolation level ISOLATION_LEVEL_READ_COMMITTED
     set.
+
+    Adding events to a queue sends a notification on a channel with the same name as the queue's table.
+    Consumers can use listen() and wait_for_events() to wake up as soon as there are new events, instead of
+    polling the queue tables.
+
+    If the queues are sharded (PG_QUEUE_SHARDS), every queue consists of a table per shard. Events are put in
+    the shard of their event_id. Events are taken from the shards set with set_worker_shards(), starting
+    at the next shard on every call, so that workers don't contend for the head of the same table.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, shard_count: int = PG_QUEUE_SHARDS):
         """
         Create a new PostgresQueues object
         :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
+        :param shard_count: number of shards per queue
         """
         self.connection = connection
+        self.shard_count = shard_count
 
     @staticmethod
     def _queue_to_table(queue: ProcessingStage):
@@ -44,48 +90,136 @@ class PostgresQueues:
             return 'queue_finalize'
         raise Exception('Implementation incomplete')
 
+    def _shard_table(self, queue: ProcessingStage, shard: int) -> str:
+        table_name = self._queue_to_table(queue)
+        if self.shard_count == 1:
+            return table_name
+        return f'{table_name}_{shard}'
+
+    def _get_worker_shards(self) -> List[int]:
+        if _worker_shards is None:
+            return list(range(self.shard_count))
+        shards = [shard for shard in _worker_shards if shard < self.shard_count]
+        if not shards:
+            raise ValueError(f'None of the worker shards {_worker_shards} exists, '
+                             f'number of shards: {self.shard_count}')
+        return shards
+
+    def _worker_shard_tables(self, queue: ProcessingStage, rotate: bool = False) -> List[str]:
+        """
+        Give the tables of the worker shards.
+        :param rotate: if set, start at the shard that's next in turn, and move the turn to the shard after
+            it. Only get_events() should do this, so that every call takes events from the next shard first.
+        """
+        shards = self._get_worker_shards()
+        if not rotate:
+            return [self._shard_table(queue, shard) for shard in shards]
+        position = _next_shard_position.get(queue, os.getpid()) % len(shards)
+        _next_shard_position[queue] = position + 1
+        return [self._shard_table(queue, shard) for shard in shards[position:] + shards[:position]]
+
     def get_events(self, queue: ProcessingStage, max_items: int) -> EventDataList:
         """
         Get a list of events from a queue for processing.
 
         :param queue: Queue from which to pick events
         :param max_items: maximum number of items to pick from the queue.
-        :return: list of events with id, at most max_items, but can be less.
+        :return: list of events, at most max_items, but can be less.
         """
-        table_name = self._queue_to_table(queue)
-        query = f'''
-            delete from {table_name}
-            where event_id in (
-                select event_id
-                from {table_name}
-                order by insert_order asc
-                limit %s
-                for update skip locked
-            )
-            returning event_id, value;
-        '''
-        with self.connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
-            cursor.execute(query, (max_items, ))
-            events_with_id: EventDataList = cursor.fetchall()
-        return events_with_id
+        events: EventDataList = []
+        for table_name in self._worker_shard_tables(queue, rotate=True):
+            query = f'''
+                delete from {table_name}
+                where event_id in (
+                    select event_id
+                    from {table_name}
+                    order by insert_order asc
+                    limit %s
+                    for update skip locked
+                )
+                returning event_id, value;
+            '''
+            with self.connection.cursor() as cursor:
+                cursor.execute(query, (max_items - len(events), ))
+                # psycopg2 parses the json value column into a dict
+                events.extend(value for event_id, value in cursor.fetchall())
+            if len(events) >= max_items:
+                break
+        return events
+
+    def get_queue_depth(self, queue: ProcessingStage) -> int:
+        """
+        Give the approximate number of events in a queue, based on the insert_order of the oldest and newest
+        event. This can overestimate the depth, if events in between have already been removed.
+        Uses the index on insert_order, so this is cheap even if the queue is long.
+        If the queues are sharded, this is the depth of the worker shards.
+        """
+        query = ' union all '.join(
+            f'select coalesce(max(insert_order) - min(insert_order) + 1, 0) as depth from {table_name}'
+            for table_name in self._worker_shard_tables(queue))
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'select sum(depth) from ({query}) as depths')
+            return int(cursor.fetchone()[0])
 
     def put_events(self,
                    queue: ProcessingStage,
-                   events: EventDataList):
+                   events: EventDataList,
+                   json_cache: Optional[EventJsonCache] = None):
         """
         Put an event with a given event-id on a queue
 
         :param queue: Which queue to put the event on
         :param events: list of events with ids
+        :param json_cache: optional cache with the json serialization of the events, to share with other sinks
         """
         if not events:
             return
-        table_name = self._queue_to_table(queue)
-        insert_query = f'''
-            insert into
-            {table_name}(event_id, value)
-            values %s
-            '''
-        values: List[Tuple[uuid.UUID, str]] = [(event['id'], json.dumps(event)) for event in events]
+        if json_cache is None:
+            json_cache = EventJsonCache()
+        values_per_shard: Dict[int, List[Tuple[uuid.UUID, str]]] = {}
+        for event in events:
+            shard = get_shard(event['id'], self.shard_count) if self.shard_count > 1 else 0
+            values_per_shard.setdefault(shard, []).append((event['id'], json_cache.get_json(event)))
         with self.connection.cursor() as cursor:
-            execute_values(cursor, insert_query, values, template=None, page_size=100)
+            for shard, values in sorted(values_per_shard.items()):
+                table_name = self._shard_table(queue, shard)
+                insert_query = f'''
+                    insert into
+                    {table_name}(event_id, value)
+                    values %s
+                    '''
+                execute_values(cursor, insert_query, values, template=None, page_size=100)
+                # The notification is only delivered when the transaction commits, and multiple notifications
+                # in the same transaction are folded into one.
+                cursor.execute(f'notify {table_name}')
+
+    def listen(self, queues: Sequence[ProcessingStage]):
+        """
+        Subscribe to notifications of new events on the given queues, or on the worker shards of the queues.
+        LISTEN only takes effect when the transaction commits, so the calling code must commit after this.
+        """
+        with self.connection.cursor() as cursor:
+            for queue in queues:
+                for shard in self._get_worker_shards():
+                    cursor.execute(f'listen {self._shard_table(queue, shard)}')
+
+    def wait_for_events(self, timeout: float) -> bool:
+        """
+        Block until there is a notification of new events on one of the queues that we listen() to, or
+        until timeout seconds have passed. Must be called outside a transaction, as notifications are only
+        delivered between transactions.
+
+        A notification doesn't guarantee that there are events to get, another consumer might have
+        picked them already.
+
+        :param timeout: maximum number of seconds to wait
+        :return: True if a notification was received, False if the timeout expired
+        """
+        # Notifications might already have been received while executing earlier queries
+        if not self.connection.notifies:
+            if select.select([self.connection], [], [], timeout) == ([], [], []):
+                return False
+            self.connection.poll()
+        received = bool(self.connection.notifies)
+        del self.connection.notifies[:]
+        return received
@@ -0,0 +1,227 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Per day rollups of the events in the data table, so that the number of events and users per day don't
+have to be computed from the raw events:
+ * daily_event_counts: number of events per day, application and event type
+ * daily_cookies: HyperLogLog sketch of the distinct cookies per day and application
+
+If PG_ROLLUPS_ENABLED is set, the finalize worker updates the rollups incrementally, in the transaction that
+inserts the events into data, see update_rollups(). The collector doesn't, so in sync mode the rollups have to
+be recounted from the data table instead, with `objectiv-rollups` on a schedule. That's also how events that
+were written before the rollups were enabled are counted, see rebuild_rollups().
+
+To keep concurrent transactions from blocking each other on the same rows, every transaction claims a shard of
+the rows that no other transaction is using, with an advisory lock. Queries have to combine the shards, e.g.
+with the daily_events and daily_users views in create_tables_upgrade.sql.
+
+HyperLogLog sketches can be merged by taking the maximum of each register. So the distinct cookies of
+multiple shards, applications or days can be estimated with hll_estimate(hll_union_agg(registers)).
+"""
+import argparse
+import math
+import os
+import sys
+from collections import Counter
+from datetime import date, datetime, timedelta
+from hashlib import blake2b
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from objectiv_backend.common.config import get_config_postgres, PG_ROLLUP_SHARDS
+from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.common.event_utils import get_optional_context
+from objectiv_backend.common.types import EventDataList
+
+# Number of bits of the hash that select the register. The sketches have 2^HLL_PRECISION registers, which
+# gives a standard error of about 1.6%.
+HLL_PRECISION = 12
+HLL_REGISTER_COUNT = 1 << HLL_PRECISION
+_HASH_BITS = 64
+
+# First key of the per shard advisory locks, the second key is the shard.
+_ADVISORY_LOCK_NAMESPACE = 0x726f6c6c  # 'roll'
+
+
+def get_hll_registers(values: Sequence[str]) -> List[int]:
+    """ Give the HyperLogLog registers of the distinct values. """
+    registers = [0] * HLL_REGISTER_COUNT
+    for value in values:
+        hashed = int.from_bytes(blake2b(value.encode('utf-8'), digest_size=_HASH_BITS // 8).digest(), 'big')
+        index = hashed >> (_HASH_BITS - HLL_PRECISION)
+        remaining = hashed & ((1 << (_HASH_BITS - HLL_PRECISION)) - 1)
+        # position of the first 1-bit in the remaining bits
+        rank = _HASH_BITS - HLL_PRECISION - remaining.bit_length() + 1
+        registers[index] = max(registers[index], rank)
+    return registers
+
+
+def hll_estimate(registers: Sequence[int]) -> float:
+    """ Estimate the number of distinct values of HyperLogLog registers. Same as hll_estimate() in SQL. """
+    count = len(registers)
+    raw_estimate = (0.7213 / (1 + 1.079 / count)) * count ** 2 / sum(2.0 ** -register for register in registers)
+    zeros = sum(1 for register in registers if register == 0)
+    if raw_estimate <= 2.5 * count and zeros:
+        # linear counting is more accurate for small numbers of values
+        return count * math.log(count / zeros)
+    return raw_estimate
+
+
+def update_rollups(connection, events: EventDataList, shard: Optional[int] = None):
+    """
+    Add events that were inserted into the data table to the rollups.
+
+    Does not do any transaction management, this should be called in the same transaction that inserts the
+    events into data, so that every event is counted exactly once.
+
+    :param connection: psycopg2 database connection
+    :param events: events that were inserted into data. Each event must have a CookieIdContext
+    :param shard: shard of the rollup rows to update, defaults to a shard that no other transaction is using,
+        see claim_shard()
+    """
+    if not events:
+        return
+    if shard is None:
+        shard = claim_shard(connection)
+    event_counts: Counter = Counter()
+    cookie_ids: Dict[Tuple[date, str], List[str]] = {}
+    for event in events:
+        day = datetime.utcfromtimestamp(event['time'] // 1000).date()
+        application_context = get_optional_context(event, 'ApplicationContext')
+        application = str(application_context['id']) if application_context else ''
+        event_counts[(day, application, event['_type'])] += 1
+        cookie_id = get_optional_context(event, 'CookieIdContext')
+        if cookie_id:
+            cookie_ids.setdefault((day, application), []).append(str(cookie_id['cookie_id']))
+
+    # Rows are updated in the order of their keys, so that concurrent transactions can't deadlock.
+    counts_keys = sorted(event_counts.keys())
+    cookies_keys = sorted(cookie_ids.keys())
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            insert into daily_event_counts(day, application, event_type, shard, event_count)
+            select day, application, event_type, %(shard)s, event_count
+            from unnest(%(days)s::date[], %(applications)s::text[], %(event_types)s::text[],
+                        %(event_counts)s::bigint[]) as counts(day, application, event_type, event_count)
+            on conflict(day, application, event_type, shard) do update
+            set event_count = daily_event_counts.event_count + excluded.event_count
+        ''', {
+            'shard': shard,
+            'days': [key[0] for key in counts_keys],
+            'applications': [key[1] for key in counts_keys],
+            'event_types': [key[2] for key in counts_keys],
+            'event_counts': [event_counts[key] for key in counts_keys],
+        })
+        if cookies_keys:
+            cursor.execute('''
+                insert into daily_cookies(day, application, shard, registers)
+                select day, application, %(shard)s, registers::smallint[]
+                from unnest(%(days)s::date[], %(applications)s::text[], %(registers)s::text[])
+                    as cookies(day, application, registers)
+                on conflict(day, application, shard) do update
+                set registers = hll_union(daily_cookies.registers, excluded.registers)
+            ''', {
+                'shard': shard,
+                'days': [key[0] for key in cookies_keys],
+                'applications': [key[1] for key in cookies_keys],
+                'registers': [_registers_to_sql(get_hll_registers(cookie_ids[key])) for key in cookies_keys],
+            })
+
+
+def claim_shard(connection, shard_count: int = PG_ROLLUP_SHARDS) -> int:
+    """
+    Give a shard of the rollup rows that no other transaction is updating, and make sure none will until this
+    transaction ends, with a transaction level advisory lock.
+
+    The shards are tried starting from a shard per process, so that the shards of concurrent processes
+    usually differ on the first try. If all shards are in use, i.e. if more than shard_count transactions
+    update the rollups at the same time, this waits for the lock on the shard of the process.
+    """
+    start = os.getpid() % shard_count
+    with connection.cursor() as cursor:
+        # The shards are tried one at a time, until a lock is acquired.
+        cursor.execute('''
+            select (%(start)s + number) %% %(shard_count)s
+            from generate_series(0, %(shard_count)s - 1) as number
+            where pg_try_advisory_xact_lock(%(namespace)s, (%(start)s + number) %% %(shard_count)s)
+            limit 1
+        ''', {'start': start, 'shard_count': shard_count, 'namespace': _ADVISORY_LOCK_NAMESPACE})
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        cursor.execute('select pg_advisory_xact_lock(%s, %s)', (_ADVISORY_LOCK_NAMESPACE, start))
+    return start
+
+
+def rebuild_rollups(connection,
+                    first_day: Optional[date] = None,
+                    batch_size: int = 10000,
+                    shard_count: int = PG_ROLLUP_SHARDS) -> int:
+    """
+    Count the events in the data table again, replacing the rollups of the days that have events. Commits a
+    transaction per day, while collector and workers can keep adding events.
+
+    Every transaction first locks all shards, so the finalize worker can't add events of the day to the
+    rollups at the same time. Events that it inserted, but didn't add to the rollups yet, are not visible to
+    this transaction, and are added by the worker after this transaction ends. So every event is still
+    counted exactly once.
+
+    :param connection: psycopg2 database connection
+    :param first_day: first day to count the events of, defaults to all days
+    :param batch_size: number of events to read from the data table at a time
+    :param shard_count: number of shards that update_rollups() uses
+    :return: number of events that were counted
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute('select distinct day from data where day >= %s order by day',
+                           (first_day or date.min, ))
+            days = [row[0] for row in cursor.fetchall()]
+    event_count = 0
+    for day in days:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select pg_advisory_xact_lock(%s, shard) from generate_series(0, %s - 1) as shard',
+                               (_ADVISORY_LOCK_NAMESPACE, shard_count))
+                cursor.execute('delete from daily_event_counts where day = %s', (day, ))
+                cursor.execute('delete from daily_cookies where day = %s', (day, ))
+            # a named cursor reads the events in batches, instead of all events of the day at once
+            with connection.cursor(name='rebuild_rollups') as cursor:
+                cursor.execute('select value from data where day = %s', (day, ))
+                while True:
+                    events = [row[0] for row in cursor.fetchmany(batch_size)]
+                    if not events:
+                        break
+                    update_rollups(connection, events, shard=0)
+                    event_count += len(events)
+    return event_count
+
+
+def _registers_to_sql(registers: List[int]) -> str:
+    """ Give the registers as a postgres array literal. """
+    return '{' + ','.join(str(register) for register in registers) + '}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the events in the data table again, replacing the '
+                                                 'rollups. Can be run on a schedule.')
+    parser.add_argument('--days', type=int, default=None,
+                        help='number of days before today to count the events of. Default is all days')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of events to read from the data table at a time')
+    args = parser.parse_args(sys.argv[1:])
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    first_day = None
+    if args.days is not None:
+        first_day = datetime.utcnow().date() - timedelta(days=args.days)
+    connection = get_db_connection(pg_config)
+    try:
+        event_count = rebuild_rollups(connection, first_day=first_day, batch_size=args.batch_size)
+        print(f'Counted {event_count} events')
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
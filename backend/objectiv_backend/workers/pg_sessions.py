@@ -0,0 +1,263 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Sessionizer: maintains the sessions table, with the session_id and session_hit_number of every event in the
+data table.
+
+Events of the same cookie are in the same session if they are less than PG_SESSION_GAP_SECONDS apart. The
+session_id is the event_id of the first event of the session, and session_hit_number is the position of an
+event in its session, starting at 1. Both are ordered on (moment, event_id).
+
+Sessionizing is not done in the transactions that insert events into data, so that those don't have to wait
+for each other. Instead, sessionize_new_events() periodically sessionizes the events of the last
+PG_SESSION_LOOKBACK_DAYS days that are not in the sessions table yet. The finalize worker does this every
+PG_SESSION_INTERVAL_SECONDS if PG_SESSIONS_ENABLED is set, see maybe_sessionize(). Without workers, e.g. in
+sync mode, `objectiv-sessions` can be run on a schedule instead.
+
+update_sessions() re-sessionizes only the affected part of the cookies with new events. Adding an event can
+only merge sessions, or start a new session with the new event, so for a cookie with new events between
+first_moment and last_moment this is:
+ * from the start of the session of the last existing event at or before first_moment, or from first_moment
+   if there is no such event,
+ * up to the first existing session that starts more than the gap after last_moment, which is unaffected.
+This also handles events that arrive late, or out of order.
+
+The sessions table can be rebuilt from the data table with `objectiv-sessions --rebuild`, e.g. after changing
+PG_SESSION_GAP_SECONDS, or to sessionize events that are older than the lookback period.
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from objectiv_backend.common.config import get_config_postgres, PG_SESSION_GAP_SECONDS, PG_SESSIONS_ENABLED, \
+    PG_SESSION_INTERVAL_SECONDS, PG_SESSION_LOOKBACK_DAYS
+from objectiv_backend.common.db import get_db_connection
+
+# First key of the per cookie advisory locks, the second key is the hash of the cookie_id.
+_ADVISORY_LOCK_NAMESPACE = 0x73657373  # 'sess'
+# Key of the advisory lock that makes sure only one process at a time sessionizes new events.
+_SESSIONIZER_LOCK_KEY = 0x6f626a73  # 'objs'
+
+_last_sessionize: Optional[float] = None
+
+_SESSIONIZE_QUERY = '''
+    with new_events(cookie_id, first_moment, last_moment) as (
+        select * from unnest(%(cookie_ids)s::uuid[], %(first_moments)s::timestamp[], %(last_moments)s::timestamp[])
+    ),
+    windows as (
+        select
+            new_events.cookie_id,
+            coalesce((
+                select session_start.moment
+                from sessions as previous
+                inner join sessions as session_start on session_start.event_id = previous.session_id
+                where previous.cookie_id = new_events.cookie_id and previous.moment <= new_events.first_moment
+                order by previous.moment desc, previous.event_id desc
+                limit 1
+            ), new_events.first_moment) as window_start,
+            (
+                select min(next_session.moment)
+                from sessions as next_session
+                where next_session.cookie_id = new_events.cookie_id
+                  and next_session.session_hit_number = 1
+                  and next_session.moment > new_events.last_moment + %(gap_seconds)s * interval '1 second'
+            ) as window_end
+        from new_events
+    ),
+    window_events as (
+        select
+            data.event_id,
+            data.cookie_id,
+            data.moment,
+            coalesce(
+                data.moment - lag(data.moment) over cookie_events > %(gap_seconds)s * interval '1 second',
+                true
+            ) as is_start_of_session
+        from windows
+        inner join data on data.cookie_id = windows.cookie_id
+            and data.moment >= windows.window_start
+            and (windows.window_end is null or data.moment < windows.window_end)
+        window cookie_events as (partition by data.cookie_id order by data.moment, data.event_id)
+    ),
+    numbered_events as (
+        select
+            *,
+            count(*) filter (where is_start_of_session)
+                over (partition by cookie_id order by moment, event_id) as session_number
+        from window_events
+    )
+    insert into sessions(event_id, cookie_id, moment, session_id, session_hit_number)
+    select
+        event_id,
+        cookie_id,
+        moment,
+        first_value(event_id) over session_events,
+        row_number() over session_events
+    from numbered_events
+    window session_events as (partition by cookie_id, session_number order by moment, event_id)
+    on conflict(event_id) do update
+    set session_id = excluded.session_id, session_hit_number = excluded.session_hit_number
+    where (sessions.session_id, sessions.session_hit_number)
+        is distinct from (excluded.session_id, excluded.session_hit_number)
+'''
+
+
+def update_sessions(connection,
+                    cookie_moments: Iterable[Tuple[str, datetime]],
+                    gap_seconds: float = PG_SESSION_GAP_SECONDS):
+    """
+    Sessionize events that were inserted into the data table, and the existing events of their cookies that
+    are affected by that.
+
+    Does not do any transaction management, this should be called in the same transaction that inserts the
+    events into data. To make sure that concurrent transactions see each other's events, this takes a
+    transaction level advisory lock per cookie, which might block until the other transaction is done.
+
+    :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
+    :param cookie_moments: cookie_id and moment of the inserted events
+    :param gap_seconds: maximum time between two events of the same session
+    """
+    windows: Dict[str, Tuple[datetime, datetime]] = {}
+    for cookie_id, moment in cookie_moments:
+        first_moment, last_moment = windows.get(cookie_id, (moment, moment))
+        windows[cookie_id] = (min(first_moment, moment), max(last_moment, moment))
+    if windows:
+        _sessionize(connection, windows, gap_seconds)
+
+
+def sessionize_new_events(connection,
+                          since: datetime,
+                          gap_seconds: float = PG_SESSION_GAP_SECONDS,
+                          batch_size: int = 1000) -> Optional[int]:
+    """
+    Sessionize the events in the data table from the day of since onwards that are not in the sessions table
+    yet. Commits a transaction per batch of cookies. If another process is already doing this, this returns
+    without doing anything.
+    :return: number of sessionized cookies, None if another process was busy sessionizing
+    """
+    cookie_count = 0
+    while True:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select pg_try_advisory_xact_lock(%s)', (_SESSIONIZER_LOCK_KEY, ))
+                if not cursor.fetchone()[0]:
+                    return None if cookie_count == 0 else cookie_count
+                cursor.execute('''
+                    select data.cookie_id, min(data.moment), max(data.moment)
+                    from data
+                    where data.day >= %(since)s
+                      and not exists (select from sessions where sessions.event_id = data.event_id)
+                    group by data.cookie_id
+                    order by data.cookie_id
+                    limit %(batch_size)s
+                ''', {'since': since.date(), 'batch_size': batch_size})
+                rows = cursor.fetchall()
+            cookie_moments = [(str(cookie_id), moment) for cookie_id, first_moment, last_moment in rows
+                              for moment in (first_moment, last_moment)]
+            update_sessions(connection, cookie_moments, gap_seconds)
+        cookie_count += len(rows)
+        if len(rows) < batch_size:
+            return cookie_count
+
+
+def maybe_sessionize(connection):
+    """
+    Call sessionize_new_events() for the last PG_SESSION_LOOKBACK_DAYS days, if PG_SESSIONS_ENABLED is set and
+    if it's PG_SESSION_INTERVAL_SECONDS since this process last did. Errors are printed, and sessionizing is
+    tried again next time.
+    """
+    global _last_sessionize
+    if not PG_SESSIONS_ENABLED:
+        return
+    now = time.monotonic()
+    if _last_sessionize is not None and now - _last_sessionize < PG_SESSION_INTERVAL_SECONDS:
+        return
+    _last_sessionize = now
+    try:
+        cookie_count = sessionize_new_events(connection,
+                                             since=datetime.utcnow() - timedelta(days=PG_SESSION_LOOKBACK_DAYS))
+        if cookie_count:
+            print(f'Sessionized the new events of {cookie_count} cookies')
+    except Exception as exc:
+        print(f'Error sessionizing events: {exc!r}')  # todo: real error logging
+
+
+def rebuild_sessions(connection, gap_seconds: float = PG_SESSION_GAP_SECONDS, batch_size: int = 1000) -> int:
+    """
+    Sessionize all events in the data table again. Commits a transaction per batch of cookies, while
+    collector and workers can keep adding events.
+    :return: number of cookies
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute('select distinct cookie_id from data')
+            cookie_ids = sorted(str(row[0]) for row in cursor.fetchall())
+    for start in range(0, len(cookie_ids), batch_size):
+        batch = cookie_ids[start:start + batch_size]
+        with connection:
+            _lock_cookies(connection, batch)
+            with connection.cursor() as cursor:
+                cursor.execute('delete from sessions where cookie_id = any(%s::uuid[])', (batch, ))
+            _sessionize(connection, {cookie_id: (datetime.min, datetime.max) for cookie_id in batch}, gap_seconds)
+    return len(cookie_ids)
+
+
+def _sessionize(connection, windows: Dict[str, Tuple[datetime, datetime]], gap_seconds: float):
+    cookie_ids = sorted(windows.keys())
+    _lock_cookies(connection, cookie_ids)
+    parameters = {
+        'cookie_ids': cookie_ids,
+        'first_moments': [windows[cookie_id][0] for cookie_id in cookie_ids],
+        'last_moments': [windows[cookie_id][1] for cookie_id in cookie_ids],
+        'gap_seconds': gap_seconds,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(_SESSIONIZE_QUERY, parameters)
+
+
+def _lock_cookies(connection, cookie_ids: List[str]):
+    # The locks are taken in the order of their keys, so that concurrent transactions can't deadlock. The
+    # locks are released at the end of the transaction, after which the other transaction sees the
+    # committed events.
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            select pg_advisory_xact_lock(%s, lock_key)
+            from (select distinct hashtext(cookie_id) as lock_key from unnest(%s::text[]) as cookie_id) as keys
+            order by lock_key
+        ''', (_ADVISORY_LOCK_NAMESPACE, cookie_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sessionize the events in the data table that are not in the '
+                                                 'sessions table yet. Can be run on a schedule.')
+    parser.add_argument('--rebuild', default=False, action='store_true',
+                        help='sessionize all events again, e.g. after changing PG_SESSION_GAP_SECONDS')
+    parser.add_argument('--lookback-days', type=int, default=PG_SESSION_LOOKBACK_DAYS,
+                        help='number of days before today to sessionize new events of. Default is set by '
+                             'PG_SESSION_LOOKBACK_DAYS. Ignored with --rebuild')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='number of cookies to sessionize per transaction')
+    args = parser.parse_args(sys.argv[1:])
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    connection = get_db_connection(pg_config)
+    try:
+        if args.rebuild:
+            cookie_count = rebuild_sessions(connection, batch_size=args.batch_size)
+            print(f'Sessionized the events of {cookie_count} cookies')
+            return
+        since = datetime.utcnow() - timedelta(days=args.lookback_days)
+        new_cookie_count = sessionize_new_events(connection, since=since, batch_size=args.batch_size)
+        if new_cookie_count is None:
+            print('Another process is sessionizing the events, try again later')
+            sys.exit(1)
+        print(f'Sessionized the new events of {new_cookie_count} cookies')
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,22 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
+import csv
 from datetime import datetime, timedelta
-
+from io import StringIO
+from typing import Any, List, Set, Tuple, Optional
 
 from psycopg2.extras import execute_values
 
-from objectiv_backend.common.event_utils import get_context
-from objectiv_backend.common.types import FailureReason, EventDataList
+from objectiv_backend.common.config import PG_COPY_MIN_EVENTS, PG_COPY_BATCH_SIZE, PG_DATA_PARTITIONED
+from objectiv_backend.common.event_utils import get_context, EventJsonCache
+from objectiv_backend.common.types import FailureReason, EventDataList, EventData
+from objectiv_backend.workers.recent_event_ids import get_recent_event_ids
 
 
-def insert_events_into_data(connection, events: EventDataList):
+def insert_events_into_data(connection,
+                            events: EventDataList,
+                            json_cache: Optional[EventJsonCache] = None) -> EventDataList:
     """
     Insert events into the 'data' table.
 
@@ -25,15 +30,34 @@ def insert_events_into_data(connection, events: EventDataList):
     fail if the blocking exceeds the lock_timeout. To minimize impact of blocks and rollbacks, try to keep
     transactions that use this function short and do not insert too much data in one call
 
+    To avoid blocking on duplicates that are resent by trackers, events with an event_id that this process
+    inserted recently (see recent_event_ids) are first looked up with a select. The ones that are found are
+    inserted into nok_data right away.
+
     This function assumes that the postgres connection has the isolation level
     ISOLATION_LEVEL_READ_COMMITTED set and a lock_timeout is configured.
 
     :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
     :param events: EventDataList, list of events. Each event must be a valid Event, and must have a CookieIdContext
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
+    :return: the events that were inserted into data, i.e. without the duplicates
     :raise Exception: If the database is not available, or if it blocks longer than lock_timeout.
     """
     if not events:
-        return
+        return []
+    if json_cache is None:
+        json_cache = EventJsonCache()
+
+    # Events that were recently inserted by this process, are likely to be duplicates of events that are
+    # already in the data table. Check these first with a select, which doesn't block.
+    duplicate_events: EventDataList = []
+    recent_event_ids = get_recent_event_ids()
+    if recent_event_ids is not None:
+        known_event_ids = _get_known_event_ids(
+            connection, [str(event['id']) for event in events if recent_event_ids.contains(str(event['id']))])
+        if known_event_ids:
+            duplicate_events = [event for event in events if str(event['id']) in known_event_ids]
+            events = [event for event in events if str(event['id']) not in known_event_ids]
 
     # We use 'on conflict do nothing'. With the read-committed isolation level this guarantees that this
     # transaction will not insert a row that will conflict with another transaction, even if the results
@@ -50,67 +74,197 @@ def insert_events_into_data(connection, events: EventDataList):
     #
     # [1] https://www.postgresql.org/docs/13/transaction-iso.html
     # [2] https://www.postgresql.org/docs/13/sql-insert.html
-    insert_query = f'''
-        insert into data(event_id, day, moment, cookie_id, value)
-        values %s
-        on conflict(event_id) do nothing
-        returning event_id
-    '''
-    values = []
-    for event in events:
-        timestamp = _millis_to_datetime(event['time'])
-        cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
-        value = (event['id'],
-                 timestamp,
-                 timestamp,
-                 cookie_id,
-                 json.dumps(event))
-        values.append(value)
-    with connection.cursor() as cursor:
-        inserted_event_ids = execute_values(
-            cursor, insert_query, values, template=None, page_size=100, fetch=True)
+    #
+    # For large lists of events we first COPY the events into a temporary staging table, and then insert
+    # them from there into the data table with a single 'insert ... select ... on conflict do nothing'.
+    # This has the same conflict behaviour as the multi-row insert, but takes far fewer round trips.
+    #
+    # If the data table is partitioned by day (PG_DATA_PARTITIONED), its primary key can't guarantee unique
+    # event_ids, so the 'on conflict do nothing' is done on the data_event_id table instead, and only the
+    # events of which the event_id was inserted there are inserted into data. If an event_id occurs multiple
+    # times in events, then the first event is inserted.
+    if not events:
+        inserted_event_ids: Set[str] = set()
+    elif len(events) >= PG_COPY_MIN_EVENTS:
+        inserted_event_ids = _copy_events_into_data(connection, events, json_cache)
+    else:
+        values = [_event_to_row(event, json_cache) for event in events]
+        template = None
+        if PG_DATA_PARTITIONED:
+            insert_query = '''
+                with new_rows(position, event_id, day, moment, cookie_id, value) as (values %s),
+                new_event_ids as (
+                    insert into data_event_id(event_id, day)
+                    select event_id, day from new_rows
+                    on conflict(event_id) do nothing
+                    returning event_id
+                )
+                insert into data(event_id, day, moment, cookie_id, value)
+                select distinct on (new_rows.event_id) new_rows.event_id, day, moment, cookie_id, value
+                from new_rows
+                inner join new_event_ids on new_event_ids.event_id = new_rows.event_id
+                order by new_rows.event_id, position
+                returning event_id
+            '''
+            template = '(%s, %s::uuid, %s::date, %s::timestamp, %s::uuid, %s::json)'
+            values = [(position, ) + row for position, row in enumerate(values)]
+        else:
+            insert_query = '''
+                insert into data(event_id, day, moment, cookie_id, value)
+                values %s
+                on conflict(event_id) do nothing
+                returning event_id
+            '''
+        with connection.cursor() as cursor:
+            inserted_event_ids = {
+                str(row[0]) for row in
+                execute_values(cursor, insert_query, values, template=template, page_size=100, fetch=True)
+            }
 
     # Determine whether there were any duplicate events that were already in the table
     # In case of duplicate events, we'll add those to the nok_data table for traceability
-    duplicate_events: EventDataList = []
+    inserted_events = events
     if len(inserted_event_ids) < len(events):
-        inserted_event_ids_set = set(inserted_event_ids)
+        # If the same event_id occurs multiple times in events, then only the first one was inserted.
+        inserted_events = []
         for event in events:
-            if event['id'] not in inserted_event_ids_set:
+            event_id = str(event['id'])
+            if event_id in inserted_event_ids:
+                inserted_event_ids.remove(event_id)
+                inserted_events.append(event)
+            else:
                 duplicate_events.append(event)
+    if recent_event_ids is not None:
+        # If this transaction is rolled back, the filter contains event_ids that are not in the data table.
+        # That's fine, as the select above will not find them.
+        recent_event_ids.add(str(event['id']) for event in events)
     if duplicate_events:
         print(f'Duplicate events found, count: {len(duplicate_events)}. '
               f'Will be inserted in nok_data table.')
-        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE)
+        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE,
+                                    json_cache=json_cache)
+    return inserted_events
+
+
+def _get_known_event_ids(connection, event_ids: List[str]) -> Set[str]:
+    """
+    Give the event_ids that are in the data table. Only sees committed events, and doesn't block.
+    """
+    if not event_ids:
+        return set()
+    table_name = 'data_event_id' if PG_DATA_PARTITIONED else 'data'
+    with connection.cursor() as cursor:
+        cursor.execute(f'select event_id from {table_name} where event_id = any(%s::uuid[])', (event_ids, ))
+        return {str(row[0]) for row in cursor.fetchall()}
+
+
+def _copy_events_into_data(connection, events: EventDataList, json_cache: EventJsonCache) -> Set[str]:
+    """
+    Insert events into the 'data' table, using COPY into a staging table.
+    Has the same semantics as the multi-row insert in insert_events_into_data().
+    :return: set with the event_ids, as strings, of all events that were inserted.
+    """
+    # The staging table is created once per database session, and emptied at the end of each transaction.
+    # It's truncated at the start in case this function is called multiple times in one transaction.
+    staging_query = '''
+        create temporary table if not exists staging_data (
+            event_id uuid not null,
+            day date not null,
+            moment timestamp not null,
+            cookie_id uuid not null,
+            value json not null,
+            position bigserial
+        ) on commit delete rows;
+        truncate staging_data;
+    '''
+    copy_query = '''
+        copy staging_data(event_id, day, moment, cookie_id, value) from stdin with (format csv)
+    '''
+    if PG_DATA_PARTITIONED:
+        insert_query = '''
+            with new_event_ids as (
+                insert into data_event_id(event_id, day)
+                select event_id, day from staging_data
+                on conflict(event_id) do nothing
+                returning event_id
+            )
+            insert into data(event_id, day, moment, cookie_id, value)
+            select distinct on (staging_data.event_id) staging_data.event_id, day, moment, cookie_id, value
+            from staging_data
+            inner join new_event_ids on new_event_ids.event_id = staging_data.event_id
+            order by staging_data.event_id, position
+            returning event_id
+        '''
+    else:
+        insert_query = '''
+            insert into data(event_id, day, moment, cookie_id, value)
+            select event_id, day, moment, cookie_id, value
+            from staging_data
+            on conflict(event_id) do nothing
+            returning event_id
+        '''
+    inserted_event_ids: Set[str] = set()
+    with connection.cursor() as cursor:
+        for start in range(0, len(events), PG_COPY_BATCH_SIZE):
+            rows = [_event_to_row(event, json_cache) for event in events[start:start + PG_COPY_BATCH_SIZE]]
+            cursor.execute(staging_query)
+            cursor.copy_expert(copy_query, _rows_to_csv(rows))
+            cursor.execute(insert_query)
+            inserted_event_ids.update(str(row[0]) for row in cursor.fetchall())
+    return inserted_event_ids
 
 
 def insert_events_into_nok_data(connection,
                                 events: EventDataList,
-                                reason: FailureReason = FailureReason.FAILED_VALIDATION):
+                                reason: FailureReason = FailureReason.FAILED_VALIDATION,
+                                json_cache: Optional[EventJsonCache] = None):
     """
     Insert events into the not-ok data ('nok_data') table
     Does not do any transaction management, this merely issues insert commands.
     :param connection: db connection
     :param events: EventDataList, list of events. Each event must have a CookieIdContext
     :param reason: Why are these events written to the nok_data table.
+    :param json_cache: optional cache with the json serialization of the events, to share with other sinks
     """
     if not events:
         return
+    if json_cache is None:
+        json_cache = EventJsonCache()
 
-    insert_query = f'insert into nok_data (event_id, day, moment, cookie_id, value, reason) values %s'
-    values = []
-    for event in events:
-        timestamp = _millis_to_datetime(event['time'])
-        cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
-        value = (event['id'],
-                 timestamp,
-                 timestamp,
-                 cookie_id,
-                 json.dumps(event),
-                 reason.value)
-        values.append(value)
+    values = [_event_to_row(event, json_cache) + (reason.value, ) for event in events]
     with connection.cursor() as cursor:
-        execute_values(cursor, insert_query, values, template=None, page_size=100)
+        if len(events) >= PG_COPY_MIN_EVENTS:
+            # There are no constraints on nok_data, so we can COPY directly into the table.
+            copy_query = '''
+                copy nok_data(event_id, day, moment, cookie_id, value, reason) from stdin with (format csv)
+            '''
+            for start in range(0, len(values), PG_COPY_BATCH_SIZE):
+                cursor.copy_expert(copy_query, _rows_to_csv(values[start:start + PG_COPY_BATCH_SIZE]))
+        else:
+            insert_query = f'insert into nok_data (event_id, day, moment, cookie_id, value, reason) values %s'
+            execute_values(cursor, insert_query, values, template=None, page_size=100)
+
+
+def _event_to_row(event: EventData, json_cache: EventJsonCache) -> Tuple[Any, ...]:
+    """ Give the values for the columns event_id, day, moment, cookie_id, and value for an event. """
+    timestamp = _millis_to_datetime(event['time'])
+    cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
+    return (event['id'],
+            timestamp,
+            timestamp,
+            cookie_id,
+            json_cache.get_json(event))
+
+
+def _rows_to_csv(rows: List[Tuple[Any, ...]]) -> StringIO:
+    """
+    Write rows to an in-memory file, in the csv format that COPY ... with (format csv) expects.
+    All values must be non-null.
+    """
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return buffer
 
 
 def _millis_to_datetime(millis: int) -> datetime:
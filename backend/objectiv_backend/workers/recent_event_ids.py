@@ -0,0 +1,79 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+In-process filter of recently seen event_ids, used to detect duplicate events before inserting them.
+
+Trackers retry requests, and replay their offline queues, so the same events are often sent multiple
+times, usually within a short time. Inserting such a duplicate into the data table can block until the
+transaction that inserted the original commits, see insert_events_into_data(). Events whose event_id is in
+the filter are checked with a plain select first, which doesn't block. The database stays the authority: an
+event is only treated as a duplicate if the select finds its event_id, so ids of events that were never
+committed, or that are no longer in the filter, are harmless.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from objectiv_backend.common.config import PG_RECENT_EVENT_IDS_SIZE, PG_RECENT_EVENT_IDS_SECONDS
+
+
+class RecentEventIds:
+    """
+    Bounded set of event_ids, that forgets the least recently added ids when it's full, and ids that were
+    added more than max_seconds ago. Thread-safe.
+    """
+
+    def __init__(self, max_size: int, max_seconds: float):
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self._added_at: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._added_at)
+
+    def add(self, event_ids: Iterable[str]):
+        """ Add event_ids, or refresh them if they were already added. """
+        now = time.monotonic()
+        with self._lock:
+            for event_id in event_ids:
+                self._added_at[event_id] = now
+                self._added_at.move_to_end(event_id)
+            while len(self._added_at) > self.max_size:
+                self._added_at.popitem(last=False)
+            self._expire(now)
+
+    def contains(self, event_id: str) -> bool:
+        with self._lock:
+            self._expire(time.monotonic())
+            return event_id in self._added_at
+
+    def _expire(self, now: float):
+        # ids are ordered on the time they were added, so the expired ids are at the start
+        while self._added_at:
+            event_id, added_at = next(iter(self._added_at.items()))
+            if now - added_at <= self.max_seconds:
+                break
+            del self._added_at[event_id]
+
+
+_RECENT_EVENT_IDS: Dict[int, RecentEventIds] = {}
+_RECENT_EVENT_IDS_LOCK = threading.Lock()
+
+
+def get_recent_event_ids() -> Optional[RecentEventIds]:
+    """
+    Give the RecentEventIds of the current process, or None if PG_RECENT_EVENT_IDS_SIZE is 0.
+    """
+    if PG_RECENT_EVENT_IDS_SIZE <= 0:
+        return None
+    pid = os.getpid()
+    with _RECENT_EVENT_IDS_LOCK:
+        recent_event_ids = _RECENT_EVENT_IDS.get(pid)
+        if recent_event_ids is None:
+            recent_event_ids = RecentEventIds(max_size=PG_RECENT_EVENT_IDS_SIZE,
+                                              max_seconds=PG_RECENT_EVENT_IDS_SECONDS)
+            _RECENT_EVENT_IDS[pid] = recent_event_ids
+        return recent_event_ids
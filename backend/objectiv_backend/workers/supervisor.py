@@ -0,0 +1,160 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Run multiple worker processes, and keep them running.
+
+Each worker process runs worker_main() in a loop, with its own database connection. Multiple workers can
+safely consume the same queue, as PostgresQueues.get_events() skips events that are locked by other
+workers. If the queues are sharded (PG_QUEUE_SHARDS), the shards are divided over the workers of a queue.
+"""
+import argparse
+import multiprocessing
+import signal
+import sys
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Any, Dict, List, NamedTuple, Optional, Sequence
+
+from objectiv_backend.workers.pg_queues import ProcessingStage, get_worker_shards
+from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.worker_entry import main_entry
+from objectiv_backend.workers.worker_finalize import main_finalize
+
+# Time to wait after a worker crashed before restarting it. The delay doubles for every crash of a worker
+# that ran shorter than MAX_RESTART_DELAY_SECONDS, so a worker that keeps crashing is not restarted in a
+# tight loop.
+MIN_RESTART_DELAY_SECONDS = 1
+MAX_RESTART_DELAY_SECONDS = 60
+# Time that workers get to finish their current batch after a SIGTERM, before they are killed.
+SHUTDOWN_TIMEOUT_SECONDS = 30
+
+
+class WorkerType(NamedTuple):
+    name: str
+    function: Callable[[Any], int]
+    queues: Sequence[ProcessingStage]
+
+
+WORKER_TYPE_ENTRY = WorkerType(name='entry', function=main_entry, queues=(ProcessingStage.ENTRY, ))
+WORKER_TYPE_FINALIZE = WorkerType(name='finalize', function=main_finalize,
+                                  queues=(ProcessingStage.FINALIZE, ))
+
+
+class _WorkerSlot:
+    """ A place for a single worker process, that is restarted if it dies. """
+
+    def __init__(self, worker_type: WorkerType, number: int, count: int):
+        self.worker_type = worker_type
+        self.name = f'{worker_type.name}-{number}'
+        self.shards = get_worker_shards(number=number, worker_count=count)
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.restart_delay = MIN_RESTART_DELAY_SECONDS
+        self.restart_at: Optional[float] = None
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=worker_main,
+            name=self.name,
+            kwargs={
+                'function': self.worker_type.function,
+                'loop': True,
+                'queues': self.worker_type.queues,
+                'shards': self.shards
+            })
+        self.process.start()
+        self.started_at = time.time()
+        self.restart_at = None
+        print(f'Started worker {self.name}, pid: {self.process.pid}, shards: {self.shards}')
+
+    def schedule_restart(self):
+        """ Schedule a restart for a worker that died. """
+        assert self.process is not None
+        now = time.time()
+        if now - self.started_at > MAX_RESTART_DELAY_SECONDS:
+            self.restart_delay = MIN_RESTART_DELAY_SECONDS
+        self.restart_at = now + self.restart_delay
+        print(f'Worker {self.name} (pid: {self.process.pid}) exited with code {self.process.exitcode}. '
+              f'Restarting in {self.restart_delay} s')
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY_SECONDS)
+
+
+class Supervisor:
+    """
+    Start a number of worker processes per worker type, and restart any worker that dies.
+    On SIGTERM or SIGINT all workers are asked to stop after their current batch.
+    """
+
+    def __init__(self, worker_counts: Dict[WorkerType, int]):
+        self._slots: List[_WorkerSlot] = [
+            _WorkerSlot(worker_type=worker_type, number=number, count=count)
+            for worker_type, count in worker_counts.items()
+            for number in range(count)
+        ]
+        self._stopping = False
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        """ Run until SIGTERM or SIGINT is received, then stop all workers. """
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for slot in self._slots:
+            slot.start()
+        while not self._stopping:
+            self._check_workers()
+        self._stop_workers()
+
+    def _check_workers(self):
+        """
+        Wait at most a second, or until the next restart is due, for workers to exit. Then handle any exited
+        workers and due restarts.
+        """
+        sentinels = [slot.process.sentinel for slot in self._slots
+                     if slot.process is not None and slot.restart_at is None]
+        timeout = min([1.0] + [slot.restart_at - time.time() for slot in self._slots if slot.restart_at is not None])
+        wait(sentinels, timeout=max(0.0, timeout))
+        if self._stopping:
+            return
+        now = time.time()
+        for slot in self._slots:
+            assert slot.process is not None
+            if slot.restart_at is None and not slot.process.is_alive():
+                slot.process.join()
+                slot.schedule_restart()
+            elif slot.restart_at is not None and slot.restart_at <= now:
+                slot.start()
+
+    def _stop_workers(self):
+        """ Ask all workers to stop, and kill the ones that don't stop within SHUTDOWN_TIMEOUT_SECONDS. """
+        print('Stopping workers')
+        processes = [slot.process for slot in self._slots
+                     if slot.process is not None and slot.process.is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.time() + SHUTDOWN_TIMEOUT_SECONDS
+        for process in processes:
+            process.join(timeout=max(0.0, deadline - time.time()))
+            if process.is_alive():
+                print(f'Worker {process.name} (pid: {process.pid}) did not stop in time, killing it')
+                process.kill()
+                process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='supervisor',
+                                     description='Run and supervise multiple worker processes')
+    parser.add_argument('--entry', type=int, default=1, help='Number of entry workers')
+    parser.add_argument('--finalize', type=int, default=1, help='Number of finalize workers')
+    args = parser.parse_args(sys.argv[1:])
+    if args.entry < 0 or args.finalize < 0:
+        parser.error('Number of workers cannot be negative')
+    Supervisor(worker_counts={
+        WORKER_TYPE_ENTRY: args.entry,
+        WORKER_TYPE_FINALIZE: args.finalize
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
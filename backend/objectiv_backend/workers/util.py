@@ -1,31 +1,61 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import signal
+import threading
 import time
-from typing import Callable, Any
+from typing import Callable, Any, Optional, Sequence
 
-from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.config import get_config_postgres, WORKER_SLEEP_SECONDS, WORKER_BATCH_SIZE, \
+    WORKER_BATCH_SIZE_MIN, WORKER_BATCH_SIZE_MAX, WORKER_BATCH_TARGET_SECONDS
 from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage, set_worker_shards
 
+# Set when the process receives SIGTERM or SIGINT while running worker_main() in a loop.
+_stop_requested = threading.Event()
 
-def worker_main(function: Callable[[Any], int], loop: bool) -> int:
+
+def _request_stop(signum, frame):
+    print(f'Received signal {signum}, stopping after the current batch')
+    _stop_requested.set()
+
+
+def worker_main(function: Callable[[Any], int],
+                loop: bool,
+                queues: Sequence[ProcessingStage] = (),
+                shards: Optional[Sequence[int]] = None) -> int:
     """
     Run the function once, or in a loop.
     Will print the last part of the function's name and information about the function's execution time.
 
-    If running in a loop it will sleep a second between invocations if the function returns 0.
+    If running in a loop and the function returns 0, it will wait until there is a notification of new
+    events on one of the queues, or at most WORKER_SLEEP_SECONDS, before calling the function again.
     :param function: function that will be called. Should take a `connection` as arguments. The connection
         is a db_connection as delivered by get_db_connection()
-    :param loop: whether to call the function once (False) or in an endless loop (True)
+    :param loop: whether to call the function once (False) or in an endless loop (True). When running in a
+        loop, SIGTERM and SIGINT make the loop end after the current call to function. If we are waiting
+        for events, this might take up to WORKER_SLEEP_SECONDS.
+    :param queues: queues that function reads from. If empty, we'll sleep a second between invocations
+        when the function returns 0.
+    :param shards: queue shards to take events from, see set_worker_shards(). None for all shards
     :return number of processed events, if loop is False
     """
+    set_worker_shards(shards)
     pg_config = get_config_postgres()
     if pg_config is None:
         raise Exception('Missing Postgres configuration')
     connection = get_db_connection(pg_config)
+    pg_queues = PostgresQueues(connection=connection)
+    if loop:
+        signal.signal(signal.SIGTERM, _request_stop)
+        signal.signal(signal.SIGINT, _request_stop)
+        if queues:
+            with connection:
+                pg_queues.listen(queues=queues)
     name = function.__name__.split('_')[-1]
     print(f'{name} worker')
-    while True:
+    event_count = 0
+    while not _stop_requested.is_set():
         start = time.time()
         event_count = function(connection)
         end = time.time()
@@ -33,4 +63,55 @@ def worker_main(function: Callable[[Any], int], loop: bool) -> int:
         if not loop:
             return event_count
         if event_count == 0:
-            time.sleep(1)
+            if queues:
+                pg_queues.wait_for_events(timeout=WORKER_SLEEP_SECONDS)
+            else:
+                _stop_requested.wait(1)
+    connection.close()
+    return event_count
+
+
+class AdaptiveBatchSize:
+    """
+    Batch size for a queue worker, that adapts to the queue depth and the duration of transactions.
+
+    The size grows towards maximum while batches are full, there are more events waiting in the queue, and
+    transactions finish within target_seconds. The size shrinks towards minimum if a transaction takes
+    longer than target_seconds, or fails because of the lock_timeout (see decrease()).
+    An initial size outside of [minimum, maximum] is clamped into that range.
+    """
+    GROWTH_FACTOR = 1.5
+    SHRINK_FACTOR = 0.5
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_seconds: float):
+        if not 0 < minimum <= maximum:
+            raise ValueError(f'Invalid batch sizes. minimum: {minimum}, maximum: {maximum}')
+        self.size = min(maximum, max(minimum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+
+    def update(self, event_count: int, duration: float, queue_depth: int):
+        """
+        Adjust the batch size based on the last batch.
+        :param event_count: number of events in the last batch
+        :param duration: duration in seconds of the last batch's transaction
+        :param queue_depth: number of events left in the queue after getting the last batch. Only needs to be
+            determined if the batch was full, i.e. if event_count == size
+        """
+        if duration > self.target_seconds:
+            self.decrease()
+        elif event_count >= self.size and queue_depth > self.size:
+            self.size = min(self.maximum, max(self.size + 1, int(self.size * self.GROWTH_FACTOR)))
+
+    def decrease(self):
+        """ Shrink the batch size, e.g. because the last transaction hit the lock_timeout. """
+        self.size = max(self.minimum, int(self.size * self.SHRINK_FACTOR))
+
+
+def get_adaptive_batch_size() -> AdaptiveBatchSize:
+    """ Give a new AdaptiveBatchSize, based on the WORKER_BATCH_* settings. """
+    return AdaptiveBatchSize(initial=WORKER_BATCH_SIZE,
+                             minimum=WORKER_BATCH_SIZE_MIN,
+                             maximum=WORKER_BATCH_SIZE_MAX,
+                             target_seconds=WORKER_BATCH_TARGET_SECONDS)
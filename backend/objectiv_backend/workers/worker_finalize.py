@@ -2,27 +2,52 @@
 Copyright 2021 Objectiv B.V.
 """
 import sys
+import time
 
-from objectiv_backend.common.config import WORKER_BATCH_SIZE
+from psycopg2.errors import LockNotAvailable
+
+from objectiv_backend.common.config import PG_ROLLUPS_ENABLED
 from objectiv_backend.common.types import EventDataList
+from objectiv_backend.workers.pg_partitions import maybe_maintain_partitions
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+from objectiv_backend.workers.pg_rollups import update_rollups
+from objectiv_backend.workers.pg_sessions import maybe_sessionize
 from objectiv_backend.workers.pg_storage import insert_events_into_data
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.util import worker_main, get_adaptive_batch_size
+
+_batch_size = get_adaptive_batch_size()
 
 
 def main_finalize(connection) -> int:
     """
-    Pick events from the finalize queue, and write them to the data table.
+    Pick events from the finalize queue, and write them to the data table. If PG_ROLLUPS_ENABLED is set, the
+    events that were written are also added to the rollups, in the same transaction.
     :return number of processed events
     """
-    with connection:
-        pg_queues = PostgresQueues(connection=connection)
-        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=WORKER_BATCH_SIZE)
-        print(f'event-ids: {sorted(event["id"] for event in events)}')
-        insert_events_into_data(connection, events)
+    maybe_maintain_partitions(connection)
+    maybe_sessionize(connection)
+    max_items = _batch_size.size
+    queue_depth = 0
+    start = time.time()
+    try:
+        with connection:
+            pg_queues = PostgresQueues(connection=connection)
+            events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=max_items)
+            if len(events) == max_items:
+                queue_depth = pg_queues.get_queue_depth(queue=ProcessingStage.FINALIZE)
+            print(f'event-ids: {sorted(event["id"] for event in events)}')
+            inserted_events = insert_events_into_data(connection, events)
+            if PG_ROLLUPS_ENABLED:
+                update_rollups(connection, inserted_events)
+    except LockNotAvailable as exc:
+        # The transaction is rolled back, so the events are back on the queue.
+        _batch_size.decrease()
+        print(f'Lock timeout, retrying with batch size {_batch_size.size}: {exc}')
+        return 0
+    _batch_size.update(event_count=len(events), duration=time.time() - start, queue_depth=queue_depth)
     return len(events)
 
 
 if __name__ == '__main__':
     _loop = sys.argv[1:2] == ['--loop']
-    worker_main(function=main_finalize, loop=_loop)
+    worker_main(function=main_finalize, loop=_loop, queues=[ProcessingStage.FINALIZE])
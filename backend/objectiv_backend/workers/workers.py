@@ -3,24 +3,23 @@ Copyright 2021 Objectiv B.V.
 """
 import argparse
 import sys
-import time
 
-from objectiv_backend.common.config import WORKER_SLEEP_SECONDS
+from objectiv_backend.workers.pg_queues import ProcessingStage
 from objectiv_backend.workers.util import worker_main
 from objectiv_backend.workers.worker_entry import main_entry
 from objectiv_backend.workers.worker_finalize import main_finalize
 
 
+def main_all(connection) -> int:
+    """
+    Process events from both the entry and the finalize queue.
+    :return number of processed events
+    """
+    return main_entry(connection) + main_finalize(connection)
+
+
 def call_all(loop: bool):
-    while True:
-        event_count = worker_main(function=main_entry, loop=False)
-        event_count += worker_main(function=main_finalize, loop=False)
-        if not loop:
-            break
-        if event_count == 0:
-            # sleeping a short random time is nice for catching concurrency problems
-            # time.sleep(0.2 * random.random())
-            time.sleep(WORKER_SLEEP_SECONDS)
+    return worker_main(function=main_all, loop=loop, queues=[ProcessingStage.ENTRY, ProcessingStage.FINALIZE])
 
 
 def main():
@@ -34,9 +33,9 @@ def main():
     if args.type == 'all':
         return call_all(args.loop)
     if args.type == 'entry':
-        return worker_main(function=main_entry, loop=args.loop)
+        return worker_main(function=main_entry, loop=args.loop, queues=[ProcessingStage.ENTRY])
     if args.type == 'finalize':
-        return worker_main(function=main_finalize, loop=args.loop)
+        return worker_main(function=main_finalize, loop=args.loop, queues=[ProcessingStage.FINALIZE])
 
 
 if __name__ == '__main__':
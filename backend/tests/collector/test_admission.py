@@ -0,0 +1,42 @@
+from objectiv_backend.end_points.admission import InFlightBudget
+
+
+def test_requests_budget():
+    budget = InFlightBudget(max_requests=2, max_events=0)
+    assert budget.try_acquire(requests=1)
+    assert budget.try_acquire(requests=1)
+    assert not budget.try_acquire(requests=1)
+    # events are not limited
+    assert budget.try_acquire(events=1_000_000)
+    budget.release(requests=1)
+    assert budget.try_acquire(requests=1)
+    assert budget.requests == 2
+
+
+def test_events_budget():
+    budget = InFlightBudget(max_requests=0, max_events=100)
+    assert budget.try_acquire(events=60)
+    assert not budget.try_acquire(events=50)
+    assert budget.try_acquire(events=40)
+    budget.release(events=100)
+    # a request with more events than the maximum is admitted if nothing else is in flight
+    assert budget.try_acquire(events=500)
+    assert not budget.try_acquire(events=1)
+    assert budget.events == 500
+
+
+def test_admit():
+    budget = InFlightBudget(max_requests=1, max_events=10)
+    with budget.admit(requests=1, events=5) as admitted:
+        assert admitted
+        with budget.admit(requests=1) as admitted_nested:
+            assert not admitted_nested
+        assert budget.requests == 1
+    assert budget.requests == 0 and budget.events == 0
+
+    try:
+        with budget.admit(requests=1):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert budget.requests == 0
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from typing import List, Tuple
+
+import pytest
+
+from objectiv_backend import app, asgi
+from objectiv_backend.common import config
+from objectiv_backend.common.config import FileSystemOutputConfig, get_collector_config
+from objectiv_backend.end_points import collector
+from objectiv_backend.end_points.admission import InFlightBudget
+from tests.schema.test_schema import CLICK_EVENT_JSON
+
+COOKIE_ID = 'f2e9d2b2-5d4e-4bd8-9d3e-43d64ec2bf6b'
+
+
+@pytest.fixture
+def fs_output(monkeypatch, tmp_path):
+    """ Only write to the file system, in tmp_path. """
+    collector_config = get_collector_config()
+    output = collector_config.output._replace(
+        postgres=None, aws=None, file_system=FileSystemOutputConfig(path=str(tmp_path)))
+    monkeypatch.setattr(config, '_CACHED_COLLECTOR_CONFIG', collector_config._replace(output=output))
+    # Don't reload the config when creating the apps
+    monkeypatch.setattr(asgi, 'init_collector_config', lambda: None)
+    monkeypatch.setattr(app, 'init_collector_config', lambda: None)
+    for prefix in 'OK', 'NOK', 'RAW':
+        os.mkdir(tmp_path / prefix)
+    return tmp_path
+
+
+def _asgi_request(method: str, path: str, headers: List[Tuple[str, str]], body: bytes = b''):
+    """ Send a request to a new ASGI app, and return the status, headers and body of the response. """
+    asgi_app = asgi.create_asgi_app(cpu_threads=1, io_threads=2)
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+        'client': ('127.0.0.1', 12345),
+        'server': ('localhost', 80),
+    }
+    # the body is received in two parts, to test reading multiple messages
+    messages = [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+                {'type': 'http.request', 'body': body[10:], 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    asgi_app.shutdown()
+    assert [message['type'] for message in sent] == ['http.response.start', 'http.response.body']
+    response_headers = [(name.decode(), value.decode()) for name, value in sent[0]['headers']]
+    return sent[0]['status'], response_headers, sent[1]['body']
+
+
+def _flask_request(method: str, path: str, headers: List[Tuple[str, str]], body: bytes = b''):
+    client = app.create_app().test_client()
+    # the test client manages cookies itself
+    for name, value in headers:
+        if name == 'Cookie':
+            client.set_cookie(*value.split('='))
+    headers = [(name, value) for name, value in headers if name != 'Cookie']
+    response = client.open(path, method=method, headers=headers, data=body)
+    return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+
+
+def _normalize_headers(headers: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Sort the headers, and the methods in the Allow header, which flask gives in arbitrary order. Remove the
+    cookie expiry time, which depends on the time of the request.
+    """
+    normalized = []
+    for name, value in headers:
+        if name == 'Allow':
+            value = ', '.join(sorted(value.split(', ')))
+        elif name == 'Set-Cookie':
+            value = re.sub('Expires=[^;]*; ', '', value)
+        normalized.append((name, value))
+    return sorted(normalized)
+
+
+def _assert_same_response(method: str, path: str, headers: List[Tuple[str, str]], body: bytes = b''):
+    asgi_status, asgi_headers, asgi_body = _asgi_request(method, path, headers, body)
+    flask_status, flask_headers, flask_body = _flask_request(method, path, headers, body)
+    assert asgi_status == flask_status
+    assert _normalize_headers(asgi_headers) == _normalize_headers(flask_headers)
+    assert asgi_body == flask_body
+    return asgi_status, asgi_headers, asgi_body
+
+
+def test_schema_same_as_flask():
+    headers = [('Origin', 'http://example.com'), ('Cookie', f'obj_user_id={COOKIE_ID}')]
+    status, response_headers, _ = _assert_same_response('GET', '/schema', headers)
+    assert status == 200
+    assert ('Access-Control-Allow-Origin', 'http://example.com') in response_headers
+    _assert_same_response('GET', '/jsonschema', headers)
+
+
+def test_errors_same_as_flask():
+    headers = [('Origin', 'http://example.com')]
+    assert _assert_same_response('GET', '/unknown', headers)[0] == 404
+    assert _assert_same_response('GET', '/', headers)[0] == 405
+    assert _assert_same_response('POST', '/schema', [])[0] == 405
+
+
+def test_preflight_same_as_flask():
+    headers = [('Origin', 'http://example.com'),
+               ('Access-Control-Request-Method', 'POST'),
+               ('Access-Control-Request-Headers', 'x-transport-time,content-type')]
+    status, response_headers, _ = _assert_same_response('OPTIONS', '/', headers)
+    assert status == 200
+    assert ('Access-Control-Allow-Headers', 'content-type, x-transport-time') in response_headers
+    _assert_same_response('OPTIONS', '/schema', [])
+
+
+def test_collect(fs_output):
+    headers = [('Cookie', f'obj_user_id={COOKIE_ID}'), ('Content-Type', 'application/json')]
+    status, _, body = _asgi_request('POST', '/', headers, CLICK_EVENT_JSON.encode())
+    assert status == 200
+    response = json.loads(body)
+    assert response['event_count'] == 1
+    # the event is written to either OK or NOK, depending on whether the test event is too old
+    files = [fs_output / prefix / name for prefix in ('OK', 'NOK') for name in os.listdir(fs_output / prefix)]
+    assert len(files) == 1
+    events = json.loads(files[0].read_text())
+    assert events[0]['id'] == 'd8b0f1ca-4ebe-45b6-b7fb-7858cf46082a'
+    cookie_contexts = [context for context in events[0]['global_contexts']
+                       if context['_type'] == 'CookieIdContext']
+    assert cookie_contexts[0]['cookie_id'] == COOKIE_ID
+
+    # The flask app gives the same response
+    assert _flask_request('POST', '/', headers, CLICK_EVENT_JSON.encode())[2] == body
+
+
+def test_collect_invalid_data(fs_output):
+    status, _, body = _asgi_request('POST', '/', [], b'{"events": "not a list"')
+    assert status == 200
+    response = json.loads(body)
+    assert response['status'] == '400'
+    assert response['event_count'] == -1
+    assert not os.listdir(fs_output / 'OK') and not os.listdir(fs_output / 'NOK')
+
+
+def test_collect_writes_concurrently(monkeypatch, fs_output):
+    # Both writers wait for each other, which only works if they run at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+    written = []
+
+    def get_writers(**kwargs):
+        def writer():
+            barrier.wait()
+            written.append(threading.current_thread().name)
+        return [writer, writer]
+
+    monkeypatch.setattr(collector, 'get_sync_event_writers', get_writers)
+    status, _, body = _asgi_request('POST', '/', [], CLICK_EVENT_JSON.encode())
+    assert status == 200
+    assert json.loads(body)['event_count'] == 1
+    assert len(written) == 2
+
+
+def test_collect_writer_error(monkeypatch, fs_output):
+    def get_writers(**kwargs):
+        def writer():
+            raise Exception('sink is down')
+        return [writer]
+
+    monkeypatch.setattr(collector, 'get_sync_event_writers', get_writers)
+    status, headers, body = _asgi_request('POST', '/', [], CLICK_EVENT_JSON.encode())
+    assert status == 503
+    assert ('Retry-After', '5') in headers
+    assert json.loads(body)['event_count'] == 1
+
+    # The flask app gives the same response
+    assert _flask_request('POST', '/', [], CLICK_EVENT_JSON.encode())[0] == 503
+
+
+def test_collect_in_flight_budget(monkeypatch, fs_output):
+    budget = InFlightBudget(max_requests=1, max_events=0)
+    monkeypatch.setattr(collector, 'IN_FLIGHT_BUDGET', budget)
+    assert budget.try_acquire(requests=1)
+    status, headers, body = _asgi_request('POST', '/', [], CLICK_EVENT_JSON.encode())
+    assert status == 429
+    assert ('Retry-After', '5') in headers
+    assert json.loads(body)['data_error'] == 'Too many requests in flight'
+    assert _flask_request('POST', '/', [], CLICK_EVENT_JSON.encode())[0] == 429
+
+    budget.release(requests=1)
+    assert _asgi_request('POST', '/', [], CLICK_EVENT_JSON.encode())[0] == 200
+    assert budget.requests == 0 and budget.events == 0
+
+
+def test_lifespan():
+    asgi_app = asgi.create_asgi_app(cpu_threads=1, io_threads=1)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+    assert sent == [{'type': 'lifespan.startup.complete'}, {'type': 'lifespan.shutdown.complete'}]
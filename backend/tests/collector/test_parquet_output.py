@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+from objectiv_backend.common import config
+from objectiv_backend.common.config import AwsOutputConfig, FileSystemOutputConfig, get_collector_config
+from objectiv_backend.end_points import segment_output
+from objectiv_backend.end_points.parquet_output import events_to_parquet_tables, get_parquet_key
+from objectiv_backend.end_points.segment_output import SegmentWriter, publish_segment
+from tests.collector.test_segment_output import FakeS3Client
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet  # noqa: E402
+
+EVENT = {
+    '_type': 'PressEvent',
+    'id': 'd8b0f1ca-4ebe-45b6-b7fb-7858cf46082a',
+    'time': 1630049334860,
+    'location_stack': [{'_type': 'RootLocationContext', 'id': 'home'}],
+    'global_contexts': [
+        {'_type': 'ApplicationContext', 'id': 'rod-web-demo'},
+        {'_type': 'PathContext', 'id': 'http://localhost:3000/'},
+        {'_type': 'HttpContext', 'id': 'http_context', 'referrer': '', 'user_agent': 'Mozilla/5.0'},
+        {'_type': 'CookieIdContext', 'id': 'f2e9d2b2', 'cookie_id': 'f2e9d2b2'},
+        {'_type': 'InputValueContext', 'id': 'input', 'value': 'test'},
+    ],
+}
+
+
+def test_events_to_parquet_tables():
+    other_event = dict(EVENT, id='other', time=EVENT['time'] + 24 * 3600 * 1000, global_contexts=[],
+                       extra_property=1)
+    tables = events_to_parquet_tables([EVENT, other_event, EVENT])
+    assert sorted(tables.keys()) == ['2021-08-27', '2021-08-28']
+
+    rows = tables['2021-08-27'].to_pylist()
+    assert len(rows) == 2
+    row = rows[0]
+    assert row['event_id'] == EVENT['id']
+    assert row['event_type'] == 'PressEvent'
+    assert int(row['moment'].timestamp() * 1000) == EVENT['time']
+    assert row['cookie_id'] == 'f2e9d2b2'
+    assert row['path'] == 'http://localhost:3000/'
+    assert row['application'] == 'rod-web-demo'
+    assert row['user_agent'] == 'Mozilla/5.0'
+    assert row['remote_address'] is None
+    assert json.loads(row['location_stack']) == EVENT['location_stack']
+    assert json.loads(row['global_contexts']) == [EVENT['global_contexts'][4]]
+    assert row['properties'] is None
+
+    row = tables['2021-08-28'].to_pylist()[0]
+    assert row['cookie_id'] is None and row['path'] is None
+    assert json.loads(row['global_contexts']) == []
+    assert json.loads(row['properties']) == {'extra_property': 1}
+
+
+def test_publish_segment_as_parquet(monkeypatch, tmp_path):
+    aws_config = AwsOutputConfig(access_key_id='', secret_access_key='', region='', bucket='bucket',
+                                 s3_prefix='events')
+    collector_config = get_collector_config()
+    output = collector_config.output._replace(
+        postgres=None, aws=aws_config, file_system=FileSystemOutputConfig(path=str(tmp_path / 'output')))
+    monkeypatch.setattr(config, '_CACHED_COLLECTOR_CONFIG', collector_config._replace(output=output))
+    client = FakeS3Client()
+    monkeypatch.setattr(segment_output, '_get_s3_client', lambda aws_config: client)
+    monkeypatch.setattr(segment_output, 'COLLECTOR_PARQUET_ENABLED', True)
+
+    writer = SegmentWriter(str(tmp_path / 'segments'), publish=publish_segment)
+    events = [dict(EVENT, id=f'event-{i}') for i in range(3)]
+    writer.write('OK', ''.join(json.dumps(event) + '\n' for event in events).encode())
+    writer.write('NOK', (json.dumps(EVENT) + '\n').encode())
+    writer.close()
+
+    # The json segments are published as before, only the OK events are written as Parquet
+    assert len(os.listdir(tmp_path / 'output' / 'OK')) == 1
+    assert len(os.listdir(tmp_path / 'output' / 'NOK')) == 1
+    parquet_directory = tmp_path / 'output' / 'parquet' / 'day=2021-08-27'
+    file_name = os.listdir(parquet_directory)[0]
+    assert file_name == os.listdir(tmp_path / 'output' / 'OK')[0].split('.')[0] + '.parquet'
+    assert not [name for name in os.listdir(tmp_path / 'segments' / 'OK')]
+
+    table = pyarrow.parquet.read_table(parquet_directory / file_name)
+    assert table.column('event_id').to_pylist() == ['event-0', 'event-1', 'event-2']
+    assert client.objects[('bucket', get_parquet_key('events', '2021-08-27', file_name))] == \
+        (parquet_directory / file_name).read_bytes()
+
+    # The day partitions can be read as a dataset
+    dataset = pyarrow.parquet.read_table(tmp_path / 'output' / 'parquet', partitioning='hive')
+    assert dataset.num_rows == 3
+
+
+def test_parquet_config(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'COLLECTOR_PARQUET_ENABLED', True)
+    monkeypatch.setattr(config, 'COLLECTOR_SEGMENTS_ENABLED', True)
+    monkeypatch.setattr(config, '_OUTPUT_ENABLE_FILESYSTEM', True)
+    monkeypatch.setattr(config, '_FILESYSTEM_OUTPUT_DIR', str(tmp_path))
+    assert config.get_config_output().file_system == FileSystemOutputConfig(path=str(tmp_path))
+
+    # in async mode the collector only writes RAW segments, which are not written as Parquet
+    monkeypatch.setattr(config, '_ASYNC_MODE', True)
+    with pytest.raises(ValueError, match='ASYNC_MODE'):
+        config.get_config_output()
@@ -0,0 +1,134 @@
+import json
+
+import psycopg2
+import pytest
+
+from objectiv_backend.common.config import PostgresConfig, get_collector_config
+from objectiv_backend.common.spool import Spool
+from objectiv_backend.end_points import postgres_output
+from objectiv_backend.end_points.postgres_output import is_permanent_error, replay_spool_records, \
+    write_events_to_postgres
+
+PG_CONFIG = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                           password='', pool_min_size=1, pool_max_size=1)
+EVENT_1 = {'_type': 'PressEvent', 'id': 'e8f5b0a1-b2f1-4b5a-a2b5-3b8b1b1d8d11', 'time': 1630049334860}
+EVENT_2 = {'_type': 'PressEvent', 'id': '0c1e4e2b-0c3c-4d57-bf5b-1a8a8f8c6f22', 'time': 1630049334861}
+
+
+class FakeConnection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakePool:
+    def __init__(self, available: bool):
+        self.available = available
+        self.error = None
+        self.attempts = 0
+
+    def connection(self):
+        self.attempts += 1
+        if not self.available:
+            raise psycopg2.OperationalError('connection refused')
+        if self.error:
+            raise self.error
+        return FakeConnection()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """ Fake database, inserted events are added to the inserted dict. """
+    pool = FakePool(available=True)
+    inserted = {'data': [], 'nok_data': [], 'queue_entry': []}
+
+    def insert_events(connection, data, nok_data, queue_entry, json_cache):
+        inserted['data'].extend(data)
+        inserted['nok_data'].extend(nok_data)
+        inserted['queue_entry'].extend(queue_entry)
+
+    monkeypatch.setattr(postgres_output, 'get_db_connection_pool', lambda pg_config: pool)
+    monkeypatch.setattr(postgres_output, '_insert_events', insert_events)
+    return pool, inserted
+
+
+@pytest.fixture
+def spool(monkeypatch, tmp_path):
+    spool = Spool(str(tmp_path))
+    monkeypatch.setattr(postgres_output, 'get_postgres_spool', lambda: spool)
+    yield spool
+    spool.close()
+
+
+def test_write_without_spool(monkeypatch, database):
+    pool, inserted = database
+    monkeypatch.setattr(postgres_output, 'COLLECTOR_SPOOL_DIR', '')
+    write_events_to_postgres(PG_CONFIG, data=[EVENT_1], nok_data=[EVENT_2])
+    assert inserted == {'data': [EVENT_1], 'nok_data': [EVENT_2], 'queue_entry': []}
+
+    pool.available = False
+    with pytest.raises(psycopg2.OperationalError):
+        write_events_to_postgres(PG_CONFIG, queue_entry=[EVENT_1])
+
+
+def test_write_to_spool(database, spool):
+    pool, inserted = database
+    pool.available = False
+    write_events_to_postgres(PG_CONFIG, data=[EVENT_1], nok_data=[EVENT_2])
+    assert pool.attempts == 1
+    assert spool.has_pending()
+
+    # while the spool is not empty, postgres is not tried
+    pool.available = True
+    write_events_to_postgres(PG_CONFIG, queue_entry=[EVENT_2])
+    assert pool.attempts == 1
+    assert inserted == {'data': [], 'nok_data': [], 'queue_entry': []}
+
+    records, position = spool.read(max_records=10)
+    assert [json.loads(record) for record in records] == [
+        {'data': [EVENT_1], 'nok_data': [EVENT_2], 'queue_entry': []},
+        {'data': [], 'nok_data': [], 'queue_entry': [EVENT_2]}
+    ]
+
+
+def test_write_error_not_spooled(database, spool):
+    pool, inserted = database
+    # errors that would fail again when replayed are raised
+    pool.error = psycopg2.ProgrammingError('relation "data" does not exist')
+    with pytest.raises(psycopg2.ProgrammingError):
+        write_events_to_postgres(PG_CONFIG, data=[EVENT_1])
+    assert not spool.has_pending()
+
+    pool.error = psycopg2.InterfaceError('connection already closed')
+    write_events_to_postgres(PG_CONFIG, data=[EVENT_1])
+    assert spool.has_pending()
+
+
+def test_is_permanent_error():
+    assert is_permanent_error(psycopg2.ProgrammingError('relation "data" does not exist'))
+    assert is_permanent_error(psycopg2.DataError('invalid input syntax for type uuid'))
+    assert is_permanent_error(psycopg2.IntegrityError('null value in column "cookie_id"'))
+    assert not is_permanent_error(psycopg2.OperationalError('connection refused'))
+    assert not is_permanent_error(psycopg2.errors.LockNotAvailable('canceling statement due to lock timeout'))
+    assert not is_permanent_error(psycopg2.InterfaceError('connection already closed'))
+    assert not is_permanent_error(ValueError('Postgres output is not configured'))
+
+
+def test_replay_spool_records(monkeypatch, database, spool):
+    pool, inserted = database
+    pool.available = False
+    write_events_to_postgres(PG_CONFIG, data=[EVENT_1])
+    write_events_to_postgres(PG_CONFIG, data=[EVENT_2], queue_entry=[EVENT_1])
+
+    collector_config = get_collector_config()
+    collector_config = collector_config._replace(output=collector_config.output._replace(postgres=PG_CONFIG))
+    monkeypatch.setattr(postgres_output, 'get_collector_config', lambda: collector_config)
+    records, position = spool.read(max_records=10)
+    with pytest.raises(psycopg2.OperationalError):
+        replay_spool_records(records)
+
+    pool.available = True
+    replay_spool_records(records)
+    assert inserted == {'data': [EVENT_1, EVENT_2], 'nok_data': [], 'queue_entry': [EVENT_1]}
@@ -0,0 +1,190 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from objectiv_backend.common import config
+from objectiv_backend.common.config import AwsOutputConfig, FileSystemOutputConfig, get_collector_config
+from objectiv_backend.end_points import collector, segment_output
+from objectiv_backend.end_points.segment_output import SegmentWriter, get_s3_key, upload_file_to_s3, \
+    write_events_to_segments
+
+
+class FakeS3Client:
+    """
+    Stand-in for the boto3 S3 client, that keeps objects in memory. Like S3, it requires all parts of a
+    multipart upload except the last one to be at least min_part_bytes.
+    """
+    def __init__(self, min_part_bytes: int = 5 * 1024 * 1024, fail_part: int = 0):
+        self.min_part_bytes = min_part_bytes
+        self.fail_part = fail_part
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.requests = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.requests.append('put_object')
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.requests.append('create_multipart_upload')
+        upload_id = f'upload-{len(self.uploads)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.requests.append('upload_part')
+        if PartNumber == self.fail_part:
+            raise Exception('upload failed')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.requests.append('complete_multipart_upload')
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        assert numbers == sorted(parts.keys())
+        assert [part['ETag'] for part in MultipartUpload['Parts']] == [f'etag-{n}' for n in numbers]
+        assert all(len(parts[n]) >= self.min_part_bytes for n in numbers[:-1])
+        self.objects[(Bucket, Key)] = b''.join(parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.requests.append('abort_multipart_upload')
+        self.uploads.pop(UploadId)
+        self.aborted.append(UploadId)
+
+
+def _publish_to(destination: str):
+    """ Give a publish function that moves segments to destination/prefix/name """
+    def publish(path, prefix, name):
+        os.makedirs(os.path.join(destination, prefix), exist_ok=True)
+        os.rename(path, os.path.join(destination, prefix, name))
+    return publish
+
+
+def _read_lines(path) -> list:
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as fp:
+        return fp.read().decode('utf-8').splitlines()
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'none'])
+def test_roll_on_size(tmp_path, compression):
+    published = tmp_path / 'published'
+    writer = SegmentWriter(str(tmp_path / 'segments'), publish=_publish_to(str(published)),
+                           compression=compression, max_bytes=100)
+    for i in range(10):
+        writer.write('OK', f'{{"event": {i}, "data": "{os.urandom(30).hex()}"}}\n'.encode())
+    writer.write('NOK', b'{"event": "nok"}\n')
+    assert writer.publish_closed() >= 2
+
+    names = sorted(os.listdir(published / 'OK'))
+    lines = [line for name in names for line in _read_lines(published / 'OK' / name)]
+    assert [json.loads(line)['event'] for line in lines] == list(range(len(lines)))
+    assert all(name.endswith('.ndjson.gz' if compression == 'gzip' else '.ndjson') for name in names)
+    # the last segment, and the NOK segment, are still open
+    assert not (published / 'NOK').exists()
+
+    writer.close()
+    lines = [line for name in sorted(os.listdir(published / 'OK')) for line in _read_lines(published / 'OK' / name)]
+    assert len(lines) == 10
+    assert _read_lines(published / 'NOK' / os.listdir(published / 'NOK')[0]) == ['{"event": "nok"}']
+    assert os.listdir(tmp_path / 'segments' / 'OK') == []
+
+
+def test_roll_on_age(tmp_path):
+    writer = SegmentWriter(str(tmp_path), publish=_publish_to(str(tmp_path / 'published')), max_seconds=3600)
+    writer.write('RAW', b'{}\n')
+    assert writer.roll() == 0
+    writer.max_seconds = 0
+    assert writer.roll() == 1
+    assert writer.publish_closed() == 1
+    assert writer.roll() == 0
+
+
+def test_publish_retried(tmp_path):
+    attempts = []
+
+    def publish(path, prefix, name):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise Exception('output not available')
+
+    writer = SegmentWriter(str(tmp_path), publish=publish)
+    writer.write('OK', b'{}\n')
+    writer.roll(force=True)
+    with pytest.raises(Exception, match='output not available'):
+        writer.publish_closed()
+    assert len(os.listdir(tmp_path / 'OK')) == 1
+    assert writer.publish_closed() == 1
+    assert attempts[0] == attempts[1]
+    # the publish function didn't move the file, so it's deleted afterwards
+    assert os.listdir(tmp_path / 'OK') == []
+
+
+def test_recover_segments_left_open(tmp_path):
+    published = tmp_path / 'published'
+    directory = str(tmp_path / 'segments')
+    writer = SegmentWriter(directory, publish=_publish_to(str(published)))
+    writer.write('OK', b'{"event": 1}\n')
+    writer.write('OK', b'{"event": 2}\n{"event": 3, "trun')
+    # Another writer can't recover the segment while it is open
+    other_writer = SegmentWriter(directory, publish=_publish_to(str(published)))
+    assert other_writer.recover() == 0
+
+    # Simulate a process that dies: the file is closed, without completing it
+    writer._segments['OK']._file.close()
+    assert other_writer.recover() == 1
+    assert other_writer.publish_closed() == 1
+    name = os.listdir(published / 'OK')[0]
+    assert _read_lines(published / 'OK' / name) == ['{"event": 1}', '{"event": 2}']
+    assert os.listdir(os.path.join(directory, 'OK')) == []
+
+
+def test_upload_file_to_s3(tmp_path):
+    path = tmp_path / 'segment'
+    data = os.urandom(2500)
+    path.write_bytes(data)
+
+    client = FakeS3Client()
+    upload_file_to_s3(client, str(path), bucket='bucket', key='small', part_bytes=2500)
+    assert client.requests == ['put_object']
+    assert client.objects[('bucket', 'small')] == data
+
+    client = FakeS3Client(min_part_bytes=1000)
+    upload_file_to_s3(client, str(path), bucket='bucket', key='large', part_bytes=1000)
+    assert client.requests == ['create_multipart_upload'] + ['upload_part'] * 3 + ['complete_multipart_upload']
+    assert client.objects[('bucket', 'large')] == data
+
+    client = FakeS3Client(min_part_bytes=1000, fail_part=2)
+    with pytest.raises(Exception, match='upload failed'):
+        upload_file_to_s3(client, str(path), bucket='bucket', key='failed', part_bytes=1000)
+    assert client.aborted == ['upload-0']
+    assert not client.objects
+
+
+def test_write_events_to_segments(monkeypatch, tmp_path):
+    aws_config = AwsOutputConfig(access_key_id='', secret_access_key='', region='', bucket='bucket',
+                                 s3_prefix='events')
+    collector_config = get_collector_config()
+    output = collector_config.output._replace(
+        postgres=None, aws=aws_config, file_system=FileSystemOutputConfig(path=str(tmp_path)))
+    monkeypatch.setattr(config, '_CACHED_COLLECTOR_CONFIG', collector_config._replace(output=output))
+    client = FakeS3Client()
+    monkeypatch.setattr(segment_output, '_get_s3_client', lambda aws_config: client)
+    monkeypatch.setattr(segment_output, '_SEGMENT_WRITERS', {})
+    monkeypatch.setattr(collector, 'COLLECTOR_SEGMENTS_ENABLED', True)
+
+    events = [{'id': f'event-{i}', '_type': 'ClickEvent'} for i in range(3)]
+    collector._write_events_to_files(events=events[:2], prefix='OK', json_cache=None)
+    write_events_to_segments(events=events[2:], prefix='OK')
+    writer = segment_output.get_segment_writer()
+    assert writer.directory == str(tmp_path / '.segments')
+    writer.close()
+
+    name = os.listdir(tmp_path / 'OK')[0]
+    assert [json.loads(line) for line in _read_lines(tmp_path / 'OK' / name)] == events
+    assert client.objects[('bucket', get_s3_key(aws_config, 'OK', name))] == (tmp_path / 'OK' / name).read_bytes()
+    assert get_s3_key(aws_config, 'OK', name) == f'events/{name[:4]}/{name[4:6]}/{name[6:8]}/OK/{name}'
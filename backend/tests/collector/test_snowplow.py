@@ -1,11 +1,19 @@
 import json
 import jsonschema
 import base64
+import pytest
+from typing import NamedTuple
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+from objectiv_backend.snowplow import snowplow_helper
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload
 from objectiv_backend.snowplow.snowplow_helper import make_snowplow_custom_context, \
-    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, snowplow_schema_violation_json
+    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, snowplow_schema_violation_json, \
+    write_data_to_aws_pipeline, SnowplowPublishError, _make_batches, payload_to_thrift, \
+    prepare_event_for_snowplow_pipeline, index_event_errors, write_data_to_gcp_pubsub
 from tests.schema.test_schema import CLICK_EVENT_JSON, make_event_from_dict
-from objectiv_backend.common.config import SnowplowConfig
+from objectiv_backend.common.config import SnowplowConfig, SP_GCP_PUBSUB_BATCH_MAX_MESSAGES, \
+    SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS, SP_PUBLISH_TIMEOUT_SECONDS
 from objectiv_backend.schema.validate_events import EventError, ErrorInfo
 
 
@@ -99,3 +107,265 @@ def test_snowplow_failed_event():
         instance = violation['data']
 
         jsonschema.validate(instance=instance, schema=schema,)
+
+
+def test_snowplow_failed_event_parameters():
+    payload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    parameters = json.loads(payload.body)['data'][0]
+    violation = snowplow_schema_violation_json(payload=payload, config=config)
+    assert violation['data']['payload']['enrich'] == {'event_id': event['id'], 'context': parameters['cx']}
+
+    # passing the parameters gives the same result as parsing them from the payload
+    violation_from_parameters = snowplow_schema_violation_json(payload=payload, config=config,
+                                                               parameters=parameters)
+    del violation['data']['failure']['timestamp']
+    del violation_from_parameters['data']['failure']['timestamp']
+    assert violation == violation_from_parameters
+
+
+def test_prepare_bad_events_with_errors(monkeypatch):
+    events = [dict(event, id=f'event-{i}') for i in range(3)]
+    event_errors = [EventError(event_id=f'event-{i}', error_info=[ErrorInfo(data=[], info=f'error {i}')])
+                    for i in (2, 0)]
+    errors_by_event_id = index_event_errors(event_errors)
+    assert sorted(errors_by_event_id.keys()) == ['event-0', 'event-2']
+    assert index_event_errors(None) == {}
+
+    published = []
+    monkeypatch.setattr(snowplow_helper, '_get_aws_client', lambda client_type: FakeKinesisClient())
+    monkeypatch.setattr(snowplow_helper, '_put_kinesis_records',
+                        lambda client, stream_name, data: published.extend(data) or [])
+    write_data_to_aws_pipeline(events=events, config=config, good=False, event_errors=event_errors)
+
+    reports = []
+    for message in published:
+        violation = json.loads(message)
+        data_reports = violation['data']['failure']['messages'][0]['error']['dataReports']
+        reports.append((violation['data']['payload']['enrich']['event_id'],
+                        [report['message'] for report in data_reports]))
+    assert reports == [('event-0', ['error 0']), ('event-1', []), ('event-2', ['error 2'])]
+
+    # good events are not turned into violations
+    message = prepare_event_for_snowplow_pipeline(event=events[0], good=True, config=config,
+                                                  event_error=errors_by_event_id['event-0'])
+    decoded = CollectorPayload()
+    decoded.read(TBinaryProtocol.TBinaryProtocol(TTransport.TMemoryBuffer(message)))
+    assert decoded.body == objectiv_event_to_snowplow_payload(event=events[0], config=config).body
+
+
+def test_objectiv_event_to_snowplow_payload_json_identical():
+    # The payload is built from the cached serialization of the event, the result must be identical to
+    # serializing the rich event as a whole.
+    collector_payload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    body = json.loads(collector_payload.body)
+
+    rich_event = {'event_id' if k == 'id' else k: v for k, v in event.items()}
+    rich_event['cookie_id'] = ''
+    sp_event = objectiv_event_to_snowplow(event=rich_event, config=config)
+    assert body['data'][0]['cx'] == make_snowplow_custom_context(self_describing_event=sp_event, config=config)
+
+
+class FakeKinesisClient:
+    """ Kinesis client that fails the first put of every record with an odd index, or every put if fail_always. """
+    def __init__(self, fail_always: bool = False):
+        self.fail_always = fail_always
+        self.calls = []
+        self.delivered = []
+        self.failed_once = set()
+
+    def put_records(self, StreamName, Records):
+        self.calls.append((StreamName, len(Records)))
+        results = []
+        for record in Records:
+            data = record['Data']
+            if int(data.split(b'-')[1]) % 2 and (self.fail_always or data not in self.failed_once):
+                self.failed_once.add(data)
+                results.append({'ErrorCode': 'ProvisionedThroughputExceededException'})
+            else:
+                self.delivered.append(data)
+                results.append({'SequenceNumber': '1'})
+        return {'FailedRecordCount': sum('ErrorCode' in result for result in results), 'Records': results}
+
+
+class FakeSqsClient:
+    """ SQS client that fails every first message of a batch: once with a sender fault, once without. """
+    def __init__(self):
+        self.calls = []
+        self.delivered = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append((QueueUrl, len(Entries)))
+        assert len({entry['Id'] for entry in Entries}) == len(Entries)
+        failed = []
+        for entry in Entries[1:]:
+            self.delivered.append(entry['MessageBody'])
+        if len(self.calls) == 1:
+            failed.append({'Id': Entries[0]['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'})
+        else:
+            failed.append({'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+        return {'Successful': [], 'Failed': failed}
+
+
+class FakeNotFound(Exception):
+    pass
+
+
+class FakeFuture:
+    def __init__(self, publisher, data, exception=None):
+        self.publisher = publisher
+        self.data = data
+        self.exception = exception
+
+    def result(self, timeout=None):
+        self.publisher.calls.append(('result', timeout, self.data))
+        if self.exception:
+            raise self.exception
+
+
+class FakePublisherClient:
+    """
+    PubSub publisher that fails the first publish of every message with an odd index, and every publish of
+    event-3, as if the topic doesn't exist.
+    """
+    def __init__(self, batch_settings=None):
+        self.batch_settings = batch_settings
+        self.calls = []
+        self.delivered = []
+        self.failed_once = set()
+
+    def publish(self, topic_path, data):
+        self.calls.append(('publish', topic_path, data))
+        if data == b'event-3':
+            return FakeFuture(self, data, FakeNotFound('topic not found'))
+        if int(data.split(b'-')[1]) % 2 and data not in self.failed_once:
+            self.failed_once.add(data)
+            return FakeFuture(self, data, TimeoutError('deadline exceeded'))
+        self.delivered.append(data)
+        return FakeFuture(self, data)
+
+
+class FakePubSub:
+    """ Replaces the pubsub_v1 module """
+    class types:
+        class BatchSettings(NamedTuple):
+            max_messages: int
+            max_latency: float
+
+    PublisherClient = FakePublisherClient
+
+
+def test_write_data_to_gcp_pubsub(monkeypatch):
+    monkeypatch.setattr(snowplow_helper, 'pubsub_v1', FakePubSub, raising=False)
+    monkeypatch.setattr(snowplow_helper, 'NotFound', FakeNotFound, raising=False)
+    monkeypatch.setattr(snowplow_helper, '_CLIENTS', {})
+    monkeypatch.setattr(snowplow_helper, 'prepare_event_for_snowplow_pipeline', _fake_prepare)
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_RETRY_BACKOFF_SECONDS', 0)
+    events = [{'id': f'event-{i}'} for i in range(6)]
+    gcp_config = config._replace(gcp_project='project', gcp_pubsub_topic_raw='raw', gcp_pubsub_topic_bad='bad')
+
+    write_data_to_gcp_pubsub(events=events, config=gcp_config, good=True)
+    publisher = snowplow_helper._get_pubsub_publisher()
+    assert publisher.batch_settings == FakePubSub.types.BatchSettings(
+        max_messages=SP_GCP_PUBSUB_BATCH_MAX_MESSAGES, max_latency=SP_GCP_PUBSUB_BATCH_MAX_LATENCY_SECONDS)
+    # All messages are published before waiting for the results, so that the client can batch them. The
+    # messages that failed are published again, except for event-3, of which the topic is not found.
+    calls = [(call[0], call[2]) for call in publisher.calls]
+    assert calls == \
+        [('publish', f'event-{i}'.encode()) for i in range(6)] + \
+        [('result', f'event-{i}'.encode()) for i in range(6)] + \
+        [('publish', b'event-1'), ('publish', b'event-5'), ('result', b'event-1'), ('result', b'event-5')]
+    assert {call[1] for call in publisher.calls if call[0] == 'publish'} == {'projects/project/topics/raw'}
+    assert {call[1] for call in publisher.calls if call[0] == 'result'} == {SP_PUBLISH_TIMEOUT_SECONDS}
+    assert sorted(publisher.delivered) == [f'event-{i}'.encode() for i in range(6) if i != 3]
+
+    # events that keep failing
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_MAX_ATTEMPTS', 1)
+    with pytest.raises(SnowplowPublishError):
+        write_data_to_gcp_pubsub(events=[{'id': 'event-7'}], config=gcp_config, good=False)
+    assert publisher.calls[-2][1] == 'projects/project/topics/bad'
+
+
+def _fake_prepare(event, **kwargs):
+    return event['id'].encode()
+
+
+def test_write_data_to_aws_pipeline_kinesis(monkeypatch):
+    client = FakeKinesisClient()
+    monkeypatch.setattr(snowplow_helper, '_get_aws_client', lambda client_type: client)
+    monkeypatch.setattr(snowplow_helper, 'prepare_event_for_snowplow_pipeline', _fake_prepare)
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_RETRY_BACKOFF_SECONDS', 0)
+    events = [{'id': f'event-{i}'} for i in range(1200)]
+    aws_config = config._replace(aws_message_raw_type='kinesis', aws_message_topic_raw='raw-stream')
+
+    write_data_to_aws_pipeline(events=events, config=aws_config, good=True)
+    # 3 batches, and 2 batches with the 600 records that failed the first time
+    assert client.calls == [('raw-stream', 500), ('raw-stream', 500), ('raw-stream', 200),
+                            ('raw-stream', 500), ('raw-stream', 100)]
+    assert sorted(client.delivered) == sorted(event['id'].encode() for event in events)
+
+
+def test_write_data_to_aws_pipeline_kinesis_gives_up(monkeypatch):
+    client = FakeKinesisClient(fail_always=True)
+    monkeypatch.setattr(snowplow_helper, '_get_aws_client', lambda client_type: client)
+    monkeypatch.setattr(snowplow_helper, 'prepare_event_for_snowplow_pipeline', _fake_prepare)
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_RETRY_BACKOFF_SECONDS', 0)
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_MAX_ATTEMPTS', 3)
+    events = [{'id': f'event-{i}'} for i in range(4)]
+
+    with pytest.raises(SnowplowPublishError):
+        write_data_to_aws_pipeline(events=events, config=config, good=False)
+    assert client.calls == [('', 4), ('', 2), ('', 2)]
+
+
+def test_write_data_to_aws_pipeline_sqs(monkeypatch):
+    client = FakeSqsClient()
+    monkeypatch.setattr(snowplow_helper, '_get_aws_client', lambda client_type: client)
+    monkeypatch.setattr(snowplow_helper, 'prepare_event_for_snowplow_pipeline', _fake_prepare)
+    monkeypatch.setattr(snowplow_helper, 'SNOWPLOW_RETRY_BACKOFF_SECONDS', 0)
+    events = [{'id': f'event-{i}'} for i in range(15)]
+    sqs_config = config._replace(aws_message_raw_type='sqs', aws_message_topic_raw='queue-url')
+
+    with pytest.raises(SnowplowPublishError):
+        write_data_to_aws_pipeline(events=events, config=sqs_config, good=True)
+    # Batches of 10 and 5. The first message of the first batch has a sender fault, and is not retried. The
+    # first message of the second batch fails every time.
+    assert client.calls == [('queue-url', 10), ('queue-url', 5), ('queue-url', 1), ('queue-url', 1)]
+    delivered = [base64.b64decode(message).decode() for message in client.delivered]
+    assert sorted(delivered) == sorted(f'event-{i}' for i in range(15) if i not in (0, 10))
+
+
+def test_make_batches():
+    messages = [b'a' * 10, b'b' * 10, b'c' * 25, b'd', b'e']
+    assert list(_make_batches(messages, max_count=3, max_bytes=30)) == [
+        [b'a' * 10, b'b' * 10], [b'c' * 25, b'd', b'e']]
+    # a message larger than max_bytes gets a batch of its own
+    assert list(_make_batches([b'a' * 50, b'b'], max_count=3, max_bytes=30)) == [[b'a' * 50], [b'b']]
+
+
+def _generic_thrift(payload: CollectorPayload, protocol_class) -> bytes:
+    """ Encode payload with the code generated by thrift. """
+    trans = TTransport.TMemoryBuffer()
+    payload.write(oprot=protocol_class(trans=trans))
+    return trans.getvalue()
+
+
+@pytest.mark.parametrize('protocol_class', [
+    TBinaryProtocol.TBinaryProtocol,
+    TBinaryProtocol.TBinaryProtocolAccelerated
+])
+def test_payload_to_thrift_same_as_generated_code(protocol_class):
+    payload = objectiv_event_to_snowplow_payload(event=event, config=config)
+    assert payload_to_thrift(payload) == _generic_thrift(payload, protocol_class)
+
+    # non-ascii text, negative timestamp, and non-empty headers
+    payload.body = '{"text": "\u00e9\u00e8 \u2603 \U0001F600"}'
+    payload.userAgent = 'Mozilla/5.0 (\u00fc)'
+    payload.timestamp = -1
+    payload.headers = ['Accept: */*', 'X-Name: \u00e9']
+    assert payload_to_thrift(payload) == _generic_thrift(payload, protocol_class)
+
+    # fields that are None are not written
+    empty = CollectorPayload()
+    assert payload_to_thrift(empty) == _generic_thrift(empty, protocol_class)
+    partial_payload = CollectorPayload(schema='iglu:test', ipAddress='127.0.0.1', timestamp=2 ** 62, headers=[])
+    assert payload_to_thrift(partial_payload) == _generic_thrift(partial_payload, protocol_class)
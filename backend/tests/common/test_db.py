@@ -0,0 +1,136 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from objectiv_backend.common.db import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        if self.connection.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.connection.queries.append(query)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.status = TRANSACTION_STATUS_IDLE
+        self.queries = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def _get_pool(min_size=0, max_size=2, timeout=0.01):
+    created = []
+
+    def factory():
+        connection = FakeConnection()
+        created.append(connection)
+        return connection
+    return ConnectionPool(connection_factory=factory, min_size=min_size, max_size=max_size,
+                          timeout=timeout), created
+
+
+def test_pool_min_size():
+    _, created = _get_pool(min_size=2, max_size=3)
+    assert len(created) == 2
+
+
+def test_pool_invalid_size():
+    with pytest.raises(ValueError, match='Invalid pool size'):
+        _get_pool(min_size=3, max_size=2)
+
+
+def test_pool_reuses_connections():
+    pool, created = _get_pool()
+    with pool.connection() as connection1:
+        pass
+    with pool.connection() as connection2:
+        pass
+    assert connection1 is connection2
+    assert len(created) == 1
+    # health check on checkout, without leaving the connection in autocommit mode
+    assert connection2.queries == ['select 1']
+    assert connection2.autocommit is False
+
+
+def test_pool_max_size():
+    pool, created = _get_pool(max_size=2)
+    connection1 = pool.get_connection()
+    connection2 = pool.get_connection()
+    with pytest.raises(psycopg2.OperationalError, match='No database connection available'):
+        pool.get_connection()
+    pool.put_connection(connection1)
+    assert pool.get_connection() is connection1
+    pool.put_connection(connection2, discard=True)
+    assert connection2.closed
+    assert pool.get_connection() not in (connection1, connection2)
+    assert len(created) == 3
+
+
+def test_pool_discards_broken_connections():
+    pool, created = _get_pool()
+    with pool.connection() as connection:
+        pass
+    connection.broken = True
+    with pool.connection() as new_connection:
+        pass
+    assert new_connection is not connection
+    assert connection.closed
+
+    new_connection.closed = 1
+    with pool.connection() as newest_connection:
+        pass
+    assert newest_connection is not new_connection
+    assert len(created) == 3
+
+
+def test_pool_rolls_back_open_transaction():
+    pool, _ = _get_pool()
+    with pytest.raises(ZeroDivisionError):
+        with pool.connection() as connection:
+            connection.status = TRANSACTION_STATUS_INTRANS
+            1 / 0
+    assert connection.rollbacks == 1
+    with pool.connection() as connection2:
+        assert connection2 is connection
+
+
+def test_pool_close():
+    pool, _ = _get_pool()
+    connection = pool.get_connection()
+    idle_connection = pool.get_connection()
+    pool.put_connection(idle_connection)
+    pool.close()
+    assert idle_connection.closed
+    pool.put_connection(connection)
+    assert connection.closed
+    with pytest.raises(psycopg2.OperationalError, match='closed'):
+        pool.get_connection()
@@ -0,0 +1,74 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import json
+
+import pytest
+
+from objectiv_backend.common import json_codec
+from objectiv_backend.common.event_utils import EventJsonCache, ContextIndex, add_global_context_to_event, \
+    get_contexts, get_optional_context
+from tests.schema.test_schema import CLICK_EVENT_JSON, make_event_from_dict
+
+
+def _get_events():
+    return [make_event_from_dict(event) for event in json.loads(CLICK_EVENT_JSON)['events']]
+
+
+def test_event_json_cache_equals_json_dumps():
+    events = _get_events()
+    json_cache = EventJsonCache()
+    for event in events:
+        assert json_cache.get_json(event) == json_codec.dumps(event)
+    assert json_cache.get_json_list(events) == json_codec.dumps(events)
+    assert json_cache.get_json_list([]) == json_codec.dumps([])
+
+
+def test_event_json_cache_serializes_once(monkeypatch):
+    event = _get_events()[0]
+    json_cache = EventJsonCache()
+    expected = json_cache.get_json(event)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('event serialized twice')
+    monkeypatch.setattr('objectiv_backend.common.event_utils.dumps', fail)
+    assert json_cache.get_json(event) == expected
+    assert json_cache.get_json_list([event, event]) == f'[{expected},{expected}]'
+
+
+def _make_event():
+    return {
+        'global_contexts': [
+            {'_type': 'HttpContext', 'id': 'http', '_types': ['AbstractContext', 'HttpContext']},
+            {'_type': 'CookieIdContext', 'id': 'cookie'},
+        ],
+        'location_stack': [
+            {'_type': 'RootLocationContext', 'id': 'root'},
+            {'_type': 'SectionContext', 'id': 'section', '_types': ['AbstractContext', 'SectionContext']},
+        ]
+    }
+
+
+def test_context_index_matches_get_contexts():
+    event = _make_event()
+    context_index = ContextIndex(event)
+    for context_type in ['HttpContext', 'CookieIdContext', 'RootLocationContext', 'AbstractContext',
+                         'SectionContext', 'PathContext']:
+        assert context_index.get_contexts(context_type) == get_contexts(event, context_type)
+        assert context_index.get_optional_context(context_type) == get_optional_context(event, context_type)
+    assert [c['id'] for c in context_index.get_contexts('AbstractContext')] == ['http', 'section']
+    assert context_index.get_context('CookieIdContext')['id'] == 'cookie'
+    with pytest.raises(ValueError):
+        context_index.get_context('PathContext')
+
+
+def test_context_index_add_global_context():
+    event = _make_event()
+    context_index = ContextIndex(event)
+    path_context = {'_type': 'PathContext', 'id': 'path', '_types': ['AbstractContext', 'PathContext']}
+    add_global_context_to_event(event, path_context, context_index=context_index)
+    assert event['global_contexts'][-1] is path_context
+    assert context_index.get_context('PathContext') is path_context
+    # global contexts come before the location stack, also if they are added later
+    assert [c['id'] for c in context_index.get_contexts('AbstractContext')] == ['http', 'path', 'section']
+    assert context_index.get_contexts('AbstractContext') == get_contexts(event, 'AbstractContext')
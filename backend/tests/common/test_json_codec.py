@@ -0,0 +1,61 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import json
+import uuid
+
+import pytest
+
+from objectiv_backend.common.json_codec import get_json_codec
+from objectiv_backend.schema.schema import make_context
+from objectiv_backend.schema.validate_events import EventError, ErrorInfo
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC_NAMES = [
+    'json',
+    pytest.param('orjson', marks=pytest.mark.skipif(orjson is None, reason='orjson is not installed'))
+]
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_round_trip(name):
+    codec = get_json_codec(name)
+    data = {'events': [{'id': 'a', 'values': [1, 2.5, None, True], 'text': 'café ☃'}], 'n': 3}
+    assert codec.loads(codec.dumps(data)) == data
+    assert codec.loads(codec.dumps_bytes(data)) == data
+    assert codec.loads(json.dumps(data).encode('utf-8')) == data
+    # compact output, key order is preserved
+    assert codec.dumps({'b': 1, 'a': [1, 2]}) == '{"b":1,"a":[1,2]}'
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_dumps_special_types(name):
+    codec = get_json_codec(name)
+    event_id = uuid.UUID('6f5b3dc4-ea8b-4a1a-b2a4-d0e8a4e3f2b1')
+    assert codec.dumps(event_id) == f'"{event_id}"'
+
+    context = make_context(_type='CookieIdContext', id='cookie', cookie_id='cookie')
+    assert json.loads(codec.dumps(context)) == dict(context)
+
+    event_error = EventError(event_id=event_id, error_info=[ErrorInfo(data={'x': 1}, info='test')])
+    assert json.loads(codec.dumps(event_error)) == \
+        {'event_id': str(event_id), 'error_info': [{'data': {'x': 1}, 'info': 'test'}]}
+
+
+@pytest.mark.parametrize('name', CODEC_NAMES)
+def test_loads_invalid(name):
+    codec = get_json_codec(name)
+    with pytest.raises(ValueError):
+        codec.loads(b'{"events": [')
+
+
+def test_get_json_codec():
+    assert get_json_codec('json').name == 'json'
+    assert get_json_codec('auto').name == ('json' if orjson is None else 'orjson')
+    with pytest.raises(ValueError):
+        get_json_codec('yaml')
@@ -0,0 +1,203 @@
+import os
+import threading
+
+import pytest
+
+from objectiv_backend.common.spool import Spool, SpoolDrainer, SpoolLockedError, SpoolPosition, open_spool_slot
+
+
+def test_append_read_commit(tmp_path):
+    spool = Spool(str(tmp_path))
+    assert not spool.has_pending()
+    assert spool.read(max_records=10) == ([], SpoolPosition(0, 0))
+    spool.append(b'one')
+    spool.append(b'two')
+    spool.append(b'three')
+    assert spool.has_pending()
+
+    records, position = spool.read(max_records=2)
+    assert records == [b'one', b'two']
+    # reading doesn't change the read position
+    assert spool.read(max_records=2)[0] == [b'one', b'two']
+    spool.commit(position)
+    records, position = spool.read(max_records=10)
+    assert records == [b'three']
+    spool.commit(position)
+    assert not spool.has_pending()
+    spool.close()
+
+
+def test_reopen(tmp_path):
+    spool = Spool(str(tmp_path))
+    for payload in b'one', b'two', b'three':
+        spool.append(payload)
+    spool.commit(spool.read(max_records=1)[1])
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert spool.has_pending()
+    assert spool.wait_for_records(timeout=0)
+    assert spool.read(max_records=10)[0] == [b'two', b'three']
+    spool.append(b'four')
+    assert spool.read(max_records=10)[0] == [b'two', b'three', b'four']
+    spool.close()
+
+
+def test_incomplete_record_discarded(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b'one')
+    spool.append(b'two')
+    spool.close()
+    segment_path = tmp_path / 'segment-00000000000000000000.log'
+    size = os.path.getsize(segment_path)
+    # simulate a crash halfway through writing the second record
+    with open(segment_path, 'r+b') as segment_file:
+        segment_file.truncate(size - 2)
+
+    spool = Spool(str(tmp_path))
+    assert spool.read(max_records=10)[0] == [b'one']
+    spool.append(b'three')
+    assert spool.read(max_records=10)[0] == [b'one', b'three']
+    spool.close()
+
+
+def test_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_max_bytes=40)
+    payloads = [f'record-{i}'.encode() for i in range(10)]
+    for payload in payloads:
+        spool.append(payload)
+    segment_files = sorted(name for name in os.listdir(tmp_path) if name.startswith('segment-'))
+    assert len(segment_files) == 5
+
+    records, position = spool.read(max_records=5)
+    assert records == payloads[:5]
+    spool.commit(position)
+    # completely read segments are deleted
+    assert len([name for name in os.listdir(tmp_path) if name.startswith('segment-')]) == 3
+
+    records, position = spool.read(max_records=100)
+    assert records == payloads[5:]
+    spool.commit(position)
+    assert not spool.has_pending()
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_max_bytes=40)
+    assert not spool.has_pending()
+    spool.append(b'next')
+    assert spool.read(max_records=100)[0] == [b'next']
+    spool.close()
+
+
+def test_concurrent_appends(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path), segment_max_bytes=1000)
+    fsync_count = 0
+    fsync = os.fsync
+
+    def count_fsync(fd):
+        nonlocal fsync_count
+        fsync_count += 1
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', count_fsync)
+
+    def append(thread_number):
+        for i in range(50):
+            spool.append(f'{thread_number}-{i}'.encode())
+
+    threads = [threading.Thread(target=append, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = spool.read(max_records=1000)[0]
+    assert sorted(records) == sorted(f'{n}-{i}'.encode() for n in range(4) for i in range(50))
+    # records of a thread are in order
+    assert [record for record in records if record.startswith(b'2-')] == [f'2-{i}'.encode() for i in range(50)]
+    assert fsync_count <= 200 + len([name for name in os.listdir(tmp_path) if name.startswith('segment-')])
+    spool.close()
+
+
+def test_locked(tmp_path):
+    spool = Spool(str(tmp_path / '0'))
+    with pytest.raises(SpoolLockedError):
+        Spool(str(tmp_path / '0'))
+    other_spool = open_spool_slot(str(tmp_path))
+    assert other_spool.directory == str(tmp_path / '1')
+    other_spool.close()
+    spool.close()
+    spool = open_spool_slot(str(tmp_path))
+    assert spool.directory == str(tmp_path / '0')
+    spool.close()
+
+
+def test_drainer(tmp_path):
+    spool = Spool(str(tmp_path))
+    replayed = []
+    failures = [Exception('database is down')]
+
+    def replay(records):
+        if failures:
+            raise failures.pop()
+        replayed.extend(records)
+
+    drainer = SpoolDrainer(spool=spool, replay=replay, batch_size=2, retry_seconds=0.01)
+    for payload in b'one', b'two', b'three':
+        spool.append(payload)
+    with pytest.raises(Exception):
+        drainer.drain_once()
+    assert spool.has_pending()
+
+    drainer.start()
+    for _ in range(500):
+        if not spool.has_pending():
+            break
+        threading.Event().wait(0.01)
+    drainer.stop(timeout=5)
+    assert replayed == [b'one', b'two', b'three']
+    assert not spool.has_pending()
+    spool.close()
+
+
+def test_drainer_permanent_error(tmp_path):
+    spool = Spool(str(tmp_path))
+    replayed = []
+    transient_failures = []
+
+    def replay(records):
+        if transient_failures:
+            raise transient_failures.pop()
+        if b'bad' in records:
+            raise ValueError('can never be replayed')
+        replayed.extend(records)
+
+    for payload in b'one', b'two', b'bad', b'three', b'four':
+        spool.append(payload)
+    # without is_permanent_error, every error is retried
+    drainer = SpoolDrainer(spool=spool, replay=replay, batch_size=5)
+    with pytest.raises(ValueError):
+        drainer.drain_once()
+    assert spool.has_pending()
+
+    # a transient error while the batch is split up is retried, the records are not committed
+    drainer = SpoolDrainer(spool=spool, replay=replay, batch_size=5,
+                           is_permanent_error=lambda exc: isinstance(exc, ValueError))
+    transient_failures.append(Exception('database is down'))
+    transient_failures.append(ValueError('can never be replayed'))
+    with pytest.raises(Exception, match='database is down'):
+        drainer.drain_once()
+    assert spool.has_pending()
+    assert spool.rejected_records() == []
+
+    # the failing record is moved to the dead letter file, and the others are replayed
+    replayed.clear()
+    assert drainer.drain_once() == 5
+    assert replayed == [b'one', b'two', b'three', b'four']
+    assert spool.rejected_records() == [b'bad']
+    assert not spool.has_pending()
+    spool.close()
+
+    # the dead letter file is kept
+    spool = Spool(str(tmp_path))
+    assert spool.rejected_records() == [b'bad']
+    spool.close()
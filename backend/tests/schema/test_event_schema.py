@@ -170,6 +170,26 @@ def test_all_parent_context_types():
            {'BaseContext', 'OtherContext', 'ExtraContext'}
 
 
+def test_precomputed_types():
+    schema = _get_schema()
+    for event_type in schema.list_event_types():
+        assert schema.get_sorted_parent_event_types(event_type) == \
+               tuple(sorted(schema.get_all_parent_event_types(event_type)))
+        assert schema.get_frozen_required_contexts_for_event(event_type) == \
+               schema.get_all_required_contexts_for_event(event_type)
+    for context_type in schema.list_context_types() + ['X']:
+        assert schema.get_sorted_parent_context_types(context_type) == \
+               tuple(sorted(schema.get_all_parent_context_types(context_type)))
+        assert schema.get_frozen_parent_context_types(context_type) == \
+               schema.get_all_parent_context_types(context_type)
+        assert schema.get_frozen_required_contexts_for_context(context_type) == \
+               schema.get_all_required_contexts_for_context(context_type)
+    assert schema.get_sorted_parent_context_types('ExtraContext') == \
+           ('BaseContext', 'ExtraContext', 'OtherContext')
+    # precomputed values are shared, not computed per call
+    assert schema.get_sorted_parent_event_types('ChildEvent') is schema.get_sorted_parent_event_types('ChildEvent')
+
+
 def test_all_child_context_types():
     schema = _get_schema()
     assert schema.get_all_child_context_types('X') == set()
@@ -231,6 +251,32 @@ def test_optional_property():
     assert other_context['required'] == ['id', 'other_property']
 
 
+def test_get_context_validator():
+    schema = _get_schema()
+    assert schema.get_context_validator('X') is None
+    validator = schema.get_context_validator('OtherContext')
+    assert validator.is_valid({'id': 'a', 'other_property': 1})
+    assert validator.is_valid({'id': 'a', 'other_property': 1, 'optional_property': None})
+    assert not validator.is_valid({'id': 'a'})
+    assert not validator.is_valid({'id': 'a', 'other_property': 'not a number'})
+
+
+def test_get_event_validator():
+    schema = _get_schema()
+    assert schema.get_event_validator('XEvent') is None
+    # none of the events in the test schema have properties, so any object is valid
+    validator = schema.get_event_validator('GrandChildEvent')
+    assert validator.is_valid({})
+    assert not validator.is_valid([])
+
+
+def test_get_context_schema_returns_copy():
+    schema = _get_schema()
+    context_schema = schema.get_context_schema('BaseContext')
+    context_schema['properties']['_type'] = {'type': 'string', 'const': 'BaseContext'}
+    assert '_type' not in schema.get_context_schema('BaseContext')['properties']
+
+
 # ### Below are helper functions and test data
 def _get_schema() -> EventSchema:
 
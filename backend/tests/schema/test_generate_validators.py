@@ -0,0 +1,85 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import jsonschema
+import pytest
+
+from objectiv_backend.schema.event_schemas import get_event_schema
+from objectiv_backend.schema.generate_validators import compile_validator, generate_validator_source, \
+    NativeValidator, UnsupportedSchemaError
+
+
+CONTEXT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'id': {'type': 'string', 'description': 'id', 'pattern': '^[a-z]+$', 'maxLength': 5},
+        'count': {'type': 'integer', 'minimum': 0, 'exclusiveMaximum': 10},
+        'kind': {'type': ['string', 'null'], 'enum': ['a', 'b']},
+        'tags': {'type': 'array', 'items': {'type': 'string', 'minLength': 1}},
+        'nested': {'type': 'object', 'properties': {'x': {'type': 'number'}}, 'required': ['x']}
+    },
+    'required': ['count', 'id']
+}
+
+INSTANCES = [
+    {'id': 'abc', 'count': 3},
+    {'id': 'abc', 'count': 3, 'kind': 'a', 'tags': ['x', 'y'], 'nested': {'x': 1.5}},
+    {'id': 'abc', 'count': 3, 'kind': None},
+    {'id': 'abc'},
+    {'id': 'ABC', 'count': 3},
+    {'id': 'abcdef', 'count': 3},
+    {'id': 'abc', 'count': -1},
+    {'id': 'abc', 'count': 10},
+    {'id': 'abc', 'count': True},
+    {'id': 'abc', 'count': 3.0},
+    {'id': 'abc', 'count': 3, 'kind': 'c'},
+    {'id': 'abc', 'count': 3, 'tags': ['x', '']},
+    {'id': 'abc', 'count': 3, 'tags': 'x'},
+    {'id': 'abc', 'count': 3, 'nested': {}},
+    {'id': 'abc', 'count': 3, 'nested': {'x': 'a'}},
+    {'id': 1, 'count': 3},
+    ['id', 'count'],
+    None,
+]
+
+
+@pytest.mark.parametrize('instance', INSTANCES)
+def test_compiled_validator_agrees_with_jsonschema(instance):
+    validate = compile_validator(CONTEXT_SCHEMA)
+    assert validate is not None
+    schema_validator = jsonschema.Draft202012Validator(CONTEXT_SCHEMA)
+    if validate(instance):
+        assert schema_validator.is_valid(instance)
+    native_validator = NativeValidator(schema_validator=schema_validator, validate=validate)
+    assert native_validator.is_valid(instance) == schema_validator.is_valid(instance)
+    assert [str(e) for e in native_validator.iter_errors(instance)] == \
+           [str(e) for e in schema_validator.iter_errors(instance)]
+
+
+def test_compiled_validator_accepts_valid():
+    validate = compile_validator(CONTEXT_SCHEMA)
+    assert validate(INSTANCES[0])
+    assert validate(INSTANCES[1])
+    # None is not one of the enum values
+    assert not validate(INSTANCES[2])
+    assert not validate(INSTANCES[3])
+
+
+def test_unsupported_keywords():
+    assert compile_validator({'type': 'object', 'additionalProperties': False}) is None
+    assert compile_validator({'type': 'object', 'properties': {'a': {'oneOf': []}}}) is None
+    assert compile_validator({'type': 'object', 'properties': {'a': {'type': 'AbstractContext'}}}) is None
+    with pytest.raises(UnsupportedSchemaError):
+        generate_validator_source('validate', {'enum': [1, True]})
+    # keywords that jsonschema doesn't know are ignored, just like jsonschema does
+    validate = compile_validator({'type': 'object', 'name': 'x', 'optional': True, 'description': 'y'})
+    assert validate is not None
+    assert validate({})
+
+
+def test_schema_validators_are_native():
+    event_schema = get_event_schema(schema_extensions_directory=None)
+    for event_type in event_schema.list_event_types():
+        assert isinstance(event_schema.get_event_validator(event_type), NativeValidator)
+    for context_type in event_schema.list_context_types():
+        assert isinstance(event_schema.get_context_validator(context_type), NativeValidator)
@@ -4,7 +4,8 @@ from typing import Dict, Any
 from objectiv_backend.schema.schema import make_event_from_dict, make_context, \
     ContentContext, HttpContext, MarketingContext
 from objectiv_backend.common.event_utils import add_global_context_to_event, get_context
-from objectiv_backend.schema.validate_events import validate_structure_event_list, validate_event_adheres_to_schema
+from objectiv_backend.schema.validate_events import validate_structure_event_list, validate_event_adheres_to_schema, \
+    get_event_list_schema
 from objectiv_backend.common.config import get_collector_config
 
 
@@ -219,3 +220,26 @@ def test_required_context_broken_state():
     # now we remove the location_stack, event should still be valid
     event['location_stack'] = []
     assert (validate_event_adheres_to_schema(event_schema=event_schema, event=event) == [])
+
+
+def test_validate_structure_event_list():
+    event_list = json.loads(CLICK_EVENT_JSON)
+    assert validate_structure_event_list(event_list) == []
+
+    del event_list['transport_time']
+    assert validate_structure_event_list(event_list) != []
+
+    event_list = json.loads(CLICK_EVENT_JSON)
+    event_list['events'] = {}
+    assert validate_structure_event_list(event_list) != []
+
+
+def test_get_event_list_schema_is_not_shared():
+    event_list_schema = get_event_list_schema()
+    assert event_list_schema['properties']['events']['items']['type'] == 'object'
+    event_list_schema['properties']['events']['items']['type'] = 'AbstractEvent'
+    assert get_event_list_schema()['properties']['events']['items']['type'] == 'object'
+
+    # building the event list schema does not change the event schema
+    abstract_event = get_collector_config().event_schema.events.schema['AbstractEvent']
+    assert abstract_event['properties']['location_stack']['items']['type'] == 'AbstractLocationContext'
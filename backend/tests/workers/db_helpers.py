@@ -0,0 +1,118 @@
+"""
+Copyright 2021 Objectiv B.V.
+
+Database helpers for the worker tests:
+ * FakeConnection: records the executed queries, without a database
+ * postgres_schema(): a connection to a real Postgres database, with the tables of create_tables.sql in a
+   new schema. Tests using it are skipped if no database is available, see get_config_postgres() for the
+   settings.
+"""
+import re
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+import psycopg2
+import pytest
+
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.tools.db_init.db_init import get_sql
+
+# Gives the rows that a query returns, from the query and its parameters.
+ResultFunction = Callable[[str, Any], Sequence[tuple]]
+
+
+class FakeCursor:
+    """ Cursor that records the executed queries, and gives the rows of result_function as result. """
+    def __init__(self, result_function: Optional[ResultFunction] = None):
+        self.result_function = result_function
+        self.queries: List[tuple] = []
+        self.result: Sequence[tuple] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, parameters=None):
+        # Composed queries are recorded as their repr, e.g. "Composed([SQL('drop table '), Identifier(...)])"
+        query = query if isinstance(query, str) else repr(query)
+        self.queries.append((query, parameters))
+        self.result = self.result_function(query, parameters) if self.result_function else []
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchmany(self, size):
+        rows, self.result = self.result[:size], self.result[size:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, result_function: Optional[ResultFunction] = None):
+        self._cursor = FakeCursor(result_function)
+        self.transactions = 0
+
+    def __enter__(self):
+        self.transactions += 1
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self, name=None):
+        if name is None:
+            return self._cursor
+        # a named (server side) cursor keeps its result while other queries are executed
+        cursor = FakeCursor(self._cursor.result_function)
+        cursor.queries = self._cursor.queries
+        return cursor
+
+    def executed(self, text):
+        """ Give the parameters of the executed queries that contain text """
+        return [parameters for query, parameters in self._cursor.queries if text in query]
+
+
+# Statements of create_tables.sql that can't be run in a test schema: roles are global, and the tables are
+# created in the transaction of the test connection.
+_GLOBAL_STATEMENT_RE = re.compile(r'^(begin|commit|create role .*|grant .*);$', re.MULTILINE)
+
+
+def without_global_statements(sql: str) -> str:
+    """ Give the sql of create_tables.sql or create_tables_upgrade.sql, without the global statements. """
+    return _GLOBAL_STATEMENT_RE.sub('', sql)
+
+
+@contextmanager
+def postgres_schema(partitioned: bool = False) -> Iterator[Any]:
+    """
+    Give a connection to Postgres with the tables of create_tables.sql in a new schema, which is dropped
+    afterwards. Skips the test if Postgres is not available.
+    :param partitioned: if set, use the partitioned layout of the data tables
+    """
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        pytest.skip('Postgres output is not enabled')
+    try:
+        connection = get_db_connection(pg_config)
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f'Postgres is not available: {exc}')
+    schema = f'test_{uuid.uuid4().hex}'
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'create schema {schema}')
+                cursor.execute(f'set search_path to {schema}')
+                cursor.execute(without_global_statements(get_sql(partitioned=partitioned)))
+        yield connection
+    finally:
+        connection.rollback()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'drop schema {schema} cascade')
+        connection.close()
@@ -0,0 +1,47 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import pytest
+from psycopg2.errors import LockNotAvailable
+
+from objectiv_backend.workers import worker_entry, worker_finalize
+from objectiv_backend.workers.util import AdaptiveBatchSize
+
+
+class FakeConnection:
+    """ Connection that is only used as transaction context manager. """
+    def __init__(self):
+        self.rolled_back = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.rolled_back = exc_type is not None
+
+
+class LockingQueues:
+    """ PostgresQueues of which every query hits the lock_timeout. """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_events(self, queue, max_items):
+        raise LockNotAvailable('canceling statement due to lock timeout')
+
+
+@pytest.mark.parametrize('module, function', [
+    (worker_entry, worker_entry.main_entry),
+    (worker_finalize, worker_finalize.main_finalize),
+])
+def test_lock_timeout_decreases_batch_size(monkeypatch, module, function):
+    batch_size = AdaptiveBatchSize(initial=400, minimum=10, maximum=1000, target_seconds=1.0)
+    monkeypatch.setattr(module, '_batch_size', batch_size)
+    monkeypatch.setattr(module, 'PostgresQueues', LockingQueues)
+    monkeypatch.setattr(worker_finalize, 'maybe_maintain_partitions', lambda connection: None)
+    connection = FakeConnection()
+
+    assert function(connection) == 0
+    assert connection.rolled_back
+    assert batch_size.size == 200
+    assert function(connection) == 0
+    assert batch_size.size == 100
@@ -0,0 +1,135 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import uuid
+from datetime import date
+
+import pytest
+from psycopg2 import sql
+
+from objectiv_backend.tools.db_init.db_init import get_sql
+from objectiv_backend.workers import pg_partitions
+from objectiv_backend.workers.pg_partitions import apply_retention, create_partitions, get_partition_name, \
+    get_partitions, maintain_partitions, PARTITIONED_TABLES
+from tests.workers.db_helpers import FakeConnection, postgres_schema
+
+
+def _get_connection(partitions=None, got_lock=True) -> FakeConnection:
+    """ Give a connection that gives the partitions of the table queried for, and got_lock for the lock. """
+    partitions = partitions or {}
+
+    def result_function(query, parameters):
+        if 'pg_inherits' in query:
+            return [(name, ) for name in partitions.get(parameters[0], [])]
+        return [(got_lock, )]
+
+    return FakeConnection(result_function)
+
+
+def test_get_partitions():
+    connection = _get_connection({'data': ['data_default', 'data_p20210827', 'data_p20210828', 'data_old']})
+    assert get_partitions(connection, 'data') == {
+        date(2021, 8, 27): 'data_p20210827',
+        date(2021, 8, 28): 'data_p20210828',
+    }
+    assert get_partitions(connection, 'nok_data') == {}
+    assert get_partition_name('nok_data', date(2021, 8, 1)) == 'nok_data_p20210801'
+
+
+def test_create_partitions():
+    connection = _get_connection({'data': ['data_default', 'data_p20210827'], 'nok_data': ['nok_data_p20210828']})
+    created = create_partitions(connection, date(2021, 8, 27), date(2021, 8, 28))
+    assert created == ['data_p20210828', 'nok_data_p20210827']
+    # rows of the new partition's day are moved from the default partition before attaching it
+    parameters = connection.executed("Identifier('data_p20210828')")
+    assert parameters == [{'start': date(2021, 8, 28), 'end': date(2021, 8, 29)}]
+
+
+@pytest.mark.parametrize('action', ['drop', 'detach'])
+def test_apply_retention(action):
+    connection = _get_connection({'data': ['data_p20210826', 'data_p20210827', 'data_p20210828']})
+    removed = apply_retention(connection, date(2021, 8, 28), action)
+    assert removed == ['data_p20210826', 'data_p20210827']
+    statement = "SQL('drop table ')" if action == 'drop' else "SQL(' detach partition ')"
+    assert len(connection.executed(statement)) == 2
+    assert connection.executed('data_event_id') == [(date(2021, 8, 28), )]
+    assert connection.executed("Identifier('nok_data_default')") == [(date(2021, 8, 28), )]
+
+    with pytest.raises(ValueError):
+        apply_retention(connection, date(2021, 8, 28), 'truncate')
+
+
+def test_maintain_partitions(monkeypatch):
+    connection = _get_connection({'data': ['data_p20210820']})
+    assert maintain_partitions(connection, today=date(2021, 8, 27), days_ahead=2, retention_days=7)
+    # partitions from yesterday up to two days ahead, and the partition of 2021-08-20 is older than 7 days
+    assert [query for query, _ in connection.cursor().queries if "SQL('drop table ')" in query]
+    assert len(connection.executed('attach partition')) == 8
+
+    connection = _get_connection(got_lock=False)
+    assert not maintain_partitions(connection, today=date(2021, 8, 27))
+    assert not connection.executed('attach partition')
+
+    monkeypatch.setattr(pg_partitions, 'PG_DATA_PARTITIONED', False)
+    pg_partitions.maybe_maintain_partitions(connection)
+    assert len(connection.cursor().queries) == 1
+
+
+def _insert_event(cursor, day: date):
+    event_id = uuid.uuid4()
+    cursor.execute('''
+        insert into data_event_id(event_id, day) values (%(event_id)s, %(day)s);
+        insert into data(event_id, day, moment, cookie_id, value)
+        values (%(event_id)s, %(day)s, %(day)s, %(event_id)s, '{}');
+        insert into nok_data(event_id, day, moment, cookie_id, value)
+        values (%(event_id)s, %(day)s, %(day)s, %(event_id)s, '{}');
+    ''', {'event_id': event_id, 'day': day})
+
+
+def _count_events(cursor, table: str) -> int:
+    cursor.execute(sql.SQL('select count(*) from {table}').format(table=sql.Identifier(table)))
+    return cursor.fetchone()[0]
+
+
+@pytest.mark.parametrize('action', ['drop', 'detach'])
+def test_partitions_postgres(action):
+    with postgres_schema(partitioned=True) as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                for day in [date(2021, 8, 25), date(2021, 8, 27), date(2021, 8, 27), date(2021, 8, 28)]:
+                    _insert_event(cursor, day)
+
+            # the events of 08-27 are moved from the default partitions to the new partitions
+            assert create_partitions(connection, date(2021, 8, 26), date(2021, 8, 27)) == [
+                'data_p20210826', 'data_p20210827', 'nok_data_p20210826', 'nok_data_p20210827']
+            assert create_partitions(connection, date(2021, 8, 26), date(2021, 8, 27)) == []
+            assert sorted(get_partitions(connection, 'data').values()) == ['data_p20210826', 'data_p20210827']
+            with connection.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    assert _count_events(cursor, f'{table}_p20210827') == 2
+                    assert _count_events(cursor, f'{table}_default') == 2
+                    assert _count_events(cursor, table) == 4
+
+            # events before 08-27 are removed from the partitions, default partitions and data_event_id
+            assert apply_retention(connection, date(2021, 8, 27), action) == [
+                'data_p20210826', 'nok_data_p20210826']
+            with connection.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    assert _count_events(cursor, f'{table}_default') == 1
+                    assert _count_events(cursor, table) == 3
+                assert _count_events(cursor, 'data_event_id') == 3
+                cursor.execute("select count(*) from pg_tables where tablename = 'data_p20210826'")
+                assert cursor.fetchone()[0] == (1 if action == 'detach' else 0)
+
+
+def test_get_sql_partitioned():
+    sql = get_sql()
+    assert 'data_event_id' not in sql
+    partitioned_sql = get_sql(partitioned=True)
+    assert 'create table data_event_id' in partitioned_sql
+    assert 'create table data_default partition of data default;' in partitioned_sql
+    assert 'grant select, insert on data_event_id' in partitioned_sql
+    assert partitioned_sql.count('create table nok_data ') == 1
+    # everything outside of the sections is the same
+    assert partitioned_sql.split('-- end data grants')[1] == sql.split('-- end data grants')[1]
+    assert 'create or replace view data_with_sessions' in partitioned_sql
@@ -0,0 +1,170 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import socket
+
+from objectiv_backend.tools.db_init.db_init import get_sql
+from objectiv_backend.workers import pg_queues
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage, get_shard, get_worker_shards, \
+    set_worker_shards
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=None):
+        self.connection.queries.append(' '.join(query.split()))
+
+    def fetchall(self):
+        if self.connection.rows_per_query:
+            return self.connection.rows_per_query.pop(0)
+        return self.connection.rows
+
+    def fetchone(self):
+        return self.fetchall()[0]
+
+
+class FakeConnection:
+    """ Connection that receives notifications over a socket, like a psycopg2 connection. """
+    def __init__(self):
+        self.queries = []
+        self.rows = []
+        self.rows_per_query = []
+        self.notifies = []
+        self._socket, self.server_socket = socket.socketpair()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def poll(self):
+        for channel in self._socket.recv(1024).decode('utf-8').split():
+            self.notifies.append(channel)
+
+
+def test_get_events():
+    connection = FakeConnection()
+    connection.rows = [('a', {'id': 'a', '_type': 'ClickEvent'}), ('b', {'id': 'b', '_type': 'ClickEvent'})]
+    events = PostgresQueues(connection).get_events(ProcessingStage.ENTRY, max_items=10)
+    assert events == [{'id': 'a', '_type': 'ClickEvent'}, {'id': 'b', '_type': 'ClickEvent'}]
+    assert [event['id'] for event in events] == ['a', 'b']
+
+
+def test_listen():
+    connection = FakeConnection()
+    PostgresQueues(connection).listen([ProcessingStage.ENTRY, ProcessingStage.FINALIZE])
+    assert connection.queries == ['listen queue_entry', 'listen queue_finalize']
+
+
+def test_put_events_notifies(monkeypatch):
+    monkeypatch.setattr('objectiv_backend.workers.pg_queues.execute_values', lambda *args, **kwargs: None)
+    connection = FakeConnection()
+    pg_queues = PostgresQueues(connection)
+    pg_queues.put_events(queue=ProcessingStage.FINALIZE, events=[])
+    assert connection.queries == []
+    pg_queues.put_events(queue=ProcessingStage.FINALIZE, events=[{'id': 'event-id'}])
+    assert connection.queries == ['notify queue_finalize']
+
+
+def test_wait_for_events():
+    connection = FakeConnection()
+    pg_queues = PostgresQueues(connection)
+    assert pg_queues.wait_for_events(timeout=0.01) is False
+
+    connection.server_socket.send(b'queue_entry')
+    assert pg_queues.wait_for_events(timeout=0.01) is True
+    assert connection.notifies == []
+
+    # notifications that were received earlier are consumed without waiting
+    connection.notifies.append('queue_entry')
+    assert pg_queues.wait_for_events(timeout=10) is True
+    assert pg_queues.wait_for_events(timeout=0.01) is False
+
+
+def test_get_worker_shards():
+    assert get_worker_shards(number=0, worker_count=3, shard_count=8) == [0, 3, 6]
+    assert get_worker_shards(number=2, worker_count=3, shard_count=8) == [2, 5]
+    assert get_worker_shards(number=5, worker_count=6, shard_count=4) == [1]
+    assert get_worker_shards(number=0, worker_count=1, shard_count=1) == [0]
+
+
+def test_put_events_sharded(monkeypatch):
+    inserted = {}
+
+    def execute_values(cursor, query, values, **kwargs):
+        inserted[query.split()[2].split('(')[0]] = [value[0] for value in values]
+
+    monkeypatch.setattr('objectiv_backend.workers.pg_queues.execute_values', execute_values)
+    connection = FakeConnection()
+    events = [{'id': f'event-{i}'} for i in range(20)]
+    PostgresQueues(connection, shard_count=4).put_events(queue=ProcessingStage.ENTRY, events=events)
+    assert inserted == {
+        f'queue_entry_{shard}': [event['id'] for event in events if get_shard(event['id'], 4) == shard]
+        for shard in range(4)
+    }
+    assert connection.queries == [f'notify queue_entry_{shard}' for shard in range(4)]
+
+
+def test_get_events_sharded(monkeypatch):
+    monkeypatch.setattr(pg_queues, '_next_shard_position', {})
+    set_worker_shards([1, 3, 5])
+    try:
+        connection = FakeConnection()
+        connection.rows_per_query = [[('a', {'id': 'a'})], [('b', {'id': 'b'}), ('c', {'id': 'c'})]]
+        queues = PostgresQueues(connection, shard_count=6)
+        queues.listen([ProcessingStage.FINALIZE])
+        assert connection.queries == [f'listen queue_finalize_{shard}' for shard in [1, 3, 5]]
+
+        # shards are tried in turn until there are enough events
+        connection.queries.clear()
+        assert queues.get_events(ProcessingStage.FINALIZE, max_items=3) == [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+        tables = [query.split()[2] for query in connection.queries]
+        assert len(tables) == 2
+        assert tables[1] == {'queue_finalize_1': 'queue_finalize_3', 'queue_finalize_3': 'queue_finalize_5',
+                             'queue_finalize_5': 'queue_finalize_1'}[tables[0]]
+        assert 'limit %s' in connection.queries[0]
+
+        # the next call starts at the next shard
+        connection.queries.clear()
+        queues.get_events(ProcessingStage.FINALIZE, max_items=3)
+        assert connection.queries[0].split()[2] == tables[1]
+        assert len(connection.queries) == 3
+    finally:
+        set_worker_shards(None)
+
+
+def test_get_queue_depth_keeps_shard_turn(monkeypatch):
+    monkeypatch.setattr(pg_queues, '_next_shard_position', {})
+    connection = FakeConnection()
+    connection.rows_per_query = [[('a', {'id': 'a'})], [(10, )], [('b', {'id': 'b'})]]
+    queues = PostgresQueues(connection, shard_count=2)
+
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=1) == [{'id': 'a'}]
+    first_table = connection.queries[0].split()[2]
+    assert queues.get_queue_depth(ProcessingStage.ENTRY) == 10
+    assert 'queue_entry_0' in connection.queries[1] and 'queue_entry_1' in connection.queries[1]
+
+    # the queue depth doesn't count as a turn, the next call starts at the other shard
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=1) == [{'id': 'b'}]
+    assert connection.queries[2].split()[2] == {'queue_entry_0': 'queue_entry_1',
+                                                'queue_entry_1': 'queue_entry_0'}[first_table]
+
+
+def test_get_sql_queue_shards():
+    sql = get_sql(queue_shards=3, unlogged_queues=True)
+    assert 'create table queue_entry ' not in sql
+    for shard in range(3):
+        assert f'create unlogged table queue_entry_{shard} (' in sql
+        assert f'create index on queue_finalize_{shard}(insert_order);' in sql
+        assert f'grant select, update, insert, delete on queue_finalize_{shard} to obj_worker_role;' in sql
+    assert 'create unlogged table data' not in sql
+    assert 'create table queue_entry (' in get_sql()
@@ -0,0 +1,186 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import os
+from datetime import date
+
+import uuid
+
+import pytest
+
+from objectiv_backend.workers import worker_finalize
+from objectiv_backend.workers.pg_rollups import claim_shard, get_hll_registers, hll_estimate, rebuild_rollups, \
+    update_rollups, HLL_REGISTER_COUNT
+from objectiv_backend.workers.pg_storage import insert_events_into_data
+from tests.workers.db_helpers import FakeConnection, postgres_schema
+
+
+@pytest.mark.parametrize('count', [0, 10, 1000, 100000])
+def test_hll_estimate(count):
+    values = [f'cookie-{i}' for i in range(count)]
+    registers = get_hll_registers(values + values[:count // 2])
+    assert len(registers) == HLL_REGISTER_COUNT
+    assert hll_estimate(registers) == pytest.approx(count, rel=0.05)
+
+
+def test_hll_union():
+    values = [f'cookie-{i}' for i in range(2000)]
+    registers1 = get_hll_registers(values[:1500])
+    registers2 = get_hll_registers(values[1000:])
+    # the union of sketches is the sketch of the union
+    assert [max(pair) for pair in zip(registers1, registers2)] == get_hll_registers(values)
+
+
+def _make_event(event_id, time, cookie_id='cookie', application='app', event_type='PressEvent'):
+    global_contexts = [{'_type': 'CookieIdContext', 'id': 'c', 'cookie_id': cookie_id}]
+    if application:
+        global_contexts.append({'_type': 'ApplicationContext', 'id': application})
+    return {'_type': event_type, 'id': event_id, 'time': time, 'global_contexts': global_contexts}
+
+
+def test_update_rollups():
+    connection = FakeConnection()
+    day1 = 1630049334860  # 2021-08-27
+    day2 = day1 + 24 * 3600 * 1000
+    update_rollups(connection, [
+        _make_event('1', day1),
+        _make_event('2', day1, cookie_id='other-cookie'),
+        _make_event('3', day1, event_type='ClickEvent'),
+        _make_event('4', day2, application=''),
+    ], shard=3)
+
+    counts = connection.executed('insert into daily_event_counts')
+    assert counts == [{
+        'shard': 3,
+        'days': [date(2021, 8, 27), date(2021, 8, 27), date(2021, 8, 28)],
+        'applications': ['app', 'app', ''],
+        'event_types': ['ClickEvent', 'PressEvent', 'PressEvent'],
+        'event_counts': [1, 2, 1],
+    }]
+    cookies = connection.executed('insert into daily_cookies')[0]
+    assert cookies['days'] == [date(2021, 8, 27), date(2021, 8, 28)]
+    assert cookies['applications'] == ['app', '']
+    registers = [int(register) for register in cookies['registers'][0].strip('{}').split(',')]
+    assert registers == get_hll_registers(['cookie', 'other-cookie'])
+
+    connection = FakeConnection()
+    update_rollups(connection, [])
+    assert not connection.cursor().queries
+
+
+def test_claim_shard():
+    # the first shard that isn't locked by another transaction
+    connection = FakeConnection(lambda query, parameters: [(5, )] if 'pg_try_advisory_xact_lock' in query else [])
+    assert claim_shard(connection, shard_count=16) == 5
+    assert connection.executed('pg_try_advisory_xact_lock')[0]['start'] == os.getpid() % 16
+    update_rollups(connection, [_make_event('1', 1630049334860)])
+    assert connection.executed('insert into daily_event_counts')[0]['shard'] == 5
+
+    # all shards are locked: wait for the shard of this process
+    connection = FakeConnection()
+    assert claim_shard(connection, shard_count=16) == os.getpid() % 16
+    assert connection.executed('select pg_advisory_xact_lock') == [(0x726f6c6c, os.getpid() % 16)]
+
+
+def test_update_rollups_postgres():
+    with postgres_schema() as connection:
+        day1 = 1630049334860  # 2021-08-27
+        cookie_ids = [str(uuid.uuid4()) for _ in range(100)]
+        with connection:
+            # the same day and application in two shards
+            update_rollups(connection, [_make_event(str(i), day1, cookie_id=cookie_ids[i]) for i in range(60)],
+                           shard=0)
+            update_rollups(connection, [_make_event(str(i), day1, cookie_id=cookie_ids[i]) for i in range(40, 100)],
+                           shard=1)
+            update_rollups(connection, [_make_event('x', day1, application='other', event_type='ClickEvent')])
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select day, application, event_type, event_count from daily_events order by 2, 3')
+                assert cursor.fetchall() == [
+                    (date(2021, 8, 27), 'app', 'PressEvent', 120),
+                    (date(2021, 8, 27), 'other', 'ClickEvent', 1),
+                ]
+                cursor.execute('select application, user_count from daily_users order by 1')
+                users = cursor.fetchall()
+                assert [application for application, _ in users] == ['app', 'other']
+                assert [user_count for _, user_count in users] == [pytest.approx(100, abs=2), 1]
+
+
+def test_main_finalize_updates_rollups(monkeypatch):
+    events = [_make_event('1', 1630049334860), _make_event('2', 1630049334860)]
+
+    class FakeQueues:
+        def __init__(self, connection):
+            pass
+
+        def get_events(self, queue, max_items):
+            return events
+
+    rolled_up = []
+    monkeypatch.setattr(worker_finalize, 'PostgresQueues', FakeQueues)
+    monkeypatch.setattr(worker_finalize, 'maybe_maintain_partitions', lambda connection: None)
+    monkeypatch.setattr(worker_finalize, 'maybe_sessionize', lambda connection: None)
+    # the second event is a duplicate
+    monkeypatch.setattr(worker_finalize, 'insert_events_into_data', lambda connection, events: events[:1])
+    monkeypatch.setattr(worker_finalize, 'update_rollups', lambda connection, events: rolled_up.extend(events))
+
+    monkeypatch.setattr(worker_finalize, 'PG_ROLLUPS_ENABLED', False)
+    assert worker_finalize.main_finalize(FakeConnection()) == 2
+    assert rolled_up == []
+
+    # only the inserted events are counted
+    monkeypatch.setattr(worker_finalize, 'PG_ROLLUPS_ENABLED', True)
+    assert worker_finalize.main_finalize(FakeConnection()) == 2
+    assert rolled_up == [events[0]]
+
+
+def test_rebuild_rollups():
+    day1 = 1630049334860  # 2021-08-27
+    day2 = day1 + 24 * 3600 * 1000
+    values = {
+        date(2021, 8, 27): [(_make_event('1', day1), ), (_make_event('2', day1), ), (_make_event('3', day1), )],
+        date(2021, 8, 28): [(_make_event('4', day2), )],
+    }
+
+    def result_function(query, parameters):
+        if 'select distinct day' in query:
+            return [(day, ) for day in values]
+        if 'select value from data' in query:
+            return values[parameters[0]]
+        return []
+
+    connection = FakeConnection(result_function)
+    assert rebuild_rollups(connection, batch_size=2, shard_count=4) == 4
+    # a transaction to find the days, and one per day
+    assert connection.transactions == 3
+    assert connection.executed('select distinct day') == [(date.min, )]
+    assert connection.executed('pg_advisory_xact_lock') == [(0x726f6c6c, 4), (0x726f6c6c, 4)]
+    assert connection.executed('delete from daily_event_counts') == [(date(2021, 8, 27), ), (date(2021, 8, 28), )]
+    assert connection.executed('delete from daily_cookies') == [(date(2021, 8, 27), ), (date(2021, 8, 28), )]
+    # the events of a day are counted in batches
+    counts = connection.executed('insert into daily_event_counts')
+    assert [parameters['event_counts'] for parameters in counts] == [[2], [1], [1]]
+
+    connection = FakeConnection(result_function)
+    rebuild_rollups(connection, first_day=date(2021, 8, 28))
+    assert connection.executed('select distinct day') == [(date(2021, 8, 28), )]
+
+
+def test_rebuild_rollups_postgres():
+    with postgres_schema() as connection:
+        day1 = 1630049334860  # 2021-08-27
+        day2 = day1 + 24 * 3600 * 1000
+        events = [_make_event(str(uuid.uuid4()), day1, cookie_id=str(uuid.uuid4())) for _ in range(3)]
+        events.append(_make_event(str(uuid.uuid4()), day2, cookie_id=str(uuid.uuid4())))
+        with connection:
+            insert_events_into_data(connection, events)
+            # only some events are counted, e.g. because the rollups were enabled later
+            update_rollups(connection, events[:1])
+        assert rebuild_rollups(connection, batch_size=2) == 4
+        assert rebuild_rollups(connection, first_day=date(2021, 8, 28)) == 1
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select day, event_count from daily_events order by 1')
+                assert cursor.fetchall() == [(date(2021, 8, 27), 3), (date(2021, 8, 28), 1)]
+                cursor.execute('select day, user_count from daily_users order by 1')
+                assert cursor.fetchall() == [(date(2021, 8, 27), 3), (date(2021, 8, 28), 1)]
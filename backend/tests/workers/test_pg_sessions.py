@@ -0,0 +1,199 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import re
+import uuid
+from datetime import date, datetime, timedelta
+
+from objectiv_backend.tools.db_init.db_init import get_upgrade_sql
+from objectiv_backend.workers import pg_sessions
+from objectiv_backend.workers.pg_sessions import maybe_sessionize, rebuild_sessions, sessionize_new_events, \
+    update_sessions
+from tests.workers.db_helpers import FakeConnection, postgres_schema, without_global_statements
+
+_START = datetime(2021, 8, 27, 12)
+
+
+def test_update_sessions():
+    connection = FakeConnection()
+    update_sessions(connection, [
+        ('cookie-2', datetime(2021, 8, 27, 12)),
+        ('cookie-1', datetime(2021, 8, 27, 10)),
+        # a late event
+        ('cookie-2', datetime(2021, 8, 26, 23)),
+        ('cookie-2', datetime(2021, 8, 27, 11)),
+    ], gap_seconds=60)
+
+    # the cookies are locked before they are sessionized
+    queries = [query for query, _ in connection.cursor().queries]
+    assert 'pg_advisory_xact_lock' in queries[0]
+    assert 'insert into sessions' in queries[1]
+    assert connection.executed('insert into sessions') == [{
+        'cookie_ids': ['cookie-1', 'cookie-2'],
+        'first_moments': [datetime(2021, 8, 27, 10), datetime(2021, 8, 26, 23)],
+        'last_moments': [datetime(2021, 8, 27, 10), datetime(2021, 8, 27, 12)],
+        'gap_seconds': 60,
+    }]
+
+    connection = FakeConnection()
+    update_sessions(connection, [])
+    assert not connection.cursor().queries
+
+
+def test_rebuild_sessions():
+    connection = FakeConnection(lambda query, parameters: [('cookie-3', ), ('cookie-1', ), ('cookie-2', )])
+    assert rebuild_sessions(connection, batch_size=2) == 3
+    assert connection.transactions == 3
+    assert connection.executed('delete from sessions') == [(['cookie-1', 'cookie-2'], ), (['cookie-3'], )]
+    sessionized = connection.executed('insert into sessions')
+    assert [parameters['cookie_ids'] for parameters in sessionized] == [['cookie-1', 'cookie-2'], ['cookie-3']]
+    assert sessionized[1]['first_moments'] == [datetime.min]
+
+
+def _get_sessionize_connection(batches, got_lock=True):
+    """ Give a connection that gives a batch of new events per query for them, and got_lock for the lock. """
+    def result_function(query, parameters):
+        if 'pg_try_advisory_xact_lock' in query:
+            return [(got_lock, )]
+        if 'not exists' in query:
+            return batches.pop(0)
+        return []
+
+    return FakeConnection(result_function)
+
+
+def test_sessionize_new_events():
+    connection = _get_sessionize_connection([
+        [('cookie-1', datetime(2021, 8, 27, 10), datetime(2021, 8, 27, 11)),
+         ('cookie-2', datetime(2021, 8, 26, 23), datetime(2021, 8, 26, 23))],
+        [('cookie-3', datetime(2021, 8, 27, 12), datetime(2021, 8, 27, 13))],
+    ])
+    assert sessionize_new_events(connection, since=datetime(2021, 8, 26, 12), batch_size=2, gap_seconds=60) == 3
+    # a transaction per batch, until a batch is not full
+    assert connection.transactions == 2
+    assert connection.executed('not exists') == [{'since': date(2021, 8, 26), 'batch_size': 2}] * 2
+    sessionized = connection.executed('insert into sessions')
+    assert sessionized[0]['cookie_ids'] == ['cookie-1', 'cookie-2']
+    assert sessionized[0]['first_moments'] == [datetime(2021, 8, 27, 10), datetime(2021, 8, 26, 23)]
+    assert sessionized[0]['last_moments'] == [datetime(2021, 8, 27, 11), datetime(2021, 8, 26, 23)]
+    assert sessionized[1]['cookie_ids'] == ['cookie-3']
+
+    # another process is sessionizing
+    connection = _get_sessionize_connection([], got_lock=False)
+    assert sessionize_new_events(connection, since=datetime(2021, 8, 26, 12)) is None
+    assert not connection.executed('not exists')
+
+
+def test_maybe_sessionize(monkeypatch):
+    monkeypatch.setattr(pg_sessions, '_last_sessionize', None)
+    monkeypatch.setattr(pg_sessions, 'PG_SESSIONS_ENABLED', True)
+    connection = _get_sessionize_connection([[]])
+    maybe_sessionize(connection)
+    assert len(connection.executed('not exists')) == 1
+    # not again within PG_SESSION_INTERVAL_SECONDS
+    maybe_sessionize(connection)
+    assert len(connection.executed('not exists')) == 1
+
+    monkeypatch.setattr(pg_sessions, '_last_sessionize', None)
+    monkeypatch.setattr(pg_sessions, 'PG_SESSIONS_ENABLED', False)
+    maybe_sessionize(connection)
+    assert len(connection.executed('not exists')) == 1
+
+
+def _insert_events(connection, cookie_id, minutes, sessionize=True):
+    """
+    Insert events at the given minutes after _START into data, and sessionize them like
+    sessionize_new_events() does, if sessionize is set.
+    """
+    event_ids = {}
+    with connection:
+        with connection.cursor() as cursor:
+            for minute in minutes:
+                event_ids[minute] = uuid.uuid4()
+                cursor.execute('''
+                    insert into data(event_id, day, moment, cookie_id, value)
+                    values (%s, %s, %s, %s, '{}')
+                ''', (event_ids[minute], _START.date(), _START + timedelta(minutes=minute), cookie_id))
+        if sessionize:
+            update_sessions(connection, [(cookie_id, _START + timedelta(minutes=minute)) for minute in minutes],
+                            gap_seconds=1800)
+    return event_ids
+
+
+def _get_sessions(connection, event_ids):
+    """ Give the sessions as lists of the minutes of their events, in order of session_hit_number. """
+    minutes = {event_id: minute for minute, event_id in event_ids.items()}
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                select event_id, session_id, session_hit_number from sessions
+                where event_id = any(%s) order by moment
+            ''', (list(event_ids.values()), ))
+            rows = cursor.fetchall()
+    sessions = {}
+    for event_id, session_id, session_hit_number in rows:
+        assert len(sessions.setdefault(session_id, [])) == session_hit_number - 1
+        sessions[session_id].append(minutes[event_id])
+    # the session_id is the event_id of the first event
+    assert all(event_ids[session[0]] == session_id for session_id, session in sessions.items())
+    return sorted(sessions.values())
+
+
+def test_update_sessions_postgres():
+    with postgres_schema() as connection:
+        cookie_id = uuid.uuid4()
+        event_ids = _insert_events(connection, cookie_id, [0, 10, 20, 120])
+        assert _get_sessions(connection, event_ids) == [[0, 10, 20], [120]]
+
+        # a late event more than the gap from the others starts a new session
+        event_ids.update(_insert_events(connection, cookie_id, [70]))
+        assert _get_sessions(connection, event_ids) == [[0, 10, 20], [70], [120]]
+
+        # a late event within the gap of two sessions merges them, the session of minute 120 is after the
+        # window_end and is not changed
+        event_ids.update(_insert_events(connection, cookie_id, [45]))
+        assert _get_sessions(connection, event_ids) == [[0, 10, 20, 45, 70], [120]]
+
+        # events at the start and the end of the sessions, and in between, merging all events
+        event_ids.update(_insert_events(connection, cookie_id, [-20, 95, 145]))
+        assert _get_sessions(connection, event_ids) == [[-20, 0, 10, 20, 45, 70, 95, 120, 145]]
+
+        # other cookies have their own sessions
+        other_event_ids = _insert_events(connection, uuid.uuid4(), [5, 100])
+        assert _get_sessions(connection, other_event_ids) == [[5], [100]]
+
+        # rebuilding gives the same sessions
+        assert rebuild_sessions(connection) == 2
+        assert _get_sessions(connection, event_ids) == [[-20, 0, 10, 20, 45, 70, 95, 120, 145]]
+
+        # the upgrade of an existing database doesn't fail on, or change, the existing tables
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(without_global_statements(get_upgrade_sql()))
+        assert _get_sessions(connection, other_event_ids) == [[5], [100]]
+
+
+def test_sessionize_new_events_postgres():
+    with postgres_schema() as connection:
+        cookie_id = uuid.uuid4()
+        event_ids = _insert_events(connection, cookie_id, [0, 10])
+        event_ids.update(_insert_events(connection, cookie_id, [-20, 30, 120], sessionize=False))
+        other_event_ids = _insert_events(connection, uuid.uuid4(), [5], sessionize=False)
+
+        # events that are not sessionized yet are in data_with_sessions, without session
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('select count(*) from data_with_sessions where session_id is null')
+                assert cursor.fetchone()[0] == 4
+
+        assert sessionize_new_events(connection, since=_START, batch_size=1) == 2
+        assert _get_sessions(connection, event_ids) == [[-20, 0, 10, 30], [120]]
+        assert _get_sessions(connection, other_event_ids) == [[5]]
+        assert sessionize_new_events(connection, since=_START) == 0
+
+
+def test_upgrade_sql_idempotent():
+    statements = re.findall(r'^create .*$', get_upgrade_sql(), flags=re.MULTILINE)
+    assert 'create table if not exists sessions (' in statements
+    assert all(' if not exists ' in statement or statement.startswith('create or replace ')
+               for statement in statements)
@@ -0,0 +1,167 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import csv
+import json
+from datetime import datetime
+
+from objectiv_backend.common.types import FailureReason
+from objectiv_backend.workers import pg_storage, recent_event_ids
+from objectiv_backend.workers.pg_storage import insert_events_into_data, insert_events_into_nok_data, \
+    _rows_to_csv
+from objectiv_backend.workers.recent_event_ids import RecentEventIds
+
+
+class FakeCursor:
+    def __init__(self, existing_event_ids):
+        self.existing_event_ids = existing_event_ids
+        self.staging = []
+        self.copied = {}
+        self.result = []
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, parameters=None):
+        self.queries.append(query)
+        if 'where event_id = any' in query:
+            self.result = [(event_id, ) for event_id in parameters[0] if event_id in self.existing_event_ids]
+        elif 'truncate staging_data' in query:
+            self.staging = []
+        elif 'from staging_data' in query:
+            self.result = []
+            for row in self.staging:
+                if row[0] not in self.existing_event_ids:
+                    self.existing_event_ids.add(row[0])
+                    self.result.append((row[0], ))
+        elif 'pg_try_advisory_xact_lock' in query:
+            # shard of the rollups
+            self.result = [(0, )]
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0]
+
+    def copy_expert(self, query, file):
+        rows = list(csv.reader(file))
+        table = query.split()[1].split('(')[0]
+        self.copied.setdefault(table, []).extend(rows)
+        if table == 'staging_data':
+            self.staging.extend(rows)
+
+
+class FakeConnection:
+    def __init__(self, existing_event_ids=()):
+        self._cursor = FakeCursor(set(existing_event_ids))
+
+    def cursor(self):
+        return self._cursor
+
+
+def _make_event(event_id: str):
+    return {
+        '_type': 'PressEvent',
+        'id': event_id,
+        'time': 1630049334860,
+        'global_contexts': [{'_type': 'CookieIdContext', 'id': 'c', 'cookie_id': 'cookie'}],
+        'location_stack': [],
+        'value': 'a "quoted", multi-line\nvalue with a \\ backslash'
+    }
+
+
+def test_rows_to_csv():
+    rows = [('id-1', datetime(2021, 8, 27, 7, 28, 54, 860000), json.dumps(_make_event('id-1')))]
+    parsed = list(csv.reader(_rows_to_csv(rows)))
+    assert parsed == [['id-1', '2021-08-27 07:28:54.860000', json.dumps(_make_event('id-1'))]]
+
+
+def test_copy_events_into_data(monkeypatch):
+    monkeypatch.setattr(pg_storage, 'PG_COPY_MIN_EVENTS', 0)
+    monkeypatch.setattr(pg_storage, 'PG_COPY_BATCH_SIZE', 2)
+    connection = FakeConnection(existing_event_ids={'id-2'})
+    events = [_make_event(event_id) for event_id in ['id-1', 'id-2', 'id-3', 'id-1', 'id-4']]
+    insert_events_into_data(connection, events)
+
+    copied = connection.cursor().copied
+    assert [row[0] for row in copied['staging_data']] == ['id-1', 'id-2', 'id-3', 'id-1', 'id-4']
+    assert [json.loads(row[4]) for row in copied['staging_data']] == events
+    # duplicates go to nok_data, including the second occurrence of an event_id within the same list
+    assert [row[0] for row in copied['nok_data']] == ['id-2', 'id-1']
+    assert {row[5] for row in copied['nok_data']} == {FailureReason.DUPLICATE.value}
+
+
+def test_insert_events_into_data_returns_inserted_events(monkeypatch):
+    monkeypatch.setattr(pg_storage, 'PG_COPY_MIN_EVENTS', 0)
+    connection = FakeConnection(existing_event_ids={'id-2'})
+    events = [_make_event(event_id) for event_id in ['id-1', 'id-2', 'id-1']]
+    # the duplicates are not returned
+    assert insert_events_into_data(connection, events) == [events[0]]
+    # rollups and sessions are not updated in the insert transaction
+    assert not [query for query in connection.cursor().queries if 'daily_' in query or 'sessions' in query]
+    assert insert_events_into_data(connection, []) == []
+
+
+def test_copy_events_into_partitioned_data(monkeypatch):
+    monkeypatch.setattr(pg_storage, 'PG_COPY_MIN_EVENTS', 0)
+    monkeypatch.setattr(pg_storage, 'PG_DATA_PARTITIONED', True)
+    connection = FakeConnection(existing_event_ids={'id-2'})
+    events = [_make_event(event_id) for event_id in ['id-1', 'id-2', 'id-1']]
+    insert_events_into_data(connection, events)
+
+    # with a partitioned data table, duplicates are detected with data_event_id
+    insert_query = [query for query in connection.cursor().queries if 'from staging_data' in query][0]
+    assert 'insert into data_event_id' in insert_query
+    assert 'order by staging_data.event_id, position' in insert_query
+    assert [row[0] for row in connection.cursor().copied['nok_data']] == ['id-2', 'id-1']
+
+
+def test_copy_events_into_nok_data(monkeypatch):
+    monkeypatch.setattr(pg_storage, 'PG_COPY_MIN_EVENTS', 0)
+    connection = FakeConnection()
+    insert_events_into_nok_data(connection, [_make_event('id-1')])
+    rows = connection.cursor().copied['nok_data']
+    assert len(rows) == 1
+    assert rows[0][0] == 'id-1'
+    assert rows[0][3] == 'cookie'
+    assert rows[0][5] == FailureReason.FAILED_VALIDATION.value
+
+
+def test_recent_event_ids(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(recent_event_ids.time, 'monotonic', lambda: now[0])
+    recent = RecentEventIds(max_size=3, max_seconds=60)
+    recent.add(['id-1', 'id-2', 'id-3'])
+    recent.add(['id-1', 'id-4'])
+    # the least recently added id is forgotten
+    assert [recent.contains(event_id) for event_id in ['id-1', 'id-2', 'id-3', 'id-4']] == [True, False, True, True]
+    now[0] += 30
+    recent.add(['id-3'])
+    now[0] += 31
+    assert [recent.contains(event_id) for event_id in ['id-1', 'id-3', 'id-4']] == [False, True, False]
+    assert len(recent) == 1
+
+
+def test_insert_recent_duplicates(monkeypatch):
+    monkeypatch.setattr(pg_storage, 'PG_COPY_MIN_EVENTS', 0)
+    recent = RecentEventIds(max_size=100, max_seconds=60)
+    monkeypatch.setattr(pg_storage, 'get_recent_event_ids', lambda: recent)
+    connection = FakeConnection()
+    insert_events_into_data(connection, [_make_event('id-1'), _make_event('id-2')])
+    assert recent.contains('id-1') and recent.contains('id-2')
+
+    # id-1 is known to be in data, so it's not inserted again. id-3 is in the filter, but not in data, e.g.
+    # because the transaction that inserted it was rolled back, so it's inserted.
+    recent.add(['id-3'])
+    connection.cursor().queries.clear()
+    insert_events_into_data(connection, [_make_event('id-1'), _make_event('id-3'), _make_event('id-4')])
+    queries = connection.cursor().queries
+    assert 'where event_id = any' in queries[0]
+    assert [row[0] for row in connection.cursor().staging] == ['id-3', 'id-4']
+    assert [row[0] for row in connection.cursor().copied['nok_data']] == ['id-1']
+    assert connection.cursor().copied['nok_data'][0][5] == FailureReason.DUPLICATE.value
@@ -0,0 +1,132 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
+
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.workers import supervisor, util
+from objectiv_backend.workers.supervisor import Supervisor, WorkerType
+from objectiv_backend.workers.util import worker_main
+
+# The workers are forked, so that they run with the monkeypatched functions and settings of the tests.
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                                reason='requires the fork start method')
+
+
+class FakeConnection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_database(monkeypatch):
+    """ Let worker_main() run without a database, and restore the signal handlers that it sets. """
+    pg_config = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                               password='', pool_min_size=1, pool_max_size=1)
+    monkeypatch.setattr(util, 'get_config_postgres', lambda: pg_config)
+    monkeypatch.setattr(util, 'get_db_connection', lambda pg_config: FakeConnection())
+    monkeypatch.setattr(util, '_stop_requested', threading.Event())
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def _send_signal_after(seconds: float, signum: int = signal.SIGTERM) -> threading.Timer:
+    timer = threading.Timer(seconds, os.kill, args=(os.getpid(), signum))
+    timer.start()
+    return timer
+
+
+@pytest.mark.parametrize('signum', [signal.SIGTERM, signal.SIGINT])
+def test_worker_main_stops_on_signal(fake_database, signum):
+    calls = []
+
+    def function(connection):
+        calls.append(connection)
+        if len(calls) == 3:
+            os.kill(os.getpid(), signum)
+        return 1
+
+    # the loop ends after the call to function during which the signal arrived
+    assert worker_main(function=function, loop=True) == 1
+    assert len(calls) == 3
+
+
+def test_worker_main_stops_while_waiting(fake_database):
+    timer = _send_signal_after(0.2)
+    start = time.time()
+    # without queues, the loop waits a second between calls that return 0, and stops when signalled
+    assert worker_main(function=lambda connection: 0, loop=True) == 0
+    assert time.time() - start < 0.9
+    timer.join()
+
+
+def _crashing_worker_main(function, **kwargs):
+    function(None)
+    sys.exit(1)
+
+
+def test_supervisor_restarts_workers_with_backoff(fake_database, monkeypatch, tmp_path):
+    monkeypatch.setattr(supervisor, 'worker_main', _crashing_worker_main)
+    monkeypatch.setattr(supervisor, 'MIN_RESTART_DELAY_SECONDS', 0.1)
+    monkeypatch.setattr(supervisor, 'MAX_RESTART_DELAY_SECONDS', 0.4)
+    starts_path = tmp_path / 'starts'
+
+    def record_start(connection):
+        with open(starts_path, 'a') as f:
+            f.write(f'{time.time()}\n')
+        return 0
+
+    worker_supervisor = Supervisor(worker_counts={WorkerType(name='crash', function=record_start, queues=()): 1})
+    timer = _send_signal_after(2)
+    worker_supervisor.run()
+    timer.join()
+
+    starts = [float(line) for line in starts_path.read_text().split()]
+    delays = [second - first for first, second in zip(starts, starts[1:])]
+    # the delay doubles from 0.1 s, up to 0.4 s
+    assert len(delays) >= 4
+    assert delays[0] == pytest.approx(0.1, abs=0.08)
+    assert delays[1] == pytest.approx(0.2, abs=0.08)
+    assert all(delay == pytest.approx(0.4, abs=0.08) for delay in delays[2:])
+    assert worker_supervisor._slots[0].restart_delay == 0.4
+
+
+def _sleep(connection):
+    time.sleep(0.1)
+    return 1
+
+
+def _ignore_sigterm(connection):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(0.1)
+    return 1
+
+
+@pytest.mark.parametrize('function, exit_code', [(_sleep, 0), (_ignore_sigterm, -signal.SIGKILL)])
+def test_supervisor_stops_workers(fake_database, monkeypatch, function, exit_code):
+    monkeypatch.setattr(supervisor, 'SHUTDOWN_TIMEOUT_SECONDS', 1)
+    worker_supervisor = Supervisor(worker_counts={WorkerType(name='sleep', function=function, queues=()): 2})
+    timer = _send_signal_after(0.5)
+    start = time.time()
+    worker_supervisor.run()
+    timer.join()
+
+    # workers finish their current batch and exit, workers that don't are killed after the timeout
+    processes = [slot.process for slot in worker_supervisor._slots]
+    assert [process.exitcode for process in processes] == [exit_code, exit_code]
+    assert time.time() - start < 0.5 + 1 + 1
@@ -0,0 +1,62 @@
+"""
+Copyright 2021 Objectiv B.V.
+"""
+import pytest
+
+from objectiv_backend.workers import util
+from objectiv_backend.workers.util import AdaptiveBatchSize, get_adaptive_batch_size
+
+
+def _get_batch_size() -> AdaptiveBatchSize:
+    return AdaptiveBatchSize(initial=100, minimum=10, maximum=400, target_seconds=1.0)
+
+
+def test_adaptive_batch_size_invalid():
+    with pytest.raises(ValueError, match='Invalid batch sizes'):
+        AdaptiveBatchSize(initial=100, minimum=400, maximum=200, target_seconds=1.0)
+    with pytest.raises(ValueError, match='Invalid batch sizes'):
+        AdaptiveBatchSize(initial=100, minimum=0, maximum=200, target_seconds=1.0)
+
+
+def test_adaptive_batch_size_initial_clamped():
+    assert AdaptiveBatchSize(initial=100, minimum=200, maximum=400, target_seconds=1.0).size == 200
+    assert AdaptiveBatchSize(initial=500, minimum=200, maximum=400, target_seconds=1.0).size == 400
+
+
+def test_get_adaptive_batch_size_settings(monkeypatch):
+    # The default WORKER_BATCH_SIZE is outside of the configured range, e.g. WORKER_BATCH_SIZE_MAX=100
+    monkeypatch.setattr(util, 'WORKER_BATCH_SIZE_MAX', 100)
+    assert get_adaptive_batch_size().size == 100
+    monkeypatch.setattr(util, 'WORKER_BATCH_SIZE_MAX', 5000)
+    monkeypatch.setattr(util, 'WORKER_BATCH_SIZE_MIN', 300)
+    assert get_adaptive_batch_size().size == 300
+
+
+def test_adaptive_batch_size_grows_with_deep_queue():
+    batch_size = _get_batch_size()
+    batch_size.update(event_count=100, duration=0.1, queue_depth=1000)
+    assert batch_size.size == 150
+    for _ in range(10):
+        batch_size.update(event_count=batch_size.size, duration=0.1, queue_depth=1000)
+    assert batch_size.size == 400
+
+
+def test_adaptive_batch_size_stable():
+    batch_size = _get_batch_size()
+    # batch not full: the queue is drained
+    batch_size.update(event_count=50, duration=0.1, queue_depth=0)
+    assert batch_size.size == 100
+    # batch full, but not much left in the queue
+    batch_size.update(event_count=100, duration=0.1, queue_depth=20)
+    assert batch_size.size == 100
+
+
+def test_adaptive_batch_size_shrinks():
+    batch_size = _get_batch_size()
+    batch_size.update(event_count=100, duration=2.0, queue_depth=1000)
+    assert batch_size.size == 50
+    batch_size.decrease()
+    assert batch_size.size == 25
+    for _ in range(10):
+        batch_size.decrease()
+    assert batch_size.size == 10